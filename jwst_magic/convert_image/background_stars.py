@@ -15,6 +15,7 @@ import random
 # Third Party Imports
 import fgscountrate
 import numpy as np
+from scipy import signal
 
 # Local Imports
 from jwst_magic.convert_image import renormalize
@@ -24,6 +25,10 @@ __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file
 PACKAGE_PATH = os.path.split(__location__)[0]
 OUT_PATH = os.path.split(PACKAGE_PATH)[0]  # Location of out/ and logs/ directory
 
+# Background star copies are added with a single FFT convolution when they
+# would add up to more than this many times as many pixels as the convolution
+FFT_COST_RATIO = 12
+
 # Start logger
 LOGGER = logging.getLogger(__name__)
 
@@ -118,33 +123,22 @@ def add_background_stars(image, stars, norm_value, norm_unit, guider,
 
     # (Try to) only use the data for added stars, not the noise
     mean = np.mean(image)
-    image[image < mean] = 0
+    template = np.where(image < mean, 0, image)
+
+    # Scale and position of each copy
+    scales, dy, dx = [], [], []
     for x, y, fgs_mag_back, hstid_back in zip(x_back, y_back, fgs_mags_back, hstid_back):
         if fgs_mag_back != 0:  # should have already removed all "bad" values marked with 0
             star_fgs_countrate = fgscountrate.convert_fgs_mag_to_cr(fgs_mag_back, guider)
-            scale_factor = star_fgs_countrate / fgs_countrate
-
-            star_data = image * scale_factor
-            psfx = psfy = 2048
-
-            # Crop the image to fit on the array at the specified location
-            x1 = max(0, int(x) - int(psfx / 2))
-            x2 = min(2048, int(x) + int(psfx / 2) + 1)
-            y1 = max(0, int(y) - int(psfy / 2))
-            y2 = min(2048, int(y) + int(psfy / 2) + 1)
-            if y > 1024:
-                star_data = star_data[:y2 - y1]
-            else:
-                star_data = star_data[2048 - (y2 - y1):]
-            if x > 1024:
-                star_data = star_data[:, :x2 - x1]
-            else:
-                star_data = star_data[:, 2048 - (x2 - x1):]
+            scales.append(star_fgs_countrate / fgs_countrate)
+            dy.append(_placement_shift(y, size))
+            dx.append(_placement_shift(x, size))
 
             LOGGER.info(
                 'Background Stars: Adding background star{} with magnitude {:.1f} at location ({}, {}).'.
                 format(hstid_back, fgs_mag_back, x, y))
-            add_data[y1:y2, x1:x2] += star_data
+
+    add_shifted_copies(add_data, template, dy, dx, scales)
 
     if save_file:
         # Set up out dir
@@ -160,3 +154,89 @@ def add_background_stars(image, stars, norm_value, norm_unit, guider,
                                  cols=all_cols, log=LOGGER)
 
     return add_data
+
+
+def _placement_shift(position, size=2048):
+    """Get the shift of the copy of the image that puts a background
+    star at ``position`` along one axis.
+
+    Copies are centered on the star's (truncated) position, with the
+    center of the image taken as pixel ``size // 2`` for stars past the
+    center and ``size // 2 - 1`` otherwise.
+    """
+    if position > size // 2:
+        return int(position) - size // 2
+    return min(int(position) - size // 2 + 1, 0)
+
+
+def _add_at_offset(data, patch, y, x):
+    """Add ``patch`` to ``data`` with its [0, 0] pixel at [y, x],
+    dropping the part that falls off ``data``"""
+    n_rows, n_cols = data.shape
+    y1, y2 = max(y, 0), min(y + patch.shape[0], n_rows)
+    x1, x2 = max(x, 0), min(x + patch.shape[1], n_cols)
+    if y1 < y2 and x1 < x2:
+        data[y1:y2, x1:x2] += patch[y1 - y:y2 - y, x1 - x:x2 - x]
+
+
+def add_shifted_copies(data, template, dy, dx, scales, method='auto'):
+    """Add scaled and shifted copies of a template to an image, in place:
+    ``data[r, c] += sum(scales[k] * template[r - dy[k], c - dx[k]])``.
+
+    When the copies are big and many, they are all added at once by
+    convolving the template with an image of delta functions at the
+    shifts (weighted by the scales) using FFTs, so the time and memory
+    don't grow with the number of copies. Otherwise it is faster to add
+    them one by one.
+
+    Parameters
+    ----------
+    data : 2-D numpy array
+        Image to add the copies to
+    template : 2-D numpy array
+        Image to copy
+    dy, dx : list of int
+        Row and column shift of each copy
+    scales : list of float
+        Scale factor of each copy
+    method : str, optional
+        "fft", "direct", or "auto" to choose from the number of pixels
+        to add (see ``FFT_COST_RATIO``)
+
+    Returns
+    -------
+    data : 2-D numpy array
+        The input image, with the copies added
+    """
+    if method not in ['fft', 'direct', 'auto']:
+        raise ValueError('Unknown method {}; use "fft", "direct", or "auto"'.format(method))
+    dy = np.asarray(dy, dtype=int)
+    dx = np.asarray(dx, dtype=int)
+    scales = np.asarray(scales, dtype=float)
+
+    # Only copy the part of the template with any flux
+    rows = np.flatnonzero(np.any(template != 0, axis=1))
+    cols = np.flatnonzero(np.any(template != 0, axis=0))
+    if len(scales) == 0 or len(rows) == 0:
+        return data
+    template = template[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    dy = dy + rows[0]
+    dx = dx + cols[0]
+    y0, x0 = dy.min(), dx.min()
+    deltas_shape = (dy.max() - y0 + 1, dx.max() - x0 + 1)
+
+    if method == 'auto':
+        fft_size = (template.shape[0] + deltas_shape[0]) * (template.shape[1] + deltas_shape[1])
+        # A NaN would spread over the whole FFT convolution
+        use_fft = len(scales) * template.size > FFT_COST_RATIO * fft_size and np.all(np.isfinite(template))
+        method = 'fft' if use_fft else 'direct'
+
+    if method == 'fft':
+        deltas = np.zeros(deltas_shape)
+        np.add.at(deltas, (dy - y0, dx - x0), scales)
+        _add_at_offset(data, signal.fftconvolve(template, deltas), y0, x0)
+    else:
+        for y, x, scale in zip(dy, dx, scales):
+            _add_at_offset(data, scale * template, y, x)
+
+    return data
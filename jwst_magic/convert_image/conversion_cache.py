@@ -0,0 +1,205 @@
+"""
+This module keeps an on-disk cache of the results of ``convert_im``, so
+that re-running MAGIC on the same input with the same conversion
+settings (e.g. to iterate on the star selection) skips the conversion.
+
+Each result is stored under a key made from the SHA-256 hash of the
+input file (and of any provided all found PSFs file), all of the
+conversion parameters, the MAGIC and SIAF versions, and the checksums
+of the bad pixel masks (which are replaced when the CRDS context
+changes). An entry holds
+the converted image, the header dictionary, and the contents of the all
+found PSFs and PSF center files. The least recently used entries are
+removed once the cache grows beyond ``MAX_CACHE_SIZE`` bytes.
+
+The cache is kept in ``jwst_magic/data/conversion_cache`` unless the
+``MAGIC_CONVERSION_CACHE`` environment variable gives another
+directory; its size limit can be set with the
+``MAGIC_CONVERSION_CACHE_SIZE`` environment variable (in bytes).
+
+Use
+---
+    This module can be imported in a Python shell as such:
+    ::
+        from jwst_magic.convert_image import conversion_cache
+        key = conversion_cache.make_key(input_im, parameters)
+        entry = conversion_cache.load(key)
+        conversion_cache.save(key, data, fgs_hdr_dict, all_found_psfs_path, psf_center_path)
+
+"""
+# Standard Library Imports
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+# Third Party Imports
+import numpy as np
+import pysiaf
+
+# Local Imports
+from jwst_magic import __version__
+from jwst_magic.utils import utils
+
+# Paths
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+PACKAGE_PATH = os.path.split(__location__)[0]
+CACHE_PATH = os.environ.get('MAGIC_CONVERSION_CACHE', os.path.join(PACKAGE_PATH, 'data', 'conversion_cache'))
+
+# Maximum total size of the cached results (bytes)
+MAX_CACHE_SIZE = int(os.environ.get('MAGIC_CONVERSION_CACHE_SIZE', 2 * 1024 ** 3))
+
+# Start logger
+LOGGER = logging.getLogger(__name__)
+
+
+def make_key(input_im, parameters):
+    """Make the cache key of a conversion.
+
+    Parameters
+    ----------
+    input_im : str
+        Path to the input image
+    parameters : dict
+        All of the other parameters that affect the conversion. Values
+        that are paths to files (``all_found_psfs_file``) are hashed by
+        content.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal SHA-256 digest identifying the conversion
+    """
+    parameters = dict(parameters)
+    if parameters.get('all_found_psfs_file') is not None:
+        parameters['all_found_psfs_file'] = utils.file_checksum(parameters['all_found_psfs_file'])
+
+    description = {'input': utils.file_checksum(input_im),
+                   'parameters': parameters,
+                   'magic_version': __version__,
+                   'prd_version': pysiaf.JWST_PRD_VERSION,
+                   'bad_pixel_masks': utils.bad_pixel_mask_checksums()}
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load(key):
+    """Get a cached conversion.
+
+    Parameters
+    ----------
+    key : str
+        Cache key (see ``make_key``)
+
+    Returns
+    -------
+    entry : dict or None
+        Dictionary with the converted image 'data', the
+        'fgs_hdr_dict', and the text of the 'all_found_psfs' and
+        'psf_center' files (None if they weren't written), or None if
+        the conversion is not cached
+    """
+    entry_dir = os.path.join(CACHE_PATH, key)
+    try:
+        with open(os.path.join(entry_dir, 'result.json')) as f:
+            entry = json.load(f)
+        entry['data'] = np.load(os.path.join(entry_dir, 'data.npy'))
+    except (OSError, ValueError):
+        return None
+
+    # JSON turns the (value, comment) header tuples into lists
+    entry['fgs_hdr_dict'] = {k: tuple(v) for k, v in entry['fgs_hdr_dict'].items()}
+
+    # Mark this entry as recently used
+    try:
+        os.utime(entry_dir)
+    except OSError:
+        pass
+
+    return entry
+
+
+def save(key, data, fgs_hdr_dict, all_found_psfs_path=None, psf_center_path=None):
+    """Save a conversion to the cache, and remove the least recently used
+    entries if the cache is too big.
+
+    Parameters
+    ----------
+    key : str
+        Cache key (see ``make_key``)
+    data : 2-D numpy array
+        Converted image
+    fgs_hdr_dict : dict
+        Header information of the converted image
+    all_found_psfs_path : str, optional
+        Path to the all found PSFs file written by the conversion
+    psf_center_path : str, optional
+        Path to the PSF center file written by the conversion
+    """
+    def read(path):
+        if path is None:
+            return None
+        with open(path) as f:
+            return f.read()
+
+    entry = {'fgs_hdr_dict': fgs_hdr_dict,
+             'all_found_psfs': read(all_found_psfs_path),
+             'psf_center': read(psf_center_path),
+             'time': time.time()}
+
+    entry_dir = os.path.join(CACHE_PATH, key)
+    temp_dir = None
+    try:
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        # Write to a temporary directory first so a partial entry is never read
+        temp_dir = tempfile.mkdtemp(dir=CACHE_PATH, prefix='.tmp_')
+        np.save(os.path.join(temp_dir, 'data.npy'), np.asarray(data))
+        with open(os.path.join(temp_dir, 'result.json'), 'w') as f:
+            json.dump(entry, f, default=str)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(temp_dir, entry_dir)
+        temp_dir = None
+    except OSError as e:
+        # A read-only installation just doesn't cache conversions
+        LOGGER.warning('Image Conversion: Cannot save converted image to cache: {}'.format(e))
+        return
+    finally:
+        # evict() skips temporary directories, so don't leave a partial one behind
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    evict()
+
+
+def evict(max_size=None):
+    """Remove the least recently used entries until the cache is no
+    bigger than ``max_size`` bytes.
+
+    Parameters
+    ----------
+    max_size : int, optional
+        Maximum total size of the cache (bytes); defaults to
+        ``MAX_CACHE_SIZE``
+    """
+    max_size = MAX_CACHE_SIZE if max_size is None else max_size
+    entries = []
+    for name in os.listdir(CACHE_PATH) if os.path.isdir(CACHE_PATH) else []:
+        entry_dir = os.path.join(CACHE_PATH, name)
+        if name.startswith('.') or not os.path.isdir(entry_dir):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+        entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_dir in sorted(entries):
+        if total_size <= max_size:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+
+
+def clear():
+    """Remove all cached conversions"""
+    shutil.rmtree(CACHE_PATH, ignore_errors=True)
@@ -66,7 +66,6 @@ Notes
 # Standard Library Imports
 import copy
 import datetime
-import itertools
 import logging
 import os
 import yaml
@@ -74,21 +73,16 @@ import yaml
 # Third Party Imports
 from astropy.io import ascii as asc
 from astropy.io import fits
-from astropy.nddata import Cutout2D
-from astropy.stats import sigma_clip
-from jwst.resample import ResampleStep
-from jwst.datamodels import ImageModel
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 import numpy as np
 import pysiaf
 from scipy import signal
 from scipy import ndimage
-from scipy.ndimage import gaussian_filter
 from scipy.signal import medfilt2d
 
 # Local Imports
-from jwst_magic.convert_image import renormalize
+from jwst_magic.convert_image import conversion_cache, renormalize, undistortion
 from jwst_magic.utils import utils, coordinate_transforms
 
 # Paths
@@ -136,7 +130,7 @@ def apply_coarse_pointing_filter(data, jitter_rate_arcsec, pixel_scale):
     jitter_rate = jitter_rate_arcsec / pixel_scale  # pixel/sec
     sigma = jitter_rate * t_fullframe_read / 3  # pixel
 
-    data_gauss = gaussian_filter(data, sigma)
+    data_gauss = utils.smooth_image(data, sigma)
 
     return data_gauss
 
@@ -173,33 +167,63 @@ def bad_pixel_correction(data, nircam, detector, dq_array=None):
         with fits.open(bad_pixel_mask_file) as bad_pix_hdu:
             bad_pix_data = bad_pix_hdu[0].data
 
-    # Now, use data
-    m, n = data.shape
+    return median_of_good_neighbors(data, bad_pix_data)
+
+
+def median_of_good_neighbors(data, bad_pix_data):
+    """Replace every flagged pixel with the median of the un-flagged
+    pixels in its 3x3 neighborhood, for all flagged pixels at once.
+
+    Neighbors that fall off the edge of the array or are themselves
+    flagged are ignored. If none of a pixel's neighbors can be used,
+    that pixel is set to 0.
+
+    Parameters
+    ----------
+    data : 2-D numpy array
+        Image data
+    bad_pix_data : 2-D numpy array
+        Bad pixel mask with the same shape as ``data``, where pixels
+        equal to 1 are bad
+
+    Returns
+    -------
+    new_data : 2-D numpy array
+        Copy of the image data with the flagged pixels replaced
+    """
     new_data = copy.deepcopy(data)
-    for i, j in itertools.product(range(m), range(n)):
-        # If the bad pixel is flagged, need to replace it
-        if bad_pix_data[i, j] == 1:
-            # For each surrounding pixel
-            vals = []
-            for k, h in itertools.product([i + 1, i, i - 1], [j + 1, j, j - 1]):
-                # Does the surrounding pixel exist on the array - if not, ignore it
-                if k < 0 or k >= m:
-                    pass
-                elif h < 0 or h >= n:
-                    pass
-                # Is the surrounding pixel also bad - ignore it
-                elif bad_pix_data[k, h] == 1:
-                    pass
-                # If it passes those tests, include it
-                else:
-                    vals.append(new_data[k, h])
-
-            if len(vals) == 0:
-                # If pix is surrounded by all bad pixels, set it's value to 0
-                new_data[i, j] = 0
-            else:
-                # Take the median value
-                new_data[i, j] = np.median(vals)
+    bad = np.asarray(bad_pix_data) == 1
+    rows, cols = np.nonzero(bad)
+    if len(rows) == 0:
+        return new_data
+
+    # Pad by one pixel so that every flagged pixel has a full 3x3
+    # neighborhood; the padding is treated as bad so it is never used
+    padded_data = np.pad(np.asarray(data, dtype=np.float64), 1, mode='constant')
+    padded_bad = np.pad(bad, 1, mode='constant', constant_values=True)
+
+    # Gather the (n_flagged, 9) neighborhood of each flagged pixel
+    dy, dx = np.meshgrid([-1, 0, 1], [-1, 0, 1], indexing='ij')
+    neighbor_rows = rows[:, np.newaxis] + 1 + dy.ravel()
+    neighbor_cols = cols[:, np.newaxis] + 1 + dx.ravel()
+    values = padded_data[neighbor_rows, neighbor_cols]
+    good = ~padded_bad[neighbor_rows, neighbor_cols]
+
+    # Sort the good values to the front of each row, then take the
+    # median of the first n_good entries
+    n_good = good.sum(axis=1)
+    has_nan = np.any(np.isnan(values) & good, axis=1)
+    values[~good] = np.inf
+    values.sort(axis=1)
+    lower = values[np.arange(len(rows)), np.maximum(n_good - 1, 0) // 2]
+    upper = values[np.arange(len(rows)), np.maximum(n_good, 1) // 2]
+    medians = (lower + upper) / 2
+
+    medians[has_nan] = np.nan  # A NaN among the good neighbors makes the median NaN
+    # If pix is surrounded by all bad pixels, set its value to 0
+    medians[n_good == 0] = 0
+
+    new_data[rows, cols] = medians
 
     return new_data
 
@@ -303,7 +327,7 @@ def pad_data(data, padding, fgs_pix):
     padded_data[padding:padding + size, padding:padding + size] = data
 
     # Correct any negative pixels
-    padded_data = utils.correct_image(padded_data)
+    padded_data = utils.correct_image(padded_data, inplace=True)
 
     return padded_data
 
@@ -577,6 +601,105 @@ def count_psfs(smoothed_data, gauss_sigma, npeaks=np.inf, detection_threshold='s
     return num_psfs, coords, threshold
 
 
+def resample_image(image, data):
+    """Remove the distortion from a cal image with the JWST pipeline's
+    Resample step.
+
+    Parameters
+    ----------
+    image : InputImage
+        The input image, whose SCI data will be replaced by ``data``
+    data : 2-D numpy array
+        Image data to resample
+
+    Returns
+    -------
+    data : 2-D numpy array
+        Undistorted image data, cropped to the shape of the input
+    """
+    # Importing the pipeline is slow, so only do it if needed
+    from jwst.datamodels import ImageModel
+    from jwst.resample import ResampleStep
+
+    LOGGER.info("Image Conversion: Removing distortion from data using the JWST Pipeline's Resample step.")
+    # Update HDUList object and read it into the image model
+    image.hdulist['SCI'].data = data
+    with ImageModel(image.hdulist, skip_fits_update=False) as model:
+        result = ResampleStep.call(model, save_results=False)
+
+    # Crop data back to (2048, 2048), cutting out the top and right to keep the origin
+    n_rows, n_cols = np.shape(data)
+    LOGGER.info(f"Image Conversion: Cutting undistorted data from {result.data.shape} to ({n_rows}, {n_cols})")
+    return result.data[0:n_rows, 0:n_cols]
+
+
+class InputImage:
+    """Read the parts of an input image that ``convert_im`` needs while
+    opening the file only once.
+
+    ``convert_im`` used to open the input file separately for the data,
+    the primary and SCI headers, the DQ array, and the resample step,
+    which costs a round trip each on remote file systems. This keeps a
+    single (memory-mapped) HDU list open instead; each extension is only
+    read when its property is first used. Use it as a context manager
+    (or call ``close``) to release the file.
+    """
+    def __init__(self, filename):
+        """Open the image.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the FITS file
+        """
+        self.filename = filename
+        # Memory-mapped where possible (not for scaled data, e.g. unsigned integers)
+        self.hdulist = fits.open(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the file (arrays that have already been read remain valid)"""
+        self.hdulist.close()
+
+    @property
+    def data(self):
+        """Data of the primary HDU, or of the first extension if the
+        primary has none (as with ``fits.getdata``)"""
+        data = self.hdulist[0].data
+        if data is None and len(self.hdulist) > 1:
+            data = self.hdulist[1].data
+        if data is None:
+            raise IndexError('No data in this HDU.')
+        return data
+
+    @property
+    def header(self):
+        """Primary header"""
+        return self.hdulist[0].header
+
+    @property
+    def sci_header(self):
+        """Header of the SCI extension, or an empty dictionary if there
+        is no SCI extension"""
+        try:
+            return self.hdulist['SCI'].header
+        except KeyError:
+            return {}
+
+    @property
+    def dq(self):
+        """Data of the DQ extension, or None if there is no DQ extension"""
+        try:
+            return self.hdulist['DQ'].data
+        except KeyError:
+            return None
+
+
 def create_all_found_psfs_file(data, guider, root, out_dir, smoothing='default',
                                detection_threshold='standard-deviation', save=True, num_peaks=None):
     """Take input column information and save out the all_found_psfs_file
@@ -634,9 +757,9 @@ def create_all_found_psfs_file(data, guider, root, out_dir, smoothing='default',
         num_peaks = npeaks
 
     data = data.astype(float)
-    smoothed_data = ndimage.gaussian_filter(data, sigma=gauss_sigma)
 
-    # Use photutils.find_peaks to locate all PSFs in image
+    # Use photutils.find_peaks to locate all PSFs in the smoothed image
+    smoothed_data = utils.smooth_image(data, gauss_sigma)
     num_psfs, coords, threshold = count_psfs(smoothed_data, gauss_sigma, npeaks=num_peaks,
                                              detection_threshold=detection_threshold, choose=False)
     x_list, y_list = map(list, zip(*coords))
@@ -713,9 +836,101 @@ def save_psf_center_file(center_cols, guider, root, out_dir):
     return psf_center_path
 
 
+def make_stamp_mask(shape, x, y, psf_size):
+    """Make a mask of the square postage stamps around a list of PSFs.
+
+    The stamps are placed like ``astropy.nddata.Cutout2D(data, (x, y),
+    psf_size)`` cutouts (trimmed at the edges of the image).
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the image (rows, columns)
+    x : list
+        List of x-coordinates of the PSFs
+    y : list
+        List of y-coordinates of the PSFs
+    psf_size : int
+        Edge length of the square stamps (pixels)
+
+    Returns
+    -------
+    mask : 2-D numpy array
+        Boolean array that is True within any stamp
+    """
+    n_rows, n_cols = shape
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    x_min = np.clip(np.ceil(x - psf_size / 2.).astype(int), 0, n_cols)
+    x_max = np.clip(np.ceil(x + psf_size / 2.).astype(int), 0, n_cols)
+    y_min = np.clip(np.ceil(y - psf_size / 2.).astype(int), 0, n_rows)
+    y_max = np.clip(np.ceil(y + psf_size / 2.).astype(int), 0, n_rows)
+
+    mask = np.zeros(shape, dtype=bool)
+    for stamp_y_min, stamp_y_max, stamp_x_min, stamp_x_max in zip(y_min, y_max, x_min, x_max):
+        mask[stamp_y_min:stamp_y_max, stamp_x_min:stamp_x_max] = True
+
+    return mask
+
+
+def estimate_background(data, mask=None, sigma=3, maxiters=10, max_pixels=None, rng=None):
+    """Estimate the background of an image as the median of the unmasked
+    pixels, after iteratively clipping those more than ``sigma`` standard
+    deviations from their mean.
+
+    This is the same as ``np.nanmedian(sigma_clip(data, sigma=sigma,
+    cenfunc='mean', maxiters=maxiters))`` with the masked pixels set to
+    NaN, but only the unmasked pixels are copied and clipped.
+
+    Parameters
+    ----------
+    data : 2-D numpy array
+        Image data
+    mask : 2-D numpy array, optional
+        Boolean array that is True for pixels to exclude (e.g. stamps
+        around PSFs; see ``make_stamp_mask``)
+    sigma : float, optional
+        Number of standard deviations at which to clip
+    maxiters : int, optional
+        Maximum number of clipping iterations
+    max_pixels : int, optional
+        If set and there are more unmasked pixels than this, estimate
+        the background from a random subsample of about this many pixels
+    rng : int or numpy.random.Generator, optional
+        Seed or generator for the subsample (see ``utils.get_rng``)
+
+    Returns
+    -------
+    background : float
+        Median of the clipped background pixels
+    """
+    good = np.isfinite(data)
+    if mask is not None:
+        good &= ~mask
+    values = data[good]
+
+    if max_pixels is not None and values.size > max_pixels:
+        keep = utils.get_rng(rng).random(values.size) < max_pixels / values.size
+        values = values[keep]
+
+    for _ in range(maxiters):
+        if values.size == 0:
+            return np.nan
+        # One pass for the deviations serves both the std and the clipping
+        deviation = values - np.mean(values)
+        std = np.sqrt(np.dot(deviation, deviation) / values.size)
+        keep = np.abs(deviation, out=deviation) <= sigma * std
+        if np.all(keep):
+            break
+        values = values[keep]
+
+    return np.median(values, overwrite_input=True) if values.size > 0 else np.nan
+
+
 def create_seed_image(data, guider, root, out_dir, smoothing='default',
                       detection_threshold='standard-deviation', psf_size=None, all_found_psfs_file=None,
-                      num_peaks=None):
+                      num_peaks=None, background_max_pixels=None):
     """Create a seed image leaving only the foreground star by removing
     the background and any background stars, and setting the background
     to zero.
@@ -751,6 +966,10 @@ def create_seed_image(data, guider, root, out_dir, smoothing='default',
         MAGIC-made all found PSFs file.
     num_peaks: int
         Number of peaks to find, will overwrite defaults based on smoothing
+    background_max_pixels : int, optional
+        Estimate the background from a random subsample of about this
+        many pixels (see ``estimate_background``); by default all
+        background pixels are used
 
     Returns
     -------
@@ -776,37 +995,17 @@ def create_seed_image(data, guider, root, out_dir, smoothing='default',
         in_table = asc.read(all_found_psfs_file)
         x_list, y_list = in_table['x'], in_table['y']
 
-    # Cut out square postage stamps around the segments
-    postage_stamps = []
-    for x, y in zip(x_list, y_list):
-        position = (x, y)  # x,y
-        size = (psf_size, psf_size)  # y,x pixels
-        cutout = Cutout2D(data, position, size)
-        postage_stamps.append(cutout)
-
-    # Find the median of the background (without the postage stamps) and subtract it from the postage stamps
-    old_bkgrd = data.copy()
-    for stamp in postage_stamps:
-        old_bkgrd[stamp.slices_original[0], stamp.slices_original[1]] = np.full_like(stamp.data, np.nan)
-
-    # Do 2x sigma clipping with sigma = 3 (returning an array where clipped data are nans)
-    import warnings
-    from astropy.utils.exceptions import AstropyUserWarning
-    with warnings.catch_warnings():
-        warnings.filterwarnings("ignore", category=AstropyUserWarning)
-        old_bkgrd = sigma_clip(old_bkgrd, sigma=3, cenfunc='mean', masked=False, copy=False, axis=[0, 1])
-        old_bkgrd = sigma_clip(old_bkgrd, sigma=3, cenfunc='mean', masked=False, copy=False, axis=[0, 1])
-    med = np.nanmedian(old_bkgrd)
-
-    final_stamps = []
-    for cutout in postage_stamps:
-        cutout.data = cutout.data - med
-        final_stamps.append(cutout)
-
-    # Set the entire background plus any background stars to 0 (May change later with thermal info)
+    # Mask square postage stamps around the segments
+    stamp_mask = make_stamp_mask(data.shape, x_list, y_list, psf_size)
+
+    # Find the median of the background (without the postage stamps), after
+    # 2x sigma clipping with sigma = 3 (up to 5 iterations each)
+    med = estimate_background(data, stamp_mask, sigma=3, maxiters=10, max_pixels=background_max_pixels)
+
+    # Subtract it from the postage stamps, and set the entire background plus
+    # any background stars to 0 (May change later with thermal info)
     seed_image = np.zeros_like(data)
-    for stamp in final_stamps:
-        seed_image[stamp.slices_original[0], stamp.slices_original[1]] = stamp.data
+    seed_image[stamp_mask] = data[stamp_mask] - med
 
     return seed_image
 
@@ -816,13 +1015,364 @@ def create_seed_image(data, guider, root, out_dir, smoothing='default',
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
+def preprocess_image(image, nircam=True, nircam_det=None, itm=False, undistort_method='pipeline'):
+    """Run the guider-independent conversion steps on an input image:
+    bad pixel correction, distortion removal, unit conversion, and
+    pedestal removal.
+
+    Parameters
+    ----------
+    image : InputImage
+        The opened input image
+    nircam : bool, optional
+        Denotes if the input image is a NIRCam (True) or FGS image
+    nircam_det : str, optional
+        The detector of a provided NIRCam image. If None, the detector
+        is taken from the image header.
+    itm : bool, optional
+        If this image come from the ITM simulator
+    undistort_method : str, optional
+        How to remove the distortion from cal images (see
+        ``convert_im``)
+
+    Returns
+    -------
+    data : 2-D numpy array
+        Preprocessed image data, in ADU/s, still in the input frame
+    itm : bool
+        Whether the image comes from the ITM simulator (set to True if
+        the header says so)
+    distortion : bool
+        Whether the image data is still distorted
+
+    Raises
+    ------
+    TypeError
+        The input image has more than one frame.
+    ValueError
+        An input NIRCam file has an obstruction in the pupil.
+    """
+    data = image.data
+    header = image.header
+
+    if len(data.shape) > 2:
+        raise TypeError('Expecting a single frame or slope image.')
+
+    # Check if this is an ITM image and the itm flag is set correctly (backwards compatibility)
+    try:
+        origin = header['ORIGIN'].strip()
+        if origin == 'ITM':
+            try:
+                assert itm is True
+            except AssertionError:
+                itm = True
+                LOGGER.warning("Deprecation Warning: This is an ITM image, setting itm flag to 'True'")
+    except KeyError:
+        pass
+
+    # Try to check that the units on the input image are as expected (Dn/s = ADU/s; *_rate.fits)
+    header_sci = image.sci_header
+
+    for hdr in [header, header_sci]:
+        if 'BUNIT' in hdr:
+            input_unit = hdr['BUNIT'].lower()
+        if 'PHOTMJSR' in hdr:
+            photmjsr = hdr['PHOTMJSR']
+        if 'DATAMODL' in hdr:
+            datamodel = hdr['DATAMODL']
+
+        if 'DETECTOR' in hdr:
+            detector = hdr['DETECTOR']  # e.g. 'NRCA3'
+        elif nircam and isinstance(nircam_det, str):
+            detector = 'NRC'+nircam_det
+
+    # Remove bad pixels from input images if possible. If not, we'll use the bad pixel masks
+        # NIRCam -> use dq array is available, use CRDS file 2nd
+        # FGS Full Frame -> use dq array is available (but no saturated flags), use DHAS mask 2nd
+        # Padded TRK image -> have to use DHAS file (no dq array; TRK box is confirmed to be in the right spot)
+    dq_array = image.dq
+    if dq_array is not None:
+        dq_array, _ = utils.convert_bad_pixel_mask_data(dq_array, nircam=nircam)
+
+    try:
+        if dq_array is None:
+            detector  # check if variable exists, needed to pull mask file
+        try:
+            data = bad_pixel_correction(data, nircam, detector, dq_array)
+            LOGGER.info(f"Image Conversion: Bad pixels removed from image using "
+                        f"{'DQ array from image' if dq_array is not None else 'Bad Pixel Mask'}.")
+        except FileNotFoundError:
+            LOGGER.error('Image Conversion: Cannot find DQ file in repository. **No DQ data added.**')
+
+    except NameError:
+        LOGGER.warning("Image Conversion: Data not run through bad pixel removal step. Unable to pull "
+                       "necessary detector information from input image.")
+
+    # Remove distortion from NIRCam or FGS cal data, but not from padded TRK data nor rate images
+    # as they cannot be run through the pipeline without lots of extra steps
+    distortion = True  # is there distortion in the image
+    try:
+        if datamodel != 'GuiderCalModel' and input_unit == 'mjy/sr':
+            if undistort_method == 'siaf':
+                LOGGER.info("Image Conversion: Removing distortion from data using the SIAF polynomials.")
+                data = undistortion.undistort_image(data, detector)
+            else:
+                siaf_data = None
+                if undistort_method == 'compare':
+                    siaf_data = undistortion.undistort_image(data, detector)
+                data = resample_image(image, data)
+                if siaf_data is not None:
+                    report = undistortion.tolerance_report(data, siaf_data)
+                    LOGGER.info("Image Conversion: SIAF undistortion compared to the Resample step: "
+                                "{}".format(report))
+            distortion = False
+    except NameError:
+        LOGGER.info("Image Conversion: Skipping removing distortion from image due to missing either "
+                    "DATAMODL, BUNIT, or DETECTOR information.")
+
+    # Turn cal images into rate images
+    try:
+        if input_unit == 'mjy/sr':
+            convert_to_adu_s = photmjsr
+            data /= convert_to_adu_s
+            LOGGER.info('Image Conversion: Input is a Cal image. Converting from MJy/sr to ADU/s')
+        elif input_unit == 'dn/s':
+            LOGGER.info('Image Conversion: Image in correct units of ADU/s.')
+    except NameError:
+        LOGGER.info("Image Conversion: Can't check image type because of missing "
+                    "BUNIT keyword. User should confirm the input image is a rate image.")
+        pass
+
+    # Remove pedestal from NIRCam or FGS data
+    # pedestal should be taken out in refpix correction - only run if that hasn't been run
+    # and if not labeled as test data which is made without a pedestal
+    if 'S_REFPIX' in header.keys() and header['S_REFPIX'] == 'COMPLETE':
+        LOGGER.info("Image Conversion: Skipping removing pedestal - Reference pixel correction run in pipeline.")
+    elif 'TEST' in header.keys() and header['TEST'] == 'True':
+        LOGGER.info("Image Conversion: Skipping removing pedestal - Test flag found in image header.")
+    else:
+        data = remove_pedestal(data, nircam, itm)
+
+    # Check that the NIRCam pupil is clear
+    if nircam:
+        try:
+            pupil_keyword = header['PUPIL']
+            if pupil_keyword in ['CLEAR', 'Imaging Pupil']:
+                pass
+            else:
+                raise ValueError(
+                    'NIRCam "PUPIL" header keyword for provided file is {}. '.format(pupil_keyword) +
+                    'Only the CLEAR/Imaging Pupil can be used to realistically simulate FGS images.'
+                )
+        except KeyError:
+            pass
+
+    return data, itm, distortion
+
+
+def convert_preprocessed_image(data, header, input_im, guider, root, out_dir, nircam=True,
+                               nircam_det=None, normalize=True, norm_value=12.0,
+                               norm_unit="FGS Magnitude", smoothing='default',
+                               detection_threshold='standard-deviation',
+                               psf_size=None, all_found_psfs_file=None, gs_catalog=None,
+                               coarse_pointing=False, jitter_rate_arcsec=None, itm=False,
+                               num_peaks=None, distortion=True):
+    """Run the guider-dependent conversion steps on a preprocessed image
+    (see ``preprocess_image``): rotation to the raw frame of the guider,
+    re-binning to the FGS plate scale, normalization, and writing the
+    all found PSFs file.
+
+    Parameters
+    ----------
+    data : 2-D numpy array
+        Preprocessed image data; it may be modified in place
+    header : astropy.io.fits.Header
+        Primary header of the input image
+    input_im : str
+        Filepath for the input (NIRCam or FGS) image
+    guider : int
+        Guider number (1 or 2)
+    root : str
+        Name used in the output filenames
+    out_dir : str
+        Directory where the output files will be saved
+    distortion : bool, optional
+        Whether the image data is still distorted
+
+    The other parameters are as in ``convert_im``.
+
+    Returns
+    -------
+    data : 2-D numpy array
+        Image formatted like a raw FGS image
+    all_found_psfs_path : str
+        Path to the all found PSFs file (None if no PSFs were found)
+    psf_center_path : str
+        Path to the PSF center file (None if not made)
+    fgs_hdr_dict : dict
+        Header information to add to the FGS image
+    """
+    # Set up hdr_dict to add header information to
+    fgs_hdr_dict = {}
+
+    try:
+        origin = header['ORIGIN'].strip()
+    except KeyError:
+        origin = None
+
+    # Create raw FGS image...
+
+    # -------------- From NIRCam --------------
+    if nircam:
+        LOGGER.info("Image Conversion: This is a NIRCam image")
+
+        # Rotate the NIRCAM image into FGS frame
+        nircam_scale, data = transform_nircam_image(data, guider, nircam_det, header)
+        # Pad image
+        data = resize_nircam_image(data, nircam_scale, FGS_PIXELS, guider)
+
+    # -------------- From FGS --------------
+    else:
+        LOGGER.info("Image Conversion: This is an FGS image")
+        # Check if header keyword is equal to fgs raw to determine if rotation to raw is needed
+        if origin is not None and origin.upper() == 'FGSRAW':  # this is a magic-team keyword that should only be in test files
+            LOGGER.info("Image Conversion: Data is already provided in raw frame; no rotation done")
+            LOGGER.warning("Assume input guider is same as output guider; no rotation done")
+        else:
+            LOGGER.info(
+                "Image Conversion: Expect that data provided is in science/DMS frame; rotating to raw FGS frame.")
+            data = coordinate_transforms.transform_sci_to_fgs_raw(data, guider)
+
+    # Apply Gaussian filter to simulate coarse pointing
+    if coarse_pointing:
+        pixel_scale = nircam_scale if nircam else globals()['FGS{}_SCALE'.format(guider)]
+
+        data = apply_coarse_pointing_filter(data, jitter_rate_arcsec, pixel_scale)
+        LOGGER.info("Image Conversion: Applied Gaussian filter to simulate "
+                    "coarse pointing with jitter of {:.3f} arcsec/sec".format(jitter_rate_arcsec))
+
+    # Normalize the image, if the "normalize" flag is True
+    # The ITM simulations are only created for relative SNR so they need to
+    # normalized to one before anything else happens
+    if itm:
+        LOGGER.info("Image Conversion: This is an ITM image.")
+        data -= data.min()  # set minimum at 0.
+        data /= data.sum()  # set total countrate to 1.
+        if not norm_value:
+            norm_value = 12
+            norm_unit = 'FGS Magnitude'
+            LOGGER.warning("Image Conversion: No normalization was specified but is required for an ITM image. "
+                           "Using FGS Magnitude of 12.")
+
+    if normalize or itm:
+        # Remove the background and background stars and output a seed image with just the foreground stars
+        data = create_seed_image(data, guider, root, out_dir, smoothing,
+                                 detection_threshold, psf_size, all_found_psfs_file, num_peaks=num_peaks)
+
+        # Convert magnitude/countrate to FGS countrate using new count rate module
+        # Take norm_value and norm_unit to pass to count rate module
+        fgs_countrate, fgs_mag = renormalize.convert_to_countrate_fgsmag(norm_value, norm_unit, guider, gs_catalog)
+
+        # Normalize the data
+        data = utils.correct_image(data) # Correct any negative or inf values before normalizing
+        data = normalize_data(data, fgs_countrate)
+        LOGGER.info("Image Conversion: Normalizing to {} FGS Countrate (FGS Mag: {})".format(fgs_countrate,
+                                                                                             fgs_mag))
+
+    try:
+        if all_found_psfs_file is None:
+            # Save out all found PSFs file once the data has been normalized
+            x_list, y_list, cr_list, all_found_psfs_path = create_all_found_psfs_file(data, guider, root, out_dir,
+                                                                                      smoothing,
+                                                                                      detection_threshold,
+                                                                                      save=True, num_peaks=num_peaks)
+        else:
+            # Write the same file out in the correct directory with the correct name
+            table = asc.read(all_found_psfs_file)
+            colnames = table.colnames
+            all_cols = [[str(i) for i in table[name].tolist()] for name in colnames]
+            all_cols = list(map(list, zip(*all_cols)))
+            all_found_psfs_path = save_all_found_psfs_file(all_cols, guider, root, out_dir)
+
+        # Save out psf center file for no smoothing case
+        if smoothing == 'low':
+            LOGGER.info(
+                "Image Conversion: No smoothing chosen for MIMF case, so calculating PSF center")
+
+            x_center, y_center, cr_center, _ = create_all_found_psfs_file(data, guider, root, out_dir,
+                                                                          smoothing='choose center',
+                                                                          detection_threshold=detection_threshold,
+                                                                          save=False, num_peaks=num_peaks)
+            psf_center_path = save_psf_center_file([[y_center[0], x_center[0], cr_center[0]]], guider, root, out_dir)
+
+            LOGGER.info("Image Conversion: PSF center y,x,cr = {}, {}, {} vs Guiding knot y,x,cr = {}, {}, {}".format(
+                y_center[0], x_center[0], cr_center[0], y_list[0], x_list[0], cr_list[0]))
+        else:
+            psf_center_path = None
+    except TypeError as e:
+        if str(e) == "object of type 'NoneType' has no len()":
+            LOGGER.warning('Image Conversion: No PSFs were found in this image. '
+                           'Cannot write out an all found PSFs file.')
+            all_found_psfs_path = None
+            psf_center_path = None
+        else:
+            raise TypeError(str(e))
+
+    # Update header information
+    fgs_hdr_dict['IN_FILE'] = (os.path.basename(input_im), 'Input image')
+    fgs_hdr_dict['IN_INSTR'] = ('NIRCAM' if nircam else 'FGS', 'Input instrument')
+    fgs_hdr_dict['IN_DET'] = (nircam_det if nircam else f'FGS', 'Input detector')
+    fgs_hdr_dict['OUT_DET'] = (f'GUIDER{guider}', 'Output guider')
+    fgs_hdr_dict['DISTORT'] = (distortion, 'Is the image distorted')
+    fgs_hdr_dict['SMOOTHIN'] = (smoothing, 'Smoothing used')
+    if normalize:
+        fgs_hdr_dict['NORMUNIT'] = (norm_unit, 'Normalization unit')
+        fgs_hdr_dict['NORMVALU'] = (norm_value, 'Normalization value')
+        if norm_unit.lower() == 'guide star id':
+            ra, dec = renormalize.query_guide_star_catalog(gs_id=norm_value)
+            fgs_hdr_dict['GS_RA'] = (ra, 'RA of guide star')
+            fgs_hdr_dict['GS_DEC'] = (dec, 'DEC of guide star')
+
+    return data, all_found_psfs_path, psf_center_path, fgs_hdr_dict
+
+
+def _conversion_cache_key(input_im, guider, **parameters):
+    """Make the ``conversion_cache`` key of converting ``input_im`` for
+    ``guider`` with the other ``convert_im`` parameters"""
+    return conversion_cache.make_key(input_im, dict(filename=os.path.basename(input_im), guider=guider,
+                                                    **parameters))
+
+
+def _load_cached_conversion(cache_key, input_im, guider, root, out_dir):
+    """Get a cached conversion and write its all found PSFs and PSF
+    center files to ``out_dir``; returns None if it isn't cached"""
+    cached = conversion_cache.load(cache_key)
+    if cached is None:
+        return None
+
+    LOGGER.info("Image Conversion: Using the cached guider {} conversion of {} (key {})".format(
+        guider, input_im, cache_key))
+    all_found_psfs_path = None
+    psf_center_path = None
+    if cached['all_found_psfs'] is not None:
+        all_found_psfs_path = os.path.join(out_dir, 'unshifted_all_found_psfs_{}_G{}.txt'.format(root, guider))
+        with open(all_found_psfs_path, 'w') as f:
+            f.write(cached['all_found_psfs'])
+    if cached['psf_center'] is not None:
+        psf_center_path = os.path.join(out_dir, 'unshifted_psf_center_{}_G{}.txt'.format(root, guider))
+        with open(psf_center_path, 'w') as f:
+            f.write(cached['psf_center'])
+    return cached['data'], all_found_psfs_path, psf_center_path, cached['fgs_hdr_dict']
+
+
 def convert_im(input_im, guider, root, out_dir=None, nircam=True,
                nircam_det=None, normalize=True, norm_value=12.0,
                norm_unit="FGS Magnitude", smoothing='default',
                detection_threshold='standard-deviation',
                psf_size=None, all_found_psfs_file=None, gs_catalog=None,
                coarse_pointing=False, jitter_rate_arcsec=None,
-               logger_passed=False, itm=False, num_peaks=None):
+               logger_passed=False, itm=False, num_peaks=None,
+               undistort_method='pipeline', use_cache=True):
     """Takes NIRCam or FGS image and converts it into an FGS-like image.
 
     Parameters
@@ -892,6 +1442,17 @@ def convert_im(input_im, guider, root, out_dir=None, nircam=True,
         If this image come from the ITM simulator (important for normalization).
     num_peaks: int
         Number of peaks to find, will overwrite defaults based on smoothing
+    undistort_method : str, optional
+        How to remove the distortion from cal images: "pipeline" to
+        use the JWST pipeline's Resample step, "siaf" to resample
+        directly with the SIAF polynomials (much faster; see
+        ``undistortion.undistort_image``), or "compare" to use the
+        Resample step and log how the SIAF result differs from it
+    use_cache : bool, optional
+        Re-use the result of a previous conversion of the same input
+        file with the same parameters, if there is one, and cache the
+        result of this conversion (see ``conversion_cache``). Set to
+        False to always convert the image.
 
     Returns
     -------
@@ -913,249 +1474,228 @@ def convert_im(input_im, guider, root, out_dir=None, nircam=True,
     if not logger_passed:
         utils.create_logger_from_yaml(__name__, out_dir_root=out_dir, root=root, level='DEBUG')
 
-    # Set up hdr_dict to add header information to
-    fgs_hdr_dict = {}
-
+    if undistort_method not in ['pipeline', 'siaf', 'compare']:
+        raise ValueError('Unknown undistortion method {}; use "pipeline", "siaf", or "compare"'.format(
+            undistort_method))
+
+    # Skip the conversion if this image has already been converted the same way
+    if use_cache:
+        cache_key = _conversion_cache_key(
+            input_im, guider, nircam=nircam, nircam_det=nircam_det, normalize=normalize, norm_value=norm_value,
+            norm_unit=norm_unit, smoothing=smoothing, detection_threshold=detection_threshold, psf_size=psf_size,
+            all_found_psfs_file=all_found_psfs_file, gs_catalog=gs_catalog, coarse_pointing=coarse_pointing,
+            jitter_rate_arcsec=jitter_rate_arcsec, itm=itm, num_peaks=num_peaks, undistort_method=undistort_method)
+        cached = _load_cached_conversion(cache_key, input_im, guider, root, out_dir)
+        if cached is not None:
+            return cached
+
+    image = None
     try:
         LOGGER.info("Image Conversion: " +
                     "Beginning image conversion to guider {} FGS image".format(guider))
         LOGGER.info("Image Conversion: Input image is expected to be in units of ADU/sec (countrate)")
 
-        data = fits.getdata(input_im, header=False)
-        header = fits.getheader(input_im, ext=0)
+        # Open the input file once and read everything from it
+        image = InputImage(input_im)
+        data, itm, distortion = preprocess_image(image, nircam, nircam_det, itm, undistort_method)
 
-        if len(data.shape) > 2:
-            raise TypeError('Expecting a single frame or slope image.')
+        data, all_found_psfs_path, psf_center_path, fgs_hdr_dict = convert_preprocessed_image(
+            data, image.header, input_im, guider, root, out_dir, nircam=nircam, nircam_det=nircam_det,
+            normalize=normalize, norm_value=norm_value, norm_unit=norm_unit, smoothing=smoothing,
+            detection_threshold=detection_threshold, psf_size=psf_size, all_found_psfs_file=all_found_psfs_file,
+            gs_catalog=gs_catalog, coarse_pointing=coarse_pointing, jitter_rate_arcsec=jitter_rate_arcsec,
+            itm=itm, num_peaks=num_peaks, distortion=distortion)
 
-        # Check if this is an ITM image and the itm flag is set correctly (backwards compatibility)
-        try:
-            origin = header['ORIGIN'].strip()
-            if origin == 'ITM':
-                try:
-                    assert itm is True
-                except AssertionError:
-                    itm = True
-                    LOGGER.warning("Deprecation Warning: This is an ITM image, setting itm flag to 'True'")
-        except KeyError:
-            origin = None
+    except Exception as e:
+        LOGGER.exception(f'{repr(e)}: {e}')
+        raise
 
-        # Try to check that the units on the input image are as expected (Dn/s = ADU/s; *_rate.fits)
-        try:
-            header_sci = fits.getheader(input_im, extname='sci')
-        except KeyError:
-            header_sci = {}
-
-        for hdr in [header, header_sci]:
-            if 'BUNIT' in hdr:
-                input_unit = hdr['BUNIT'].lower()
-            if 'PHOTMJSR' in hdr:
-                photmjsr = hdr['PHOTMJSR']
-            if 'DATAMODL' in hdr:
-                datamodel = hdr['DATAMODL']
-
-            if 'DETECTOR' in hdr:
-                detector = hdr['DETECTOR']  # e.g. 'NRCA3'
-            elif nircam and isinstance(nircam_det, str):
-                detector = 'NRC'+nircam_det
-
-        # Remove bad pixels from input images if possible. If not, we'll use the bad pixel masks
-            # NIRCam -> use dq array is available, use CRDS file 2nd
-            # FGS Full Frame -> use dq array is available (but no saturated flags), use DHAS mask 2nd
-            # Padded TRK image -> have to use DHAS file (no dq array; TRK box is confirmed to be in the right spot)
-        try:
-            dq_array = fits.getdata(input_im, extname='DQ')
-            dq_array, _ = utils.convert_bad_pixel_mask_data(dq_array, nircam=nircam)
-        except KeyError:
-            dq_array = None
+    finally:
+        if image is not None:
+            image.close()
 
-        try:
-            if dq_array is None:
-                detector  # check if variable exists, needed to pull mask file
-            try:
-                data = bad_pixel_correction(data, nircam, detector, dq_array)
-                LOGGER.info(f"Image Conversion: Bad pixels removed from image using "
-                            f"{'DQ array from image' if dq_array is not None else 'Bad Pixel Mask'}.")
-            except FileNotFoundError:
-                LOGGER.error('Image Conversion: Cannot find DQ file in repository. **No DQ data added.**')
-
-        except NameError:
-            LOGGER.warning("Image Conversion: Data not run through bad pixel removal step. Unable to pull "
-                           "necessary detector information from input image.")
-
-        # Remove distortion from NIRCam or FGS cal data, but not from padded TRK data nor rate images
-        # as they cannot be run through the pipeline without lots of extra steps
-        distortion = True  # is there distortion in the image
-        try:
-            if datamodel != 'GuiderCalModel' and input_unit == 'mjy/sr':
-                LOGGER.info("Image Conversion: Removing distortion from data using the JWST Pipeline's Resample step.")
-                # Update HDUList object and read it into the image model
-                with fits.open(input_im) as hdulist:
-                    hdulist['SCI'].data = data
-                    with ImageModel(hdulist, skip_fits_update=False) as model:
-                        result = ResampleStep.call(model, save_results=False)
-
-                # Crop data back to (2048, 2048), cutting out the top and right to keep the origin
-                LOGGER.info(f"Image Conversion: Cutting undistorted data from {result.data.shape} to (2048, 2048)")
-                data = result.data[0:2048, 0:2048]
-                distortion = False
-        except NameError:
-            LOGGER.info("Image Conversion: Skipping removing distortion from image due to missing either "
-                        "DATAMODL or BUNIT information.")
-
-        # Turn cal images into rate images
-        try:
-            if input_unit == 'mjy/sr':
-                convert_to_adu_s = photmjsr
-                data /= convert_to_adu_s
-                LOGGER.info('Image Conversion: Input is a Cal image. Converting from MJy/sr to ADU/s')
-            elif input_unit == 'dn/s':
-                LOGGER.info('Image Conversion: Image in correct units of ADU/s.')
-        except NameError:
-            LOGGER.info("Image Conversion: Can't check image type because of missing "
-                        "BUNIT keyword. User should confirm the input image is a rate image.")
-            pass
+    if use_cache:
+        conversion_cache.save(cache_key, data, fgs_hdr_dict, all_found_psfs_path, psf_center_path)
 
-        # Create raw FGS image...
+    return data, all_found_psfs_path, psf_center_path, fgs_hdr_dict
 
-        # Remove pedestal from NIRCam or FGS data
-        # pedestal should be taken out in refpix correction - only run if that hasn't been run
-        # and if not labeled as test data which is made without a pedestal
-        if 'S_REFPIX' in header.keys() and header['S_REFPIX'] == 'COMPLETE':
-            LOGGER.info("Image Conversion: Skipping removing pedestal - Reference pixel correction run in pipeline.")
-        elif 'TEST' in header.keys() and header['TEST'] == 'True':
-            LOGGER.info("Image Conversion: Skipping removing pedestal - Test flag found in image header.")
-        else:
-            data = remove_pedestal(data, nircam, itm)
 
-        # -------------- From NIRCam --------------
-        if nircam:
-            LOGGER.info("Image Conversion: This is a NIRCam image")
+def convert_im_multi(input_im, guiders, root, out_dir=None, nircam=True,
+                     nircam_det=None, normalize=True, norm_value=12.0,
+                     norm_unit="FGS Magnitude", smoothing='default',
+                     detection_threshold='standard-deviation',
+                     psf_size=None, all_found_psfs_file=None, gs_catalog=None,
+                     coarse_pointing=False, jitter_rate_arcsec=None,
+                     logger_passed=False, itm=False, num_peaks=None,
+                     undistort_method='pipeline', use_cache=True):
+    """Takes NIRCam or FGS image and converts it into FGS-like images for
+    several guiders, running the guider-independent steps (bad pixel
+    correction, distortion removal, unit conversion and pedestal
+    removal) only once.
 
-            # Check that the pupil is clear
-            try:
-                pupil_keyword = header['PUPIL']
-                if pupil_keyword in ['CLEAR', 'Imaging Pupil']:
-                    pass
-                else:
-                    raise ValueError(
-                        'NIRCam "PUPIL" header keyword for provided file is {}. '.format(pupil_keyword) +
-                        'Only the CLEAR/Imaging Pupil can be used to realistically simulate FGS images.'
-                    )
-            except KeyError:
-                pass
+    Parameters
+    ----------
+    input_im : str
+        Filepath for the input (NIRCam or FGS) image
+    guiders : list of int
+        Guider numbers (e.g. [1, 2])
+    root : str
+        Name used to create the output directory, {out_dir}/out/{root}
+    out_dir : str, optional
+        Where output files will be saved. If not provided, the
+        image(s) will be saved within the repository at
+        jwst_magic/. This path is the level outside the out/root/ dir
+    nircam : bool, optional
+        Denotes if the input_image is an FGS or NIRCam image. If True,
+        the image will be converted to FGS format. Unless out_dir is
+        specified, the FGS-formatted image will be saved to
+        ../out/{root}/FGS_imgs/{root}_binned_pad_norm.fits
+    nircam_det : str, optional
+        The detector of a provided NIRCam image. If left blank, the
+        detector will be extracted from the header of the NIRCam FITS
+        file.
+    normalize : bool, optional
+        Denotes if the image will be normalized. If True, norm_value
+        and norm_unit will be used to determine the normalization value
+    norm_value : str or float, optional
+        Specifies the Guide Star ID or the count rate/magnitude to which
+        to normalize.
+    norm_unit : str, optional
+        Specifies the unit of norm_value ("FGS Magnitude", "FGS countrate",
+        or "Guide Star ID")
+    smoothing : str or float, optional
+        Options are "low" for minimal smoothing (e.g. MIMF), "high" for large
+        smoothing (e.g. GA), "default" for medium smoothing for other cases,
+        or "choose center" for finding the center of a MIMF PSF. User can also
+        pass a float which will be used as the sigma value in ndimage.gaussian_filter.
+    detection_threshold : str, optional
+        Options are "standard-deviation" to set threshold=median + (3 * std)
+        or "pixel-wise" to use photutils' detect_threshold() function (used
+        only for normal operations)
+    psf_size : int, optional
+        Set the size of the stamps to use when cutting out PSFs from the image.
+        Input is the edge of the square size in pixels (e.g. if 100, the stamp
+        will be 100px x 100px). If not set, default values will be used based
+        on smoothing choice.
+    all_found_psfs_file : str, optional
+        A pre-made all_found_psfs file to use when creating the pseudo-FGS
+        image rather than making a new one in the code. This can be used
+        when MAGIC's current smoothing methods aren't sufficient in
+        blocking background segments and PSFs need to be deleted from the
+        MAGIC-made all found PSFs file in the backend. The file's
+        positions are guider-specific, so it can only be given when
+        converting for a single guider.
+    gs_catalog : str, optional
+        Guide star catalog version to query. E.g. 'GSC242'. None will use
+        the default catalog as defined in teh FGS Count Rate Module.
+    coarse_pointing : bool, optional
+        Denotes if the image will have a Gaussian filter applied to
+        simulate the effects of jitter when the observatory is in
+        coarse pointing rather than fine guide.
+    jitter_rate_arcsec : None, optional
+        The rate of the spacecraft jitter, in arcseconds per second,
+        that will be used to apply the Gaussian filter if
+        coarse_pointing is True.
+    logger_passed : bool, optional
+        Denotes if a logger object has already been generated.
+    itm : bool, optional
+        If this image come from the ITM simulator (important for normalization).
+    num_peaks: int
+        Number of peaks to find, will overwrite defaults based on smoothing
+    undistort_method : str, optional
+        How to remove the distortion from cal images: "pipeline" to
+        use the JWST pipeline's Resample step, "siaf" to resample
+        directly with the SIAF polynomials (much faster; see
+        ``undistortion.undistort_image``), or "compare" to use the
+        Resample step and log how the SIAF result differs from it
+    use_cache : bool, optional
+        Re-use the result of a previous conversion of the same input
+        file with the same parameters, if there is one, and cache the
+        result of this conversion (see ``conversion_cache``). Set to
+        False to always convert the image.
 
-            # Rotate the NIRCAM image into FGS frame
-            nircam_scale, data = transform_nircam_image(data, guider, nircam_det, header)
-            # Pad image
-            data = resize_nircam_image(data, nircam_scale, FGS_PIXELS, guider)
+    Returns
+    -------
+    results : dict
+        For each guider, the (data, all_found_psfs_path,
+        psf_center_path, fgs_hdr_dict) tuple returned by ``convert_im``
 
-        # -------------- From FGS --------------
-        else:
-            LOGGER.info("Image Conversion: This is an FGS image")
-            # Check if header keyword is equal to fgs raw to determine if rotation to raw is needed
-            if origin is not None and origin.upper() == 'FGSRAW':  # this is a magic-team keyword that should only be in test files
-                LOGGER.info("Image Conversion: Data is already provided in raw frame; no rotation done")
-                LOGGER.warning("Assume input guider is same as output guider; no rotation done")
-            else:
-                LOGGER.info(
-                    "Image Conversion: Expect that data provided is in science/DMS frame; rotating to raw FGS frame.")
-                data = coordinate_transforms.transform_sci_to_fgs_raw(data, guider)
-
-        # Apply Gaussian filter to simulate coarse pointing
-        if coarse_pointing:
-            pixel_scale = nircam_scale if nircam else globals()['FGS{}_SCALE'.format(guider)]
-
-            data = apply_coarse_pointing_filter(data, jitter_rate_arcsec, pixel_scale)
-            LOGGER.info("Image Conversion: Applied Gaussian filter to simulate "
-                        "coarse pointing with jitter of {:.3f} arcsec/sec".format(jitter_rate_arcsec))
-
-        # Normalize the image, if the "normalize" flag is True
-        # The ITM simulations are only created for relative SNR so they need to
-        # normalized to one before anything else happens
-        if itm:
-            LOGGER.info("Image Conversion: This is an ITM image.")
-            data -= data.min()  # set minimum at 0.
-            data /= data.sum()  # set total countrate to 1.
-            if not norm_value:
-                norm_value = 12
-                norm_unit = 'FGS Magnitude'
-                LOGGER.warning("Image Conversion: No normalization was specified but is required for an ITM image. "
-                               "Using FGS Magnitude of 12.")
-
-        if normalize or itm:
-            # Remove the background and background stars and output a seed image with just the foreground stars
-            data = create_seed_image(data, guider, root, out_dir, smoothing,
-                                     detection_threshold, psf_size, all_found_psfs_file, num_peaks=num_peaks)
-
-            # Convert magnitude/countrate to FGS countrate using new count rate module
-            # Take norm_value and norm_unit to pass to count rate module
-            fgs_countrate, fgs_mag = renormalize.convert_to_countrate_fgsmag(norm_value, norm_unit, guider, gs_catalog)
-
-            # Normalize the data
-            data = utils.correct_image(data) # Correct any negative or inf values before normalizing
-            data = normalize_data(data, fgs_countrate)
-            LOGGER.info("Image Conversion: Normalizing to {} FGS Countrate (FGS Mag: {})".format(fgs_countrate,
-                                                                                                 fgs_mag))
+    Raises
+    ------
+    TypeError
+        The input filename has more than one frame.
+    ValueError
+        An input NIRCam file has an obstruction in the pupil, or an
+        all_found_psfs_file is given for more than one guider.
+    """
+    # Set up out dir(s)
+    out_dir = utils.make_out_dir(out_dir, OUT_PATH, root)
+    utils.ensure_dir_exists(out_dir)
 
-        try:
-            if all_found_psfs_file is None:
-                # Save out all found PSFs file once the data has been normalized
-                x_list, y_list, cr_list, all_found_psfs_path = create_all_found_psfs_file(data, guider, root, out_dir,
-                                                                                          smoothing,
-                                                                                          detection_threshold,
-                                                                                          save=True, num_peaks=num_peaks)
-            else:
-                # Write the same file out in the correct directory with the correct name
-                table = asc.read(all_found_psfs_file)
-                colnames = table.colnames
-                all_cols = [[str(i) for i in table[name].tolist()] for name in colnames]
-                all_cols = list(map(list, zip(*all_cols)))
-                all_found_psfs_path = save_all_found_psfs_file(all_cols, guider, root, out_dir)
-
-            # Save out psf center file for no smoothing case
-            if smoothing == 'low':
-                LOGGER.info(
-                    "Image Conversion: No smoothing chosen for MIMF case, so calculating PSF center")
-
-                x_center, y_center, cr_center, _ = create_all_found_psfs_file(data, guider, root, out_dir,
-                                                                              smoothing='choose center',
-                                                                              detection_threshold=detection_threshold,
-                                                                              save=False, num_peaks=num_peaks)
-                psf_center_path = save_psf_center_file([[y_center[0], x_center[0], cr_center[0]]], guider, root, out_dir)
-
-                LOGGER.info("Image Conversion: PSF center y,x,cr = {}, {}, {} vs Guiding knot y,x,cr = {}, {}, {}".format(
-                    y_center[0], x_center[0], cr_center[0], y_list[0], x_list[0], cr_list[0]))
-            else:
-                psf_center_path = None
-        except TypeError as e:
-            if str(e) == "object of type 'NoneType' has no len()":
-                LOGGER.warning('Image Conversion: No PSFs were found in this image. '
-                               'Cannot write out an all found PSFs file.')
-                all_found_psfs_path = None
-                psf_center_path = None
-            else:
-                raise TypeError(str(e))
-
-        # Update header information
-        fgs_hdr_dict['IN_FILE'] = (os.path.basename(input_im), 'Input image')
-        fgs_hdr_dict['IN_INSTR'] = ('NIRCAM' if nircam else 'FGS', 'Input instrument')
-        fgs_hdr_dict['IN_DET'] = (nircam_det if nircam else f'FGS', 'Input detector')
-        fgs_hdr_dict['OUT_DET'] = (f'GUIDER{guider}', 'Output guider')
-        fgs_hdr_dict['DISTORT'] = (distortion, 'Is the image distorted')
-        fgs_hdr_dict['SMOOTHIN'] = (smoothing, 'Smoothing used')
-        if normalize:
-            fgs_hdr_dict['NORMUNIT'] = (norm_unit, 'Normalization unit')
-            fgs_hdr_dict['NORMVALU'] = (norm_value, 'Normalization value')
-            if norm_unit.lower() == 'guide star id':
-                ra, dec = renormalize.query_guide_star_catalog(gs_id=norm_value)
-                fgs_hdr_dict['GS_RA'] = (ra, 'RA of guide star')
-                fgs_hdr_dict['GS_DEC'] = (dec, 'DEC of guide star')
+    # Start logging
+    if not logger_passed:
+        utils.create_logger_from_yaml(__name__, out_dir_root=out_dir, root=root, level='DEBUG')
+
+    if undistort_method not in ['pipeline', 'siaf', 'compare']:
+        raise ValueError('Unknown undistortion method {}; use "pipeline", "siaf", or "compare"'.format(
+            undistort_method))
+    if all_found_psfs_file is not None and len(set(guiders)) > 1:
+        raise ValueError('An all found PSFs file only applies to one guider; convert guiders {} '
+                         'separately to use {}'.format(', '.join(str(guider) for guider in guiders),
+                                                       all_found_psfs_file))
+
+    parameters = dict(nircam=nircam, nircam_det=nircam_det, normalize=normalize, norm_value=norm_value,
+                      norm_unit=norm_unit, smoothing=smoothing, detection_threshold=detection_threshold,
+                      psf_size=psf_size, all_found_psfs_file=all_found_psfs_file, gs_catalog=gs_catalog,
+                      coarse_pointing=coarse_pointing, jitter_rate_arcsec=jitter_rate_arcsec,
+                      num_peaks=num_peaks)
+
+    # Only convert for the guiders that haven't already been converted the same way
+    results = {}
+    if use_cache:
+        cache_keys = {guider: _conversion_cache_key(input_im, guider, itm=itm, undistort_method=undistort_method,
+                                                    **parameters)
+                      for guider in guiders}
+        for guider in guiders:
+            cached = _load_cached_conversion(cache_keys[guider], input_im, guider, root, out_dir)
+            if cached is not None:
+                results[guider] = cached
+    remaining = [guider for guider in guiders if guider not in results]
+    if not remaining:
+        return results
+
+    image = None
+    try:
+        LOGGER.info("Image Conversion: " +
+                    "Beginning image conversion to guider {} FGS images".format(
+                        ' and '.join(str(guider) for guider in remaining)))
+        LOGGER.info("Image Conversion: Input image is expected to be in units of ADU/sec (countrate)")
+
+        image = InputImage(input_im)
+        data, itm_image, distortion = preprocess_image(image, nircam, nircam_det, itm, undistort_method)
+
+        for i, guider in enumerate(remaining):
+            LOGGER.info("Image Conversion: Converting preprocessed image to guider {} FGS image".format(guider))
+            # The guider steps may modify the data in place, so all but the last get a copy
+            guider_data = data if i == len(remaining) - 1 else np.copy(data)
+            results[guider] = convert_preprocessed_image(
+                guider_data, image.header, input_im, guider, root, out_dir, itm=itm_image, distortion=distortion,
+                **parameters)
 
     except Exception as e:
         LOGGER.exception(f'{repr(e)}: {e}')
         raise
 
-    return data, all_found_psfs_path, psf_center_path, fgs_hdr_dict
+    finally:
+        if image is not None:
+            image.close()
+
+    if use_cache:
+        for guider in remaining:
+            data, all_found_psfs_path, psf_center_path, fgs_hdr_dict = results[guider]
+            conversion_cache.save(cache_keys[guider], data, fgs_hdr_dict, all_found_psfs_path, psf_center_path)
+
+    return {guider: results[guider] for guider in guiders}
 
 
 def write_fgs_im(data, out_dir, root, guider, hdr_dict=None, fgsout_path=None):
@@ -0,0 +1,223 @@
+"""
+This module removes the optical distortion from NIRCam and FGS images
+using the SIAF polynomials directly, as a faster alternative to running
+the JWST pipeline's ResampleStep.
+
+The output image is sampled on a regular grid in the aperture's ideal
+(undistorted) frame, with the aperture's pixel scale, starting at the
+lower-left corner of the detector footprint (like the cropped
+ResampleStep output in ``convert_im``). For each output pixel, the
+matching science-frame pixel position is found with the SIAF
+ideal-to-science polynomials; these maps are computed once per aperture
+and SIAF version, and cached in memory and on disk. The image is then
+resampled with ``scipy.ndimage.map_coordinates``. Because the input is
+in surface brightness units (MJy/sr), no pixel area correction is
+applied.
+
+Use
+---
+    This module can be imported in a Python shell as such:
+    ::
+        from jwst_magic.convert_image import undistortion
+        data = undistortion.undistort_image(data, 'NRCA3')
+        report = undistortion.tolerance_report(resample_data, data)
+
+"""
+# Standard Library Imports
+import functools
+import logging
+import os
+
+# Third Party Imports
+import numpy as np
+import pysiaf
+from scipy import fft, ndimage
+
+# Paths
+__location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
+PACKAGE_PATH = os.path.split(__location__)[0]
+UNDISTORTION_MAP_PATH = os.path.join(PACKAGE_PATH, 'data', 'undistortion_maps')
+
+# Start logger
+LOGGER = logging.getLogger(__name__)
+
+
+def get_aperture_name(detector):
+    """Get the full-frame SIAF aperture of a detector.
+
+    Parameters
+    ----------
+    detector : str
+        Detector name as in the DETECTOR header keyword (e.g. 'NRCA3',
+        'NRCALONG', 'GUIDER1')
+
+    Returns
+    -------
+    aperture_name : str
+        SIAF aperture name (e.g. 'NRCA3_FULL', 'NRCA5_FULL', 'FGS1_FULL')
+    """
+    detector = detector.upper()
+    if detector.startswith('GUIDER'):
+        return 'FGS{}_FULL'.format(detector[-1])
+    if detector.startswith('NRC') and detector.endswith('LONG'):
+        return '{}5_FULL'.format(detector[:4])
+    return '{}_FULL'.format(detector)
+
+
+def get_aperture(aperture_name):
+    """Get a SIAF aperture by name"""
+    instrument = 'FGS' if aperture_name.startswith('FGS') else 'NIRCam'
+    return pysiaf.Siaf(instrument)[aperture_name]
+
+
+def build_undistortion_map(aperture_name, shape):
+    """Calculate the science-frame position of every pixel of the
+    undistorted output image.
+
+    Parameters
+    ----------
+    aperture_name : str
+        SIAF aperture name (e.g. 'NRCA3_FULL')
+    shape : tuple
+        Shape of the image (rows, columns)
+
+    Returns
+    -------
+    coordinates : 3-D numpy array
+        Array of shape (2, rows, columns) holding the (0-indexed) row
+        and column in the distorted science-frame image that each
+        output pixel samples
+    """
+    aperture = get_aperture(aperture_name)
+    n_rows, n_cols = shape
+    scale = np.sqrt(aperture.XSciScale * aperture.YSciScale)
+
+    # Footprint of the detector in the ideal frame, from its pixel edges
+    # (SIAF science pixel centers are at 1, 2, ..., n)
+    edge_cols = np.linspace(0.5, n_cols + 0.5, 257)
+    edge_rows = np.linspace(0.5, n_rows + 0.5, 257)
+    x_sci = np.concatenate([edge_cols, edge_cols, np.full(257, 0.5), np.full(257, n_cols + 0.5)])
+    y_sci = np.concatenate([np.full(257, 0.5), np.full(257, n_rows + 0.5), edge_rows, edge_rows])
+    x_idl, y_idl = aperture.sci_to_idl(x_sci, y_sci)
+
+    # Centers of the output pixels, starting from the lower left of the footprint
+    x_out = np.min(x_idl) + scale * (np.arange(n_cols) + 0.5)
+    y_out = np.min(y_idl) + scale * (np.arange(n_rows) + 0.5)
+    x_grid, y_grid = np.meshgrid(x_out, y_out)
+
+    x_sci, y_sci = aperture.idl_to_sci(x_grid, y_grid)
+    return np.stack([y_sci - 1, x_sci - 1]).astype(np.float32)
+
+
+def _undistortion_map_file(aperture_name, shape):
+    return os.path.join(UNDISTORTION_MAP_PATH, '{}_{}x{}_{}.npy'.format(
+        aperture_name, shape[0], shape[1], pysiaf.JWST_PRD_VERSION))
+
+
+@functools.lru_cache(maxsize=4)
+def get_undistortion_map(aperture_name, shape):
+    """Get the undistortion map of an aperture (see
+    ``build_undistortion_map``), building it only if it is not already
+    saved for this SIAF version.
+
+    Parameters
+    ----------
+    aperture_name : str
+        SIAF aperture name (e.g. 'NRCA3_FULL')
+    shape : tuple
+        Shape of the image (rows, columns)
+
+    Returns
+    -------
+    coordinates : 3-D numpy array
+        Read-only array of shape (2, rows, columns) with the science
+        frame row and column of each output pixel
+    """
+    shape = tuple(shape)
+    map_file = _undistortion_map_file(aperture_name, shape)
+    try:
+        coordinates = np.load(map_file, mmap_mode='r')
+        if coordinates.shape == (2,) + shape:
+            return coordinates
+    except (OSError, ValueError):
+        pass
+
+    LOGGER.info('Image Conversion: Building the {} undistortion map from the SIAF ({})'.format(
+        aperture_name, pysiaf.JWST_PRD_VERSION))
+    coordinates = build_undistortion_map(aperture_name, shape)
+    try:
+        os.makedirs(UNDISTORTION_MAP_PATH, exist_ok=True)
+        np.save(map_file, coordinates)
+    except OSError:
+        # A read-only installation just rebuilds the map in each session
+        LOGGER.warning('Image Conversion: Cannot save the undistortion map to {}'.format(map_file))
+    coordinates.flags.writeable = False
+    return coordinates
+
+
+def undistort_image(data, detector, order=1, fill_value=np.nan):
+    """Remove the distortion from a science-frame image.
+
+    Parameters
+    ----------
+    data : 2-D numpy array
+        Image data in the science frame, in surface brightness units
+    detector : str
+        Detector name as in the DETECTOR header keyword (e.g. 'NRCA3')
+    order : int, optional
+        Order of the spline interpolation (1 for bilinear)
+    fill_value : float, optional
+        Value of output pixels that fall outside the input image
+
+    Returns
+    -------
+    undistorted_data : 2-D numpy array
+        Image data on a regular grid in the ideal frame, with the same
+        shape as the input
+    """
+    coordinates = get_undistortion_map(get_aperture_name(detector), np.shape(data))
+    return ndimage.map_coordinates(np.asarray(data, dtype=float), coordinates, order=order,
+                                   mode='constant', cval=fill_value)
+
+
+def tolerance_report(reference, data):
+    """Compare an undistorted image to a reference (e.g. the
+    ResampleStep output for the same input).
+
+    Parameters
+    ----------
+    reference : 2-D numpy array
+        Reference undistorted image
+    data : 2-D numpy array
+        Undistorted image to compare, with the same shape
+
+    Returns
+    -------
+    report : dict
+        'shift' : (rows, columns) offset of ``data`` relative to
+            ``reference``, from the peak of their cross-correlation
+        'max_abs_diff', 'rms_diff' : maximum and RMS absolute
+            difference over pixels that are finite in both images
+        'max_rel_diff' : maximum absolute difference relative to the
+            maximum of the reference
+        'flux_ratio' : ratio of the summed data to the summed reference
+            over the common pixels
+        'n_pixels' : number of common pixels
+    """
+    reference = np.asarray(reference, dtype=float)
+    data = np.asarray(data, dtype=float)
+    common = np.isfinite(reference) & np.isfinite(data)
+    difference = data[common] - reference[common]
+
+    # Integer offset between the two grids
+    correlation = fft.irfft2(fft.rfft2(np.where(common, data, 0)) *
+                             np.conj(fft.rfft2(np.where(common, reference, 0))), s=data.shape)
+    shift = np.array(np.unravel_index(np.argmax(correlation), data.shape))
+    shift = tuple(int(s) for s in np.where(shift > np.array(data.shape) // 2, shift - data.shape, shift))
+
+    return {'shift': shift,
+            'max_abs_diff': float(np.max(np.abs(difference))),
+            'rms_diff': float(np.sqrt(np.mean(difference ** 2))),
+            'max_rel_diff': float(np.max(np.abs(difference)) / np.max(np.abs(reference[common]))),
+            'flux_ratio': float(np.sum(data[common]) / np.sum(reference[common])),
+            'n_pixels': int(np.count_nonzero(common))}
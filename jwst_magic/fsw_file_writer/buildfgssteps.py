@@ -46,11 +46,11 @@ from astropy.io import fits
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 import numpy as np
-from scipy.ndimage import shift
+from numpy.lib.stride_tricks import as_strided
 
 # Local imports
 from jwst_magic.utils import utils
-from jwst_magic.fsw_file_writer import config, detector_effects
+from jwst_magic.fsw_file_writer import config, detector_effects, reference_cache, shift_engine, write_files
 from jwst_magic.star_selector import select_psfs
 
 # Paths
@@ -82,8 +82,25 @@ class BuildFGSSteps(object):
     def __init__(self, im, guider, root, step, guiding_selections_file=None, configfile=None,
                  out_dir=None, thresh_factor=0.6, logger_passed=False, psf_center_file=None,
                  shift_id_attitude=True, use_oss_defaults=False, catalog_countrate=None,
-                 override_bright_guiding=False, use_readnoise=True):
+                 override_bright_guiding=False, use_readnoise=True, trk_nramps=None,
+                 trk_chunk_size=None, rng=None, catalog_only=False, output_profile='full'):
         """Initialize the class and call build_fgs_steps().
+
+        If ``trk_nramps`` is set, it overrides the number of TRK ramps in
+        the config file. If ``trk_chunk_size`` is set, the TRK bias and
+        reads are not built up front; they are generated in blocks of that
+        many ramps (see ``iter_ramp_chunks``) as the files are written.
+
+        ``rng`` (a seed or ``numpy.random.Generator``) is used for all the
+        noise in this step; if None, the global ``np.random`` state is used.
+
+        If ``catalog_only`` is True, only the coordinates, count rates and
+        thresholds are determined; no images are simulated. This is enough
+        to write the .star, .prc, .stc and catalog files.
+
+        ``output_profile`` sets which files will be written for this step
+        (see ``write_files.step_products``); arrays only used by files
+        outside the profile are not built.
         """
         # Check path exists
         utils.ensure_dir_exists(out_dir)
@@ -107,6 +124,13 @@ class BuildFGSSteps(object):
             self.threshold = None
             self.override_bright_guiding = override_bright_guiding
             self.use_readnoise = use_readnoise
+            self.trk_nramps = trk_nramps
+            self.chunked = step == 'TRK' and trk_chunk_size is not None
+            self.trk_chunk_size = trk_chunk_size
+            self.rng = utils.get_rng(rng)
+            self.catalog_only = catalog_only
+            self.output_profile = output_profile
+            self.products = write_files.step_products(step, output_profile)
             if 'config' in guiding_selections_file:
                 self.config = guiding_selections_file.split('/')[-1].split('.txt')[0].split('config')[-1]
             else:
@@ -162,7 +186,15 @@ class BuildFGSSteps(object):
 
         section = '{}_dict'.format(self.step.lower())
         config_ini = self.build_step(section, configfile)
-        self.image = self.create_img_arrays(section, config_ini)
+        if self.catalog_only or set(self.products) <= set(write_files.CATALOG_PRODUCTS):
+            # Skip simulating the images; only the catalog information is needed
+            self.time_normed_im = None
+            self.bias = None
+            self.cds = None
+            self.strips = None
+            self.image = None
+        else:
+            self.image = self.create_img_arrays(section, config_ini)
 
         # Write the files
         LOGGER.info("FSW File Writing: Creating {} FSW files".format(self.step))
@@ -247,6 +279,9 @@ class BuildFGSSteps(object):
             configfile = os.path.join(DATA_PATH, 'config.ini')
         config_ini = config.load_config_ini(configfile)
 
+        if self.step == 'TRK' and self.trk_nramps is not None:
+            config_ini.set(section, 'nramps', str(self.trk_nramps))
+
         if self.step not in ['ID', 'CAL']:
             # If not ID or CAL (i.e. if making a subarray), only use the guide star
             self.xarr = np.asarray([self.xarr[0]])
@@ -276,7 +311,9 @@ class BuildFGSSteps(object):
                 size 64 x 2048
 
         If creating LOSTRK images, the final "image" array will be
-        normalized and resized for use in the FGSES
+        normalized and resized for use in the FGSES. If creating chunked
+        TRK images, no bias or image arrays are made here; see
+        ``iter_ramp_chunks``.
 
         Parameters
         ----------
@@ -298,56 +335,36 @@ class BuildFGSSteps(object):
 
         # Add the bias, and build the array of reads with noisy data
         if config_ini.getboolean(step, 'bias'):
-            gain = GAIN_G1 if self.guider == 1 else GAIN_G2
-
-            # Get the bias ramp
-            nramps = config_ini.getint(step, 'nramps')
-            det_eff = detector_effects.FGSDetectorEffects(
-                self.guider, self.xarr, self.yarr, self.nreads, nramps,
-                config_ini.getint(step, 'imgsize'), self.use_readnoise
-            )
-            self.bias = det_eff.add_detector_effects()
-
-            # Take the bias and add a noisy version of the input image
-            # (specifically Poisson noise), adding signal over each read
-            image = np.zeros_like(self.bias)
-            signal_cube = [self.time_normed_im] * nramps
-            positive_signal_cube = np.copy(signal_cube)
-            positive_signal_cube[positive_signal_cube < 0] = 0
-
-            # Add signal to every first read
-            i_read1 = 0
-            ndrop1 = int(config_ini.getfloat(step, 'ndrops1'))
-            image[i_read1::self.nreads] += self.bias[i_read1::self.nreads] + np.random.poisson(
-                (ndrop1 + 1) * positive_signal_cube * gain) / gain
-
-            # Add signal to every second read
-            i_read2 = 1
-            ndrop2 = int(config_ini.getfloat(step, 'ndrops2'))
-            image[i_read2::self.nreads] = image[i_read1::self.nreads] + np.random.poisson(
-                (ndrop2 + 1) * positive_signal_cube * gain) / gain
-
-            # Set pixels in the image to 0 when flagged as bad in the DQ array
-            image = self.add_fgs_dq(image, self.nreads, nramps, det_eff.array_bounds)
+            self.nramps = config_ini.getint(step, 'nramps')
+            if self.chunked:
+                # The reads will be generated block by block as they are written
+                self.section = step
+                self.config_ini = config_ini
+                self.bias = None
+                image = None
+            else:
+                self.bias, image = self.create_reads(step, config_ini, self.nramps)
+                if 'bias' not in self.products:
+                    # Only needed to make the reads
+                    self.bias = None
 
         else:
             # In the case of LOSTRK, just return one frame with one
             # frame readout worth of signal
             self.bias = None
-            image = self.time_normed_im
-
-        # # Cut any pixels under zero
-        image = utils.correct_image(image)
+            image = utils.correct_image(self.time_normed_im)
 
         # Create the CDS image by subtracting the first read from the second
         # read, for each ramp
-        if config_ini.getboolean(step, 'cdsimg'):
+        if config_ini.getboolean(step, 'cdsimg') and 'cds' in self.products:
             self.cds = create_cds(image)
         else:
             self.cds = None
 
-        # If in ID, split the full-frame image into strips
-        if config_ini.getboolean(step, 'stripsimg'):
+        # If in ID, split the full-frame image into strips (for the strips
+        # and .dat files)
+        self.strips = None
+        if config_ini.getboolean(step, 'stripsimg') and {'strips', 'dat'} & set(self.products):
             self.strips = create_strips(image,
                                         config_ini.getint(step, 'imgsize'),
                                         config_ini.getint(step, 'nstrips'),
@@ -369,6 +386,94 @@ class BuildFGSSteps(object):
 
         return image
 
+    def create_reads(self, step, config_ini, nramps):
+        """Create the bias and the reads with noisy data for a number of
+        ramps of the given step.
+
+        Parameters
+        ----------
+        step : str
+            Name of step within the config file ('{step}_dict')
+        config_ini : obj
+            Object containing all parameters from the given config file
+        nramps : int
+            Number of ramps to create
+
+        Returns
+        -------
+        bias : 3-D numpy array
+            The FGS bias, of size (nramps x nreads) x n_rows x n_columns
+        image : 3-D numpy array
+            The bias plus Poisson noisy signal in each read, in counts
+        """
+        gain = GAIN_G1 if self.guider == 1 else GAIN_G2
+
+        # Get the bias ramp
+        det_eff = detector_effects.FGSDetectorEffects(
+            self.guider, self.xarr, self.yarr, self.nreads, nramps,
+            config_ini.getint(step, 'imgsize'), self.use_readnoise, dtype=np.float32,
+            rng=self.rng
+        )
+        bias = det_eff.add_detector_effects()
+
+        # Take the bias and add a noisy version of the input image
+        # (specifically Poisson noise), adding signal over each read.
+        # The reads are built one frame at a time so only the bias and
+        # image cubes are ever allocated at full size.
+        image = np.empty_like(bias)
+        positive_signal = np.copy(self.time_normed_im)
+        positive_signal[positive_signal < 0] = 0
+
+        # Add signal to every first read
+        i_read1 = 0
+        ndrop1 = int(config_ini.getfloat(step, 'ndrops1'))
+        for i_frame in range(i_read1, nramps * self.nreads, self.nreads):
+            image[i_frame] = bias[i_frame] + self.rng.poisson(
+                (ndrop1 + 1) * positive_signal * gain) / gain
+
+        # Add signal to every second read
+        i_read2 = 1
+        ndrop2 = int(config_ini.getfloat(step, 'ndrops2'))
+        for i_frame in range(i_read2, nramps * self.nreads, self.nreads):
+            image[i_frame] = image[i_frame - i_read2 + i_read1] + self.rng.poisson(
+                (ndrop2 + 1) * positive_signal * gain) / gain
+
+        # Set pixels in the image to 0 when flagged as bad in the DQ array
+        image = self.add_fgs_dq(image, self.nreads, nramps, det_eff.array_bounds)
+
+        # Cut any pixels under zero
+        image = utils.correct_image(image, inplace=True)
+
+        return bias, image
+
+    def iter_ramp_chunks(self):
+        """Generate the bias and reads of a chunked (TRK) step in blocks
+        of ``trk_chunk_size`` ramps, so that long TRK simulations never
+        hold the whole cube in memory. Each call starts a new, independent
+        realization of the noise.
+
+        Yields
+        ------
+        bias : 3-D numpy array
+            The FGS bias for the block of ramps
+        image : 3-D numpy array
+            The reads for the block of ramps, in counts
+        """
+        for start in range(0, self.nramps, self.trk_chunk_size):
+            nramps = min(self.trk_chunk_size, self.nramps - start)
+            yield self.create_reads(self.section, self.config_ini, nramps)
+
+    def drop_arrays(self):
+        """Release the image arrays once the files for this step have
+        been written, leaving a lightweight object that still holds the
+        catalog information (coordinates, countrates, thresholds) needed
+        to rewrite the .prc and .star files.
+        """
+        for attr in ['input_im', 'time_normed_im', 'bias', 'image', 'cds',
+                     'strips', 'config_ini']:
+            if hasattr(self, attr):
+                setattr(self, attr, None)
+
     def add_fgs_dq(self, image, nreads, nramps, array_bounds):
         """Set the bias to 0 where the DQ Array is flagged
         as bad (where it equals 1)
@@ -387,13 +492,12 @@ class BuildFGSSteps(object):
 
             dq_file = os.path.join(DATA_PATH, 'reference_files',
                                    'fgs_dq_G{}.fits'.format(self.guider))
-            dq_arr = np.copy(fits.getdata(dq_file))
+            dq_arr = reference_cache.get_fits_data(dq_file)
 
-            # Cut and duplicate DQ to match shape of bias file
+            # Cut DQ to match the subarray and apply it to every read
             xlow, xhigh, ylow, yhigh = array_bounds
-            dq_arr = dq_arr[xlow:xhigh, ylow:yhigh]
-            dq_arr = np.stack([dq_arr] * nramps * nreads, axis=0)
-            image[dq_arr == 1] = 0
+            dq_mask = dq_arr[xlow:xhigh, ylow:yhigh] == 1
+            image[:, dq_mask] = 0
         except FileNotFoundError:
             LOGGER.error('FSW File Writing: Cannot find DQ file in repository. **No DQ data added.**')
 
@@ -409,8 +513,8 @@ def create_strips(image, imgsize, nstrips, nramps, nreads, strip_height, yoffset
 
     Parameters
     ----------
-    image : 2-D numpy array
-        Image data
+    image : 3-D numpy array
+        Image data (reads)
     imgsize : int
         Dimension of full-frame image (pixels)
     nstrips : int
@@ -428,21 +532,106 @@ def create_strips(image, imgsize, nstrips, nramps, nreads, strip_height, yoffset
 
     Returns
     -------
-    strips : 3-D numpy array
-        Array of ID strips with dimensions:
+    strips : Strips
+        Array-like view of the ID strips with dimensions:
         (nramps * nreads * nz, strip_height, imgsize)
     """
-    nz = nramps * nreads
-    strips = np.zeros((nstrips * nz, strip_height, imgsize))
-    nn = 0
-    for i in range(nstrips):
-        for iz in range(nz):
-            ylow = i * (strip_height - overlap) + yoffset
-            yhigh = ylow + strip_height
-            strips[nn] = image[iz, ylow:yhigh, :]
-            nn += 1
+    return Strips(image[:, :, :imgsize], nstrips, nramps * nreads, strip_height, yoffset, overlap)
+
+
+class Strips(object):
+    """The ID strips of a cube of reads, as a read-only view of the
+    reads rather than a copy.
 
-    return strips
+    Strip ``i`` of read ``iz`` is rows ``i * (strip_height - overlap) +
+    yoffset`` to that plus ``strip_height`` of read ``iz``, so the strips
+    are a strided view of the reads. The strips behave like the 3-D
+    array of shape (nstrips * nz, strip_height, n_columns), ordered by
+    strip and then read, that used to be built by copying; use
+    ``to_uint16`` to get the array to write out.
+    """
+    def __init__(self, image, nstrips, nz, strip_height, yoffset, overlap):
+        """Make the view.
+
+        Parameters
+        ----------
+        image : 3-D numpy array
+            Reads, of shape (at least nz, n_rows, n_columns)
+        nstrips : int
+            Number of strips
+        nz : int
+            Number of reads
+        strip_height : int
+            Height of each strip (pixels)
+        yoffset : int
+            The offset at the bottom of the array before the first strip (pixels)
+        overlap : int
+            The number of pixels of overlap between strips
+
+        Raises
+        ------
+        ValueError
+            The strips don't fit in the image.
+        """
+        step = strip_height - overlap
+        if image.shape[0] < nz or yoffset < 0 or (nstrips - 1) * step + yoffset + strip_height > image.shape[1]:
+            raise ValueError('{} strips of height {} (overlap {}, offset {}) from {} reads do not fit in an '
+                             'image of shape {}.'.format(nstrips, strip_height, overlap, yoffset, nz, image.shape))
+
+        first = image[:nz, yoffset:]
+        z_stride, y_stride, x_stride = first.strides
+        self.view = as_strided(first, shape=(nstrips, nz, strip_height, image.shape[2]),
+                               strides=(step * y_stride, z_stride, y_stride, x_stride), writeable=False)
+
+    @property
+    def shape(self):
+        nstrips, nz, strip_height, n_columns = self.view.shape
+        return nstrips * nz, strip_height, n_columns
+
+    @property
+    def dtype(self):
+        return self.view.dtype
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def size(self):
+        return self.view.size
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """Get strip(s) by index along the first axis, as in the 3-D array"""
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('Strip index {} out of range for {} strips'.format(index, len(self)))
+            return self.view[divmod(index, self.view.shape[1])]
+        return np.asarray(self)[index]
+
+    def __array__(self, dtype=None, copy=None):
+        # The strips overlap in the view, so the 3-D array is always a copy
+        if copy is False:
+            raise ValueError('Strips cannot be converted to an array without a copy')
+        return self.view.reshape(self.shape).astype(dtype if dtype is not None else self.dtype, copy=False)
+
+    def to_uint16(self):
+        """Get the strips as an array to write out: negative and
+        non-finite pixels set to 0, saturated pixels to 65535, and cast
+        to uint16. This is the only copy of the strips that is made (see
+        ``utils.correct_and_cast``).
+
+        Returns
+        -------
+        strips : 3-D numpy array
+            uint16 array of shape (nstrips * nz, strip_height, n_columns)
+        """
+        strips = utils.correct_and_cast(self.view, 65535, dtype=np.uint16)
+        return strips.reshape(self.shape)
 
 
 def create_cds(arr, fix_saturated_pix=True):
@@ -556,7 +745,7 @@ def create_im_subarray(image, xcoord, ycoord, imgsize, show_fig=False):
 
 def shift_to_id_attitude(image, root, guider, out_dir, guiding_selections_file,
                          all_found_psfs_file, center_pointing_file, psf_center_file=None,
-                         logger_passed=False):
+                         logger_passed=False, shift_method='spline', engine=None):
     """Shift the FGS image such that the guide star is at the ID
     attitude. Rewrite the FGS FITS file, guiding_selections, and all_found_psfs
     catalog files for this shifted case. (Rename old versions of those files
@@ -583,6 +772,14 @@ def shift_to_id_attitude(image, root, guider, out_dir, guiding_selections_file,
         center psf file
     logger_passed : bool
         T/F if a logger is passed into the function
+    shift_method : str, optional
+        How to shift the image: "spline" for cubic spline interpolation,
+        or "fourier" to shift it in Fourier space (see
+        ``shift_engine.ShiftEngine.shift``)
+    engine : shift_engine.ShiftEngine, optional
+        Engine to shift the image with, which keeps the spline
+        coefficients of images it has already shifted. If None, the
+        engine shared by all shifts in this process is used.
 
     Returns
     -------
@@ -639,7 +836,9 @@ def shift_to_id_attitude(image, root, guider, out_dir, guiding_selections_file,
     bkg = np.median(image)
 
     LOGGER.info("FSW File Writing: Shifting guide star to ID attitude ({}, {})".format(xend, yend))
-    shifted_image = shift(image, (dy, dx), mode='constant', cval=bkg, prefilter=True)
+    if engine is None:
+        engine = shift_engine.SHIFT_ENGINE
+    shifted_image = engine.shift(image, (dy, dx), cval=bkg, method=shift_method)
 
     # 2) Write new shifted guiding_selections*.txt
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -722,7 +921,7 @@ def shift_to_id_attitude(image, root, guider, out_dir, guiding_selections_file,
     header_file = os.path.join(out_dir.split(root)[0], root, 'FGS_imgs', f'unshifted_{root}_G{guider}.fits')
     if not os.path.exists(header_file):
         header_file = os.path.join(DATA_PATH, 'header_g{}.fits'.format(guider))
-    hdr = fits.getheader(header_file, ext=0)
+    hdr = reference_cache.get_fits_header(header_file)
     hdr['IDATTPIX'] = (hdr_keyword, 'Image shifted to place GS at ID attitude')
 
     shifted_FGS_img = os.path.join(out_dir, 'FGS_imgs', 'shifted_' + file_root + '.fits')
@@ -20,6 +20,9 @@ Use
 import configparser
 import os
 
+# Local Imports
+from jwst_magic.fsw_file_writer import reference_cache
+
 
 def get_config_ini_path(config_file_name):
     """Define path to config file within jwst_magic/fsw_file_writer
@@ -51,11 +54,16 @@ def load_config_ini(config_file_name):
     config : obj
         configparser object containing parameters read from config.ini
     """
-    # Read config file once here.
+    # Read config file once here (the file contents are cached, but each
+    # caller gets its own parser so it can safely override values).
     config = configparser.ConfigParser()
     config._interpolation = configparser.ExtendedInterpolation()
 
     filename = get_config_ini_path(config_file_name)
-    config.read(filename)
+    try:
+        config.read_string(reference_cache.get_text(filename), source=filename)
+    except FileNotFoundError:
+        # Like ConfigParser.read, ignore a missing file
+        pass
 
     return config
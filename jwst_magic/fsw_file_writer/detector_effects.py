@@ -37,11 +37,10 @@ import os
 import logging
 
 # Third Party Imports
-from astropy.io import fits
 import numpy as np
-import yaml
 
 # Local Imports
+from jwst_magic.fsw_file_writer import reference_cache
 from jwst_magic.utils import utils
 
 # Paths
@@ -77,6 +76,14 @@ class FGSDetectorEffects:
     use_readnoise : bool, True
         Include the readnoise data in the detector effects. Only
         False for testing case.
+    dtype : numpy dtype, optional
+        Data type of the bias array. Defaults to float64; use float32
+        to halve the memory needed for large (e.g. ID) cubes.
+    rng : int, numpy.random.SeedSequence, or numpy.random.Generator, optional
+        Source of the random noise. If None, the global ``np.random``
+        state is used; otherwise a ``numpy.random.Generator`` is made
+        from it (see ``utils.get_rng``), and normal draws are made in
+        the precision of ``dtype``.
 
     Returns
     -------
@@ -88,7 +95,8 @@ class FGSDetectorEffects:
     ValueError
         Invalid guider number provided
     """
-    def __init__(self, guider, xcoord, ycoord, nreads, nramps, imgsize, use_readnoise=True):
+    def __init__(self, guider, xcoord, ycoord, nreads, nramps, imgsize, use_readnoise=True,
+                 dtype=np.float64, rng=None):
         # Check that the guider is valid
         if int(guider) not in [1, 2]:
             raise ValueError("Guider {} not recognized.".format(guider))
@@ -100,9 +108,10 @@ class FGSDetectorEffects:
         self.nramps = nramps
         self.imgsize = imgsize
         self.use_readnoise = use_readnoise
+        self.rng = utils.get_rng(rng)
 
         # Create an empty array of the appropriate size
-        self.bias = np.zeros((nramps * nreads, imgsize, imgsize))
+        self.bias = np.zeros((nramps * nreads, imgsize, imgsize), dtype=dtype)
 
         # Determine the bounds of the needed array
         self.array_bounds = self.get_subarray_location()
@@ -130,10 +139,19 @@ class FGSDetectorEffects:
         """Add kTc noise, which imprints at reset, to the bias.
         KTC is a Gaussian with a std of around 40 DN
         """
-        ktc = np.random.normal(loc=0, scale=40, size=(self.nramps, self.imgsize, self.imgsize))
-        # Repeat the KTC for all reads
-        ktc_full = np.repeat(ktc, self.nreads, axis=0)
-        self.bias += ktc_full
+        # Draw one ramp at a time and add it to all reads of that ramp
+        for iramp in range(self.nramps):
+            ktc = 40 * self.standard_normal((self.imgsize, self.imgsize))
+            self.bias[iramp * self.nreads:(iramp + 1) * self.nreads] += ktc
+
+    def standard_normal(self, size):
+        """Draw standard normal noise of the given size, in single
+        precision if the bias is single precision and a Generator is
+        in use (the legacy ``np.random`` state only draws doubles).
+        """
+        if isinstance(self.rng, np.random.Generator) and self.bias.dtype == np.float32:
+            return self.rng.standard_normal(size, dtype=np.float32)
+        return self.rng.standard_normal(size)
 
     def add_pedestal(self):
         """Add pedestal, which imprints at reset, to the bias.
@@ -163,10 +181,10 @@ class FGSDetectorEffects:
             # Create the full frame pedestal image
             pedestal = np.zeros((self.nramps * self.nreads, 2048, 2048))
             for i in range(self.nramps * self.nreads):
-                pedestal[i, :, 0:511] = np.fix(np.round(25 * np.random.random_sample()))
-                pedestal[i, :, 512:1023] = np.fix(np.round(25 * np.random.random_sample()))
-                pedestal[i, :, 1024:1535] = np.fix(np.round(25 * np.random.random_sample()))
-                pedestal[i, :, 1536:2047] = np.fix(np.round(25 * np.random.random_sample()))
+                pedestal[i, :, 0:511] = np.fix(np.round(25 * self.rng.random()))
+                pedestal[i, :, 512:1023] = np.fix(np.round(25 * self.rng.random()))
+                pedestal[i, :, 1024:1535] = np.fix(np.round(25 * self.rng.random()))
+                pedestal[i, :, 1536:2047] = np.fix(np.round(25 * self.rng.random()))
 
         # For subarrays
         else:
@@ -185,7 +203,7 @@ class FGSDetectorEffects:
                 # Determine transition x value
                 xborder = spanning - 1 - xlow
 
-                ped_noise = np.fix(25 * np.random.standard_normal(size=(self.nramps, 2)))
+                ped_noise = np.fix(25 * self.rng.standard_normal(size=(self.nramps, 2)))
                 for iramp, ped in zip(range(self.nramps), ped_noise):
                     pedestal[iramp * self.nreads:(iramp + 1) * self.nreads, :, :xborder] = ped[0]
                     pedestal[iramp * self.nreads:(iramp + 1) * self.nreads, :, xborder:] = ped[1]
@@ -193,7 +211,7 @@ class FGSDetectorEffects:
             # Else if subarray is completely within just one pedestal:
             elif not spanning:
                 ped_noise = np.zeros((self.nramps, 1, 1))
-                ped_noise[:, 0, 0] = np.fix(25 * np.random.standard_normal(size=self.nramps))
+                ped_noise[:, 0, 0] = np.fix(25 * self.rng.standard_normal(size=self.nramps))
 
                 # Resize array to match pedestal array
                 pedestal = np.repeat(ped_noise, self.imgsize, axis=1)
@@ -207,14 +225,15 @@ class FGSDetectorEffects:
         """
         # Load all the read noise values from the yaml
         try:
-            with open(READ_NOISE, encoding="utf-8") as f:
-                read_noise_dict = yaml.safe_load(f.read())
+            read_noise_dict = reference_cache.get_yaml(READ_NOISE)
             # Get the read noise value for the current step
             array_size = self.imgsize if self.imgsize != 43 else 32
             read_noise = read_noise_dict['guider{}'.format(self.guider)][array_size]
 
             # Add normally distributed read noise to the bias, with a mean value = 0 and STD = read noise
-            self.bias += np.random.normal(loc=0, scale=read_noise, size=np.shape(self.bias)).astype(int)
+            # (one frame at a time to avoid allocating another full-size cube)
+            for frame in self.bias:
+                frame += (read_noise * self.standard_normal(frame.shape)).astype(int)
         except FileNotFoundError:
             LOGGER.error('Detector Effects: Cannot find readnoise.yaml in repository. **No read noise added.**')
 
@@ -224,7 +243,7 @@ class FGSDetectorEffects:
         # Open the zeroth read bias structure file
         bias_file = BIASZERO_G1 if self.guider == 1 else BIASZERO_G2
         try:
-            bias0 = np.copy(fits.getdata(bias_file))
+            bias0 = reference_cache.get_fits_data(bias_file)
 
             xlow, xhigh, ylow, yhigh = self.array_bounds
 
@@ -97,13 +97,11 @@ class Mkproc(object):
             self.out_dir = os.path.join(OUT_PATH, 'out', root)
         else:
             self.out_dir = out_dir
-        if not os.path.exists(self.out_dir):
-            os.makedirs(self.out_dir)
+        os.makedirs(self.out_dir, exist_ok=True)
 
         self.dhas_dir, self.ground_system_dir = dhas_dir, ground_system_dir
         for dir in [dhas_dir, ground_system_dir]:
-            if not os.path.exists(os.path.join(self.out_dir, dir)):
-                os.makedirs(os.path.join(self.out_dir, dir))
+            os.makedirs(os.path.join(self.out_dir, dir), exist_ok=True)
 
         # Find templates. If template path not found, cannot make .prc files.
         template_path = os.path.join(PACKAGE_PATH, 'data', 'templates')
@@ -0,0 +1,157 @@
+"""Cache the reference data read while writing FSW files
+
+Every FGS step (and every guiding configuration) reads the same
+reference files: the zeroth read bias, the DQ array, the read noise
+values, the FITS header templates, and the config.ini file. This module
+keeps one copy of each per process, keyed by path and modification
+time, so that a file is only read again if it changes on disk. FITS
+arrays are memory-mapped and handed out read-only, so slicing them for
+a subarray does not copy the full frame.
+
+Use
+---
+    This module can be used as such:
+    ::
+        from jwst_magic.fsw_file_writer import reference_cache
+        bias0 = reference_cache.get_fits_data(bias_file)
+        hdr = reference_cache.get_fits_header(header_file)
+        stats = reference_cache.get_stats()
+
+    Required arguments:
+        ``bias_file``, ``header_file`` - paths to the reference files
+"""
+
+# Standard Library Imports
+import os
+
+# Third Party Imports
+from astropy.io import fits
+import yaml
+
+# Cached reference data, keyed by (kind, path) and storing (mtime, value)
+_CACHE = {}
+
+# Number of cache hits and misses since the last clear()
+_STATS = {'hits': 0, 'misses': 0}
+
+
+def _get(kind, path, loader):
+    """Return the cached value for ``path``, loading it if it has not
+    been loaded yet or if the file has been modified since.
+
+    Raises
+    ------
+    FileNotFoundError
+        The file does not exist
+    """
+    path = os.path.realpath(path)
+    mtime = os.stat(path).st_mtime_ns
+    key = (kind, path)
+
+    entry = _CACHE.get(key)
+    if entry is not None and entry[0] == mtime:
+        _STATS['hits'] += 1
+        return entry[1]
+
+    _STATS['misses'] += 1
+    value = loader(path)
+    _CACHE[key] = (mtime, value)
+    return value
+
+
+def _load_fits_data(path):
+    data = fits.getdata(path, memmap=True)
+    data.flags.writeable = False
+    return data
+
+
+def get_fits_data(path):
+    """Get the primary data array of a FITS file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the FITS file
+
+    Returns
+    -------
+    data : numpy array
+        Read-only (memory-mapped where possible) data array. Slice it
+        to get a view of a subarray; copy it before modifying.
+    """
+    return _get('fits_data', path, _load_fits_data)
+
+
+def get_fits_header(path):
+    """Get a copy of the primary header of a FITS file, which the
+    caller is free to modify.
+
+    Parameters
+    ----------
+    path : str
+        Path to the FITS file
+
+    Returns
+    -------
+    header : astropy.io.fits.Header
+        Copy of the cached header
+    """
+    return _get('fits_header', path, lambda p: fits.getheader(p, ext=0)).copy()
+
+
+def get_yaml(path):
+    """Get the contents of a YAML file. The returned object is shared
+    between callers and should not be modified.
+
+    Parameters
+    ----------
+    path : str
+        Path to the YAML file
+
+    Returns
+    -------
+    contents : dict
+        Parsed contents of the file
+    """
+    def load(p):
+        with open(p, encoding="utf-8") as f:
+            return yaml.safe_load(f.read())
+    return _get('yaml', path, load)
+
+
+def get_text(path):
+    """Get the contents of a text file (e.g. config.ini).
+
+    Parameters
+    ----------
+    path : str
+        Path to the text file
+
+    Returns
+    -------
+    contents : str
+        Contents of the file
+    """
+    def load(p):
+        with open(p, encoding="utf-8") as f:
+            return f.read()
+    return _get('text', path, load)
+
+
+def get_stats():
+    """Get the number of cache hits and misses since the last clear().
+
+    Returns
+    -------
+    stats : dict
+        Dictionary with 'hits', 'misses', and 'entries' (the number of
+        cached files)
+    """
+    return dict(_STATS, entries=len(_CACHE))
+
+
+def clear():
+    """Empty the cache and reset the hit/miss counters"""
+    _CACHE.clear()
+    _STATS['hits'] = 0
+    _STATS['misses'] = 0
@@ -46,6 +46,7 @@ from astropy.io import ascii as asc
 import numpy as np
 
 # Local Imports
+from jwst_magic import startup_checks
 from jwst_magic.fsw_file_writer import buildfgssteps, write_files
 from jwst_magic.star_selector import select_psfs
 from jwst_magic.utils import utils
@@ -54,7 +55,8 @@ from jwst_magic.utils import utils
 LOGGER = logging.getLogger(__name__)
 
 
-def rewrite_prc(inds_list, center_of_pointing, guider, root, out_dir, thresh_factor, shifted, override_bright_guiding):
+def rewrite_prc(inds_list, center_of_pointing, guider, root, out_dir, thresh_factor, shifted, override_bright_guiding,
+                seed=None, write_images=True, output_profile='full'):
     """For a given dataset, rewrite the PRC and guiding_selections*.txt to select a
     new commanded guide star and reference stars
 
@@ -77,6 +79,21 @@ def rewrite_prc(inds_list, center_of_pointing, guider, root, out_dir, thresh_fac
         thresh_factor used to determine the threshold uses in star/prc files
     shifted : bool
         If the image has been chosen to be shifted to the ID attitude
+    override_bright_guiding : bool
+        Use the provided threshold factor even if the 3x3 count rate is
+        above the OSS trigger
+    seed : int, optional
+        Seed for the detector noise; each config/step gets its own
+        random number stream spawned from it
+    write_images : bool, optional
+        Also rewrite the ACQ1, ACQ2, and TRK images for the new guide
+        star. If False, only the .star and .prc files are written and no
+        images are simulated at all.
+    output_profile : str, optional
+        Which files to write (see ``write_files.step_products``). Only
+        the .star, .prc, and ACQ1, ACQ2, and TRK image files in the
+        profile are rewritten; e.g. "ground-only" writes only the .prc
+        files and simulates no images.
 
     Raises
     ------
@@ -92,6 +109,10 @@ def rewrite_prc(inds_list, center_of_pointing, guider, root, out_dir, thresh_fac
     file_root = '{}_G{}'.format(root, guider)
     LOGGER.info("Rewrite PRC: Reading from (and writing to) {}".format(out_path))
 
+    # The images are simulated with the bias and bad pixel reference files
+    if write_images:
+        startup_checks.require_references()
+
     # Find converted FGS image
     if os.path.exists(os.path.join(out_path, 'FGS_imgs/unshifted_{}.fits'.format(file_root))):
         fgs_im = os.path.join(out_path, 'FGS_imgs/unshifted_{}.fits'.format(file_root))
@@ -149,6 +170,8 @@ def rewrite_prc(inds_list, center_of_pointing, guider, root, out_dir, thresh_fac
         guiding_selections_path_list.append(guiding_selections_path)
 
     # Shift and write out FSW files
+    steps = ['ID', 'ACQ1', 'ACQ2', 'TRK']
+    rngs = utils.spawn_rngs(seed, len(guiding_selections_path_list), len(steps))
     for i, guiding_selections_file in enumerate(guiding_selections_path_list):
         # Change out_dir to write data to guiding_config_#/ sub-directory next to the selections file
         if 'guiding_config' in guiding_selections_file:
@@ -166,21 +189,25 @@ def rewrite_prc(inds_list, center_of_pointing, guider, root, out_dir, thresh_fac
             psf_center_file_fsw = psf_center_file
 
         # Rewrite CECIL proc file
-        for step in ['ID', 'ACQ1', 'ACQ2', 'TRK']:
+        for step, rng in zip(steps, rngs[i]):
+            # Only the ID .star file is written, so never simulate the (full frame) ID images
+            products = write_files.step_products(step, output_profile)
+            catalog_only = step == 'ID' or not write_images or 'image' not in products
             fgs_files_obj = buildfgssteps.BuildFGSSteps(
                 fgs_im_fsw, guider, root, step, out_dir=out_dir_fsw, thresh_factor=thresh_factor,
                 logger_passed=True, guiding_selections_file=guiding_selections_file_fsw,
                 psf_center_file=psf_center_file_fsw, shift_id_attitude=shifted,
-                override_bright_guiding=override_bright_guiding
+                override_bright_guiding=override_bright_guiding, rng=rng, catalog_only=catalog_only,
+                output_profile=output_profile
             )
 
             filename_root = '{}_G{}_{}'.format(root, guider, step)
             fgs_files_obj.filename_root = filename_root
-            if step == 'ID':
+            if 'star' in products:
                 write_files.write_star(fgs_files_obj)
-            if step == 'ACQ1':
+            if step == 'ACQ1' and 'prc' in products:
                 write_files.write_prc(fgs_files_obj)
-            if step != 'ID':
+            if not catalog_only:
                 write_files.write_image(fgs_files_obj)
         LOGGER.info("*** Finished FSW File Writing for Selection #{} ***".format(i + 1))
 
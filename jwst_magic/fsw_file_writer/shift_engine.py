@@ -0,0 +1,206 @@
+"""Shift images to the ID attitude without repeating the spline prefilter
+
+``shift_to_id_attitude`` shifts the same FGS image once per guiding
+configuration. A cubic spline shift first has to compute the spline
+coefficients of the whole image (the "prefilter"), which does not depend
+on the shift. This module keeps the coefficients of the most recently
+shifted images, keyed on a hash of their data, so every configuration
+after the first only pays for the interpolation. The result, including
+its type, is identical to ``scipy.ndimage.shift(image, shift,
+mode='constant', cval=cval, prefilter=True)``.
+
+Integer shifts are done exactly, by slicing, and a Fourier shift is
+available as an alternative to the spline.
+
+Use
+---
+    This module can be used as such:
+    ::
+        from jwst_magic.fsw_file_writer import shift_engine
+        shifted = shift_engine.SHIFT_ENGINE.shift(image, (dy, dx), cval=bkg)
+        stats = shift_engine.SHIFT_ENGINE.stats
+"""
+
+# Standard Library Imports
+from collections import OrderedDict
+import hashlib
+
+# Third Party Imports
+import numpy as np
+from scipy import fft, ndimage
+
+
+class ShiftEngine:
+    """Shift images, re-using the spline coefficients of images that
+    have already been shifted.
+
+    Spline coefficients are stored read-only.
+    """
+    def __init__(self, max_images=2):
+        """Initialize the cache.
+
+        Parameters
+        ----------
+        max_images : int, optional
+            Number of images whose spline coefficients are kept (each
+            is the size of the image, in float64)
+        """
+        self.max_images = max_images
+        self._coefficients = OrderedDict()
+        self.stats = {'prefilter_hits': 0, 'prefilter_misses': 0}
+
+    @staticmethod
+    def image_key(data):
+        """Hash the contents, shape, and type of an image array"""
+        data = np.ascontiguousarray(data)
+        digest = hashlib.sha1(data.view(np.uint8)).hexdigest()
+        return digest, data.shape, data.dtype.str
+
+    def spline_coefficients(self, image, order=3):
+        """Get the spline coefficients of an image, computing them only
+        if they are not already cached.
+
+        Parameters
+        ----------
+        image : 2-D numpy array
+            Image data
+        order : int, optional
+            Order of the spline
+
+        Returns
+        -------
+        coefficients : 2-D numpy array
+            Read-only float64 spline coefficients, as computed by
+            ``scipy.ndimage.spline_filter`` with mode="constant"
+        """
+        key = (self.image_key(image), order)
+        if key in self._coefficients:
+            self._coefficients.move_to_end(key)
+            self.stats['prefilter_hits'] += 1
+            return self._coefficients[key]
+
+        self.stats['prefilter_misses'] += 1
+        coefficients = ndimage.spline_filter(image, order=order, output=np.float64, mode='constant')
+        coefficients.flags.writeable = False
+        self._coefficients[key] = coefficients
+        while len(self._coefficients) > self.max_images:
+            self._coefficients.popitem(last=False)
+        return coefficients
+
+    def shift(self, image, shift, cval=0.0, method='spline', order=3):
+        """Shift an image, filling the pixels shifted in from outside
+        with a constant.
+
+        Parameters
+        ----------
+        image : 2-D numpy array
+            Image data
+        shift : tuple
+            (rows, columns) shift
+        cval : float, optional
+            Value of the pixels shifted in from outside the image
+        method : str, optional
+            "spline" for spline interpolation (as
+            ``scipy.ndimage.shift``), or "fourier" to apply the shift
+            as a phase ramp in Fourier space. Integer shifts are done
+            exactly with either method.
+        order : int, optional
+            Order of the spline, for the "spline" method
+
+        Returns
+        -------
+        shifted_image : 2-D numpy array
+            The shifted image, of the same type as the image if it is
+            floating point, or else float64
+        """
+        if method not in ['spline', 'fourier']:
+            raise ValueError('Unknown shift method {}; use "spline" or "fourier"'.format(method))
+        shift = tuple(float(s) for s in shift)
+
+        if all(s.is_integer() for s in shift):
+            return integer_shift(image, shift, cval)
+        if method == 'fourier':
+            return fourier_shift(image, shift, cval)
+        if order < 2:
+            return ndimage.shift(np.asarray(image, dtype=np.float64), shift, output=output_dtype(image),
+                                 order=order, mode='constant', cval=cval)
+        return ndimage.shift(self.spline_coefficients(image, order), shift, output=output_dtype(image),
+                             order=order, mode='constant', cval=cval, prefilter=False)
+
+    def clear(self):
+        """Empty the cache and reset the statistics"""
+        self._coefficients.clear()
+        for key in self.stats:
+            self.stats[key] = 0
+
+
+def output_dtype(image):
+    """Get the type of a shifted image: that of the image (in native
+    byte order) if it is floating point, as ``scipy.ndimage.shift``
+    returns, or else float64.
+    """
+    dtype = np.asarray(image).dtype
+    if np.issubdtype(dtype, np.floating):
+        return dtype.newbyteorder('=')
+    return np.dtype(np.float64)
+
+
+def integer_shift(image, shift, cval=0.0):
+    """Shift an image by a whole number of pixels.
+
+    Parameters
+    ----------
+    image : 2-D numpy array
+        Image data
+    shift : tuple
+        (rows, columns) shift, in whole pixels
+    cval : float, optional
+        Value of the pixels shifted in from outside the image
+
+    Returns
+    -------
+    shifted_image : 2-D numpy array
+        The shifted image (see ``output_dtype``)
+    """
+    shifted_image = np.full(np.shape(image), cval, dtype=output_dtype(image))
+    source, destination = [], []
+    for n, s in zip(np.shape(image), shift):
+        s = int(s)
+        source.append(slice(max(-s, 0), max(n - s, 0)))
+        destination.append(slice(max(s, 0), max(n + s, 0)))
+    shifted_image[tuple(destination)] = image[tuple(source)]
+    return shifted_image
+
+
+def fourier_shift(image, shift, cval=0.0):
+    """Shift an image by applying a phase ramp to its Fourier transform.
+
+    The image (minus ``cval``) is zero-padded by at least the shift so
+    that nothing wraps around into the result.
+
+    Parameters
+    ----------
+    image : 2-D numpy array
+        Image data
+    shift : tuple
+        (rows, columns) shift
+    cval : float, optional
+        Value of the pixels shifted in from outside the image
+
+    Returns
+    -------
+    shifted_image : 2-D numpy array
+        The shifted image (see ``output_dtype``)
+    """
+    n_rows, n_cols = np.shape(image)
+    shape = [fft.next_fast_len(n + int(np.ceil(abs(s))), real=True) for n, s in zip((n_rows, n_cols), shift)]
+
+    spectrum = fft.rfft2(np.asarray(image, dtype=np.float64) - cval, s=shape)
+    phase = np.exp(-2j * np.pi * fft.fftfreq(shape[0])[:, np.newaxis] * shift[0]) * \
+        np.exp(-2j * np.pi * fft.rfftfreq(shape[1])[np.newaxis, :] * shift[1])
+    shifted_image = fft.irfft2(spectrum * phase, s=shape)[:n_rows, :n_cols]
+    return (shifted_image + cval).astype(output_dtype(image), copy=False)
+
+
+# Engine shared by all shifts in this process
+SHIFT_ENGINE = ShiftEngine()
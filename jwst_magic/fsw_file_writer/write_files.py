@@ -39,6 +39,12 @@ are as follows:
     TRK:
         .fits (to run in DHAS)
 
+Which of these files are written is set by the output profile of the
+object (see ``step_products``): "ground-only" for only the files used
+by the FGSES, "dhas" to also write the files used by the DHAS, "full"
+(the default) for all of the files above, and "debug" to also write the
+raw images (raw.fits) before saturated pixels are cut.
+
 Authors
 -------
     - Keira Brooks
@@ -51,12 +57,18 @@ Use
         from jwst_magic.fsw_file_writer import write_files
         write_files.write_all(obj)
 
+    or, to write the files in a pool of threads:
+    ::
+        with write_files.AsyncWriter() as writer:
+            handle = writer.submit(obj)
+
     Required arguments:
         ``obj`` - FGS simulation object for CAL, ID, ACQ, and/or TRK
             stages; created by ``buildfgssteps.py``
 """
 
 # Standard Library Imports
+import concurrent.futures
 import os
 import logging
 
@@ -65,7 +77,7 @@ from astropy.io import fits
 import numpy as np
 
 # Local Imports
-from jwst_magic.fsw_file_writer import mkproc
+from jwst_magic.fsw_file_writer import mkproc, reference_cache
 from jwst_magic.utils import coordinate_transforms, utils
 
 # Paths
@@ -77,6 +89,40 @@ DATA_PATH = os.path.join(PACKAGE_PATH, 'data')
 # Start logger
 LOGGER = logging.getLogger(__name__)
 
+# Number of values encoded per write when creating .dat files
+DAT_CHUNK_SIZE = 2**20
+
+# Lookup table of the ASCII hex string for every uint16 value
+_HEX_TABLE = None
+
+# Products written for each step, in the order they are written
+STEP_PRODUCTS = {
+    'CAL': ['sky', 'bias', 'cds', 'image', 'raw', 'dat'],
+    'ID': ['sky', 'bias', 'stc', 'cds', 'cat', 'image', 'raw', 'strips', 'prc', 'star', 'dat'],
+    'ACQ1': ['sky', 'bias', 'stc', 'cds', 'cat', 'image', 'raw', 'prc', 'dat'],
+    'ACQ2': ['sky', 'bias', 'stc', 'cds', 'cat', 'image', 'raw', 'dat'],
+    'TRK': ['sky', 'stc', 'bias', 'image', 'raw'],
+    'LOSTRK': ['sky', 'stc', 'image', 'dat'],
+}
+
+# Who each product is for. The .prc files are used by both the DHAS and
+# the FGSES; the ID and LOSTRK images are only for reference at STScI.
+PRODUCT_GROUPS = {'sky': 'stsci', 'bias': 'stsci', 'cds': 'stsci', 'stc': 'stsci', 'cat': 'stsci',
+                  'image': 'dhas', 'strips': 'dhas', 'star': 'dhas',
+                  'prc': 'ground_system', 'dat': 'ground_system',
+                  'raw': 'debug'}
+
+# Groups of products written with each output profile
+OUTPUT_PROFILES = {
+    'ground-only': ['ground_system'],
+    'dhas': ['ground_system', 'dhas'],
+    'full': ['ground_system', 'dhas', 'stsci'],
+    'debug': ['ground_system', 'dhas', 'stsci', 'debug'],
+}
+
+# Products written from the catalog alone, without simulating any images
+CATALOG_PRODUCTS = ['stc', 'cat', 'prc', 'star']
+
 
 def write_all(obj):
     """Create **all** the files and images needed for simulation with
@@ -88,77 +134,258 @@ def write_all(obj):
         FGS simulation object for CAL, ID, ACQ, and/or TRK stages;
         created by ``buildfgssteps.py``
     """
+    for writer in product_writers(obj):
+        writer(obj)
+
+
+def step_products(step, output_profile='full'):
+    """List the products written for a step with an output profile
+
+    Parameters
+    ----------
+    step : str
+        Name of the guider step (CAL, ID, ACQ1, ACQ2, TRK, or LOSTRK)
+    output_profile : str, optional
+        Which files to write: "ground-only" (only the .dat and .prc files
+        for the FGSES), "dhas" (also the images, strips, and .star files
+        for the DHAS), "full" (also the sky, bias, CDS, and catalog files
+        for use at STScI), or "debug" (also the raw images, before
+        saturated pixels are cut)
+
+    Returns
+    -------
+    products : list of str
+        Names of the products, in the order they are written
+
+    Raises
+    ------
+    ValueError
+        Unknown output profile
+    """
+    if output_profile not in OUTPUT_PROFILES:
+        raise ValueError('Unknown output profile {}; use one of {}.'.format(
+            output_profile, ', '.join(OUTPUT_PROFILES)))
+
+    groups = OUTPUT_PROFILES[output_profile]
+    products = []
+    for product in STEP_PRODUCTS.get(step, []):
+        group = PRODUCT_GROUPS[product]
+        if product == 'image' and step in ['ID', 'LOSTRK']:
+            group = 'stsci'
+        if group in groups:
+            products.append(product)
+    return products
+
+
+def product_writers(obj, threshold_files=True):
+    """List the functions that write each of the files for a particular
+    step, in the order ``write_all`` calls them. Also sets the root
+    filename (``obj.filename_root``) they write to.
+
+    Parameters
+    ----------
+    obj : obj
+        FGS simulation object for CAL, ID, ACQ, and/or TRK stages;
+        created by ``buildfgssteps.py``. Only the products in its
+        ``output_profile`` (default "full") are included.
+    threshold_files : bool, optional
+        Include the files that depend on the count rate threshold (the
+        .prc and .star files)
+
+    Returns
+    -------
+    writers : list of functions
+        Functions that each take ``obj`` and write one product
+    """
     # Determine the root filename
     filename_root = '{}_G{}_{}'.format(obj.root, obj.guider, obj.step)
     obj.filename_root = filename_root
 
-    if obj.step == 'CAL':
-        # Write files for use by folks at STScI
-        write_sky(obj)
-        write_bias(obj)
-        write_cds(obj)
-        write_image(obj)
-
-        # Write files for use in the DHAS and FGSES
-        write_dat(obj)
-
-    elif obj.step == 'ID':
-        # Write files for use by folks at STScI
-        write_sky(obj)
-        write_bias(obj)
-        write_stc(obj)
-        write_cds(obj)
-        write_cat(obj)
-        write_image(obj)
-
-        # Write files for use in the DHAS and FGSES
-        write_strips(obj)
-        write_prc(obj)
-        write_star(obj)
-        write_dat(obj)
+    products = step_products(obj.step, getattr(obj, 'output_profile', 'full'))
+    if not threshold_files:
+        products = [product for product in products if product not in ['prc', 'star']]
 
-    elif obj.step == 'ACQ1':
-        # Write files for use by folks at STScI
-        write_sky(obj)
-        write_bias(obj)
-        write_stc(obj)
-        write_cds(obj)
-        write_cat(obj)
-
-        # Write files for use in the DHAS and FGSES
-        write_image(obj)
-        write_prc(obj)
-        write_dat(obj)
-
-    elif obj.step == 'ACQ2':
-        # Write files for use by folks at STScI
-        write_sky(obj)
-        write_bias(obj)
-        write_stc(obj)
-        write_cds(obj)
-        write_cat(obj)
-
-        # Write files for use in the DHAS and FGSES
-        write_image(obj)
-        write_dat(obj)
-
-    elif obj.step == 'TRK':
-        # Write files for use by folks at STScI
-        write_sky(obj)
-        write_bias(obj)
-        write_stc(obj)
-
-        # Write files for use in the DHAS
-        write_image(obj)
+    writers = {'sky': write_sky, 'bias': write_bias, 'cds': write_cds, 'image': write_image,
+               'raw': write_raw, 'strips': write_strips, 'prc': write_prc, 'star': write_star,
+               'dat': write_dat, 'stc': write_stc, 'cat': write_cat}
+    if getattr(obj, 'chunked', False) and 'bias' in products:
+        # Generate the ramps in blocks, streaming the bias (for folks at
+        # STScI) and image (for use in the DHAS) to disk together
+        products = [product for product in products if product != 'image']
+        writers['bias'] = write_ramp_chunks
+    return [writers[product] for product in products]
 
-    elif obj.step == 'LOSTRK':
-        # Write files for use by folks at STScI
-        write_sky(obj)
-        write_stc(obj)
-        write_image(obj)
 
-        # Write files for use in the FGSES
-        write_dat(obj)
+def write_threshold_files(obj):
+    """Rewrite only the files that depend on the count rate threshold
+    (the .prc and .star files, if in the output profile), e.g. after the
+    threshold factor has been raised to match the other guiding
+    configurations.
+
+    Parameters
+    ----------
+    obj : obj
+        FGS simulation object for CAL, ID, ACQ, and/or TRK stages;
+        created by ``buildfgssteps.py``
+    """
+    for writer in product_writers(obj):
+        if writer in [write_prc, write_star]:
+            writer(obj)
+
+
+class WriteHandle(object):
+    """Completion handle for the files of one step queued on an
+    ``AsyncWriter``
+    """
+    def __init__(self, obj, futures):
+        """
+        Parameters
+        ----------
+        obj : obj
+            FGS simulation object whose files are being written
+        futures : list of tuples
+            (product name, ``concurrent.futures.Future``) for each file
+        """
+        self.obj = obj
+        self.futures = futures
+
+    def done(self):
+        """Whether every file has finished writing (or failed)"""
+        return all(future.done() for _, future in self.futures)
+
+    def wait(self, timeout=None):
+        """Block until every file has finished writing, then raise the
+        error of the first product that failed, if any.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum number of seconds to wait
+
+        Raises
+        ------
+        concurrent.futures.TimeoutError
+            If the files are not all written within ``timeout`` seconds
+        """
+        _, not_done = concurrent.futures.wait([future for _, future in self.futures], timeout=timeout)
+        if not_done:
+            raise concurrent.futures.TimeoutError(
+                'Write Files: {} of the {} files were not written within {} s'.format(
+                    len(not_done), self.obj.filename_root, timeout))
+
+        for name, future in self.futures:
+            error = future.exception()
+            if error is not None:
+                LOGGER.error('Write Files: Failed to write {} for {}'.format(name, self.obj.filename_root))
+                raise error
+
+
+class AsyncWriter(object):
+    """Write the files for each step in a pool of threads, so the next
+    step can be built while the previous step's files are being written.
+
+    Each product is queued as its own job, so the large FITS and .dat
+    files are written in parallel with each other and with the main
+    thread. The arrays of an object must not be modified until its
+    handle is done.
+
+    Use as a context manager; on exit, waits for all the queued files
+    and raises the first error.
+    ::
+        with write_files.AsyncWriter() as writer:
+            for obj in objs:
+                writer.submit(obj)
+    """
+    def __init__(self, max_workers=4):
+        """
+        Parameters
+        ----------
+        max_workers : int, optional
+            Number of files written at the same time
+        """
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.handles = []
+
+    def submit(self, obj, threshold_files=True):
+        """Queue all the files for a particular step
+
+        Parameters
+        ----------
+        obj : obj
+            FGS simulation object for CAL, ID, ACQ, and/or TRK stages;
+            created by ``buildfgssteps.py``
+        threshold_files : bool, optional
+            Also write the files that depend on the count rate threshold
+            (the .prc and .star files). If False, write them later with
+            ``submit_threshold_files``.
+
+        Returns
+        -------
+        handle : WriteHandle
+            Completion handle for the queued files
+        """
+        return self._submit(obj, product_writers(obj, threshold_files=threshold_files))
+
+    def submit_threshold_files(self, obj):
+        """Queue the files that depend on the count rate threshold (the
+        .prc and .star files) for a particular step
+
+        Parameters
+        ----------
+        obj : obj
+            FGS simulation object for CAL, ID, ACQ, and/or TRK stages;
+            created by ``buildfgssteps.py``
+
+        Returns
+        -------
+        handle : WriteHandle
+            Completion handle for the queued files
+        """
+        writers = [writer for writer in product_writers(obj) if writer in [write_prc, write_star]]
+        return self._submit(obj, writers)
+
+    def _submit(self, obj, writers):
+        futures = [(writer.__name__, self._executor.submit(writer, obj)) for writer in writers]
+        handle = WriteHandle(obj, futures)
+        self.handles.append(handle)
+        return handle
+
+    def wait(self):
+        """Block until every queued file has been written, then raise
+        the first error, if any
+        """
+        # Let every file finish before raising, so none is left half-written
+        concurrent.futures.wait([future for handle in self.handles for _, future in handle.futures])
+        for handle in self.handles:
+            handle.wait()
+
+    def close(self, wait=True):
+        """Shut down the pool of threads
+
+        Parameters
+        ----------
+        wait : bool, optional
+            Wait for the queued files (raising the first error); if
+            False, files that have not started are cancelled
+        """
+        if wait:
+            try:
+                self.wait()
+            finally:
+                self._executor.shutdown(wait=True)
+        else:
+            for handle in self.handles:
+                for _, future in handle.futures:
+                    future.cancel()
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Don't hide an error raised in the with block behind a write error
+        self.close(wait=exc_type is None)
+        return False
 
 
 def write_sky(obj):
@@ -229,6 +456,9 @@ def write_image(obj):
         FGS simulation object for CAL, ID, ACQ, and/or TRK stages;
         created by ``buildfgssteps.py``
     """
+    if getattr(obj, 'chunked', False):
+        write_ramp_chunks(obj, bias=False)
+        return
 
     if obj.step == 'ID':
         # Create "full-frame" (rather than strips) image
@@ -243,17 +473,78 @@ def write_image(obj):
         location = obj.dhas_dir
         filetype = '.fits'
 
-    # Cut any pixels over saturation or under zero
-    image = utils.correct_image(obj.image, upper_threshold=65535, upper_limit=65535)
+    # Cut any pixels over saturation or under zero, and convert to uint16
+    # (except for LOSTRK)
+    image = utils.correct_and_cast(obj.image, 65535, dtype=None if obj.step == 'LOSTRK' else np.uint16)
 
     # Create image fits file
     filename = os.path.join(obj.out_dir, location,
                             obj.filename_root + filetype)
+    utils.write_fits(filename, image, log=LOGGER)
+
+
+def write_raw(obj):
+    """Write the image before saturated pixels are cut and it is
+    converted to uint16, for debugging
+
+    Units:  counts
+    Size:   n_cols x n_rows x (n_reads x n_ramps)
+
+    Parameters
+    ----------
+    obj : obj
+        FGS simulation object for CAL, ID, ACQ, and/or TRK stages;
+        created by ``buildfgssteps.py``
+    """
+    if obj.image is None:
+        # Chunked TRK images are never held in memory
+        LOGGER.info('Write Files: No raw {} image to write'.format(obj.step))
+        return
+
+    filename_raw = os.path.join(obj.out_dir, obj.stsci_dir,
+                                obj.filename_root + 'raw.fits')
+    utils.write_fits(filename_raw, np.float32(obj.image), log=LOGGER)
 
-    if obj.step == 'LOSTRK':
-        utils.write_fits(filename, image, log=LOGGER) # Don't make it np.uint16
-    else:
-        utils.write_fits(filename, np.uint16(image), log=LOGGER)
+
+def write_ramp_chunks(obj, bias=True, image=True):
+    """Generate the reads of a chunked (TRK) step block by block and
+    stream the bias and/or image cubes to their FITS files as they are
+    made, so the full cubes are never held in memory.
+
+    Units:  counts
+    Size:   n_cols x n_rows x (n_reads x n_ramps)
+
+    Parameters
+    ----------
+    obj : obj
+        FGS simulation object created by ``buildfgssteps.py`` with
+        ``trk_chunk_size`` set
+    bias : bool, optional
+        Write the bias image
+    image : bool, optional
+        Write the (DHAS) image
+    """
+    shape = (obj.nramps * obj.nreads,) + np.shape(obj.input_im)
+
+    bias_writer = None
+    image_writer = None
+    if bias:
+        filename_bias = os.path.join(obj.out_dir, obj.stsci_dir, obj.filename_root + 'bias.fits')
+        bias_writer = utils.FitsCubeWriter(filename_bias, shape, np.uint16)
+    if image:
+        filename_image = os.path.join(obj.out_dir, obj.dhas_dir, obj.filename_root + '.fits')
+        image_writer = utils.FitsCubeWriter(filename_image, shape, np.uint16)
+
+    for bias_chunk, image_chunk in obj.iter_ramp_chunks():
+        if bias_writer is not None:
+            bias_writer.write(bias_chunk)
+        if image_writer is not None:
+            # Cut any pixels over saturation or under zero
+            image_writer.write(utils.correct_and_cast(image_chunk, 65535, dtype=np.uint16))
+
+    for writer in [bias_writer, image_writer]:
+        if writer is not None:
+            writer.close(log=LOGGER)
 
 
 def write_strips(obj):
@@ -276,13 +567,21 @@ def write_strips(obj):
     # Write to strips to fits file
     filename_hdr = os.path.join(DATA_PATH,
                                 'header_g{}.fits'.format(obj.guider))
-    hdr0 = fits.getheader(filename_hdr, ext=0)
+    hdr0 = reference_cache.get_fits_header(filename_hdr)
 
-    strips = utils.correct_image(obj.strips, upper_threshold=65535, upper_limit=65535)
-    utils.write_fits(filename_id_strips, np.uint16(strips), header=hdr0,
+    utils.write_fits(filename_id_strips, _strips_to_uint16(obj.strips), header=hdr0,
                      log=LOGGER)
 
 
+def _strips_to_uint16(strips):
+    """Get ID strips (a ``buildfgssteps.Strips`` view or an array) as
+    a uint16 array, with negative and non-finite pixels set to 0 and
+    saturated pixels to 65535"""
+    if hasattr(strips, 'to_uint16'):
+        return strips.to_uint16()
+    return utils.correct_and_cast(strips, 65535, dtype=np.uint16)
+
+
 def write_star(obj):
     """Write a star (.star) file for use with file software
     Should only be used for ID case.
@@ -390,34 +689,72 @@ def write_dat(obj):
         filename = '{}_G{}_{}.dat'.format(obj.root, obj.guider, obsmode)
     filename = os.path.join(out_dir, filename)
 
-    # Cut any pixels over saturation or under zero
-    data = utils.correct_image(data, upper_threshold=65535, upper_limit=65535)
-    flat = data.flatten()
-
     # Write out TRK/LOSTRK files in ASCII float format
     if (obsmode == 'PSF') or (obsmode == 'TRK') or (obsmode == 'LOSTRK'):
-        # ascii float format
-        fmt = '{:16.7e} '
-        with open(filename, 'w') as file_out:
-            for dat in flat:  # Note: NOT saving out as uint16!!!
-                file_out.write(fmt.format(dat))
+        encode = encode_dat_float  # Note: NOT saving out as uint16!!!
+        dtype = None
 
     # Write out all other files in ASCII hex format (from uint16)
     elif (obsmode == 'ID') or (obsmode == 'ACQ1') or (obsmode == 'ACQ2') or \
          (obsmode == 'ACQ') or (obsmode == 'CAL'):
-        # ascii hex dat format
-        fmt = '{:04X} '
-        with open(filename, 'w') as file_out:
-            for dat in flat.astype(np.uint16):
-                file_out.write(fmt.format(dat))
+        encode = encode_dat_hex
+        dtype = np.uint16
 
     else:
         raise ValueError("FSW File Writing: Observation mode {} not recognized.".format(obsmode))
 
+    # Cut any pixels over saturation or under zero
+    if obsmode == 'ID':
+        data = _strips_to_uint16(data)
+    else:
+        data = utils.correct_and_cast(data, 65535, dtype=dtype)
+    flat = data.ravel()
+
+    with open(filename, 'wb') as file_out:
+        for i in range(0, len(flat), DAT_CHUNK_SIZE):
+            file_out.write(encode(flat[i:i + DAT_CHUNK_SIZE]))
+
     LOGGER.info("Successfully wrote: {}".format(filename))
     return
 
 
+def encode_dat_hex(values):
+    """Encode uint16 values as ground system ASCII hex (e.g. "01AF ")
+
+    Parameters
+    ----------
+    values : 1-D numpy array
+        Values to encode, as uint16
+
+    Returns
+    -------
+    bytes
+        The encoded values, each followed by a space
+    """
+    global _HEX_TABLE
+    if _HEX_TABLE is None:
+        _HEX_TABLE = np.array(['{:04X} '.format(i) for i in range(2**16)], dtype='S5')
+
+    return _HEX_TABLE[values].tobytes()
+
+
+def encode_dat_float(values):
+    """Encode values as ground system ASCII floats (e.g. "   1.2345670e+02 ")
+
+    Parameters
+    ----------
+    values : 1-D numpy array
+        Values to encode
+
+    Returns
+    -------
+    bytes
+        The encoded values, each followed by a space
+    """
+    values = values.tolist()
+    return (('%16.7e ' * len(values)) % tuple(values)).encode('ascii')
+
+
 def write_stc(obj):
     """
     Write out stc files using offset, rotated catalog
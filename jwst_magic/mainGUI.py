@@ -75,6 +75,7 @@ from jwst_magic import run_magic
 from jwst_magic.convert_image import renormalize, background_stars_GUI
 from jwst_magic.fsw_file_writer import rewrite_prc
 from jwst_magic.segment_guiding import segment_guiding
+from jwst_magic.startup_checks import check_setup
 from jwst_magic.star_selector.SelectStarsGUI import StarClickerMatplotlibCanvas, run_SelectStars
 from jwst_magic.utils import utils
 
@@ -429,6 +430,7 @@ class MainGui(QMainWindow):
         convert_im = True
         nircam = self.radioButton_NIRCam.isChecked()
         nircam_det = str(self.comboBox_detector.currentText())
+        undistort_method = self.comboBox_undistort.currentText()
         normalize = self.checkBox_normalize.isChecked()
         norm_unit = self.comboBox_normalize.currentText()
         try:
@@ -525,6 +527,9 @@ class MainGui(QMainWindow):
             raise ValueError('Cannot use Default OSS Numbers and overwrite the bright guiding functionality '
                              'at the same time. Please check only one, or neither, button.')
 
+        # Which FSW files to write
+        output_profile = self.comboBox_outputProfile.currentText()
+
         # Rewrite .prc and guiding_selections*.txt ONLY
         if self.checkBox_rewritePRC.isChecked():
             # If use_oss_numbers if also checked, raise an error (needs catalog countrate information)
@@ -564,7 +569,8 @@ class MainGui(QMainWindow):
             threshold_factor = float(self.lineEdit_threshold.text())
             rewrite_prc.rewrite_prc(inds_list, center_of_pointing, guider, root, out_dir,
                                     thresh_factor=threshold_factor, shifted=shift_id_attitude,
-                                    override_bright_guiding=override_bright_guiding)
+                                    override_bright_guiding=override_bright_guiding,
+                                    output_profile=output_profile)
 
             # Update converted image preview
             self.update_filepreview(new_guiding_selections=True)
@@ -709,6 +715,8 @@ class MainGui(QMainWindow):
                                                  thresh_factor=threshold,
                                                  use_oss_defaults=use_oss_defaults,
                                                  override_bright_guiding=override_bright_guiding,
+                                                 output_profile=output_profile,
+                                                 undistort_method=undistort_method,
                                                  logger_passed=LOGGER,
                                                  log_filename=self.log_filename
                                                  )
@@ -1935,6 +1943,10 @@ def run_MainGui(root=None, norm_value=12.0, norm_unit="FGS Magnitude", nircam_de
                   bkgd_stars=False, out_dir=OUT_PATH, convert_im=True,
                   star_selection=True, star_selection_gui=True, file_writer=True,
                   segment_guiding=False, itm=False):
+    # Make sure the software and reference files are up to date (cached
+    # and time-limited, so this doesn't hold up the GUI for long)
+    check_setup()
+
     # RUN GUI
     app = QtCore.QCoreApplication.instance()  # Use existing instance, if there is one
     if app is None:
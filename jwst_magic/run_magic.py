@@ -35,7 +35,10 @@ Use
 """
 
 # Standard Library Imports
+from concurrent.futures import ProcessPoolExecutor
 import logging
+import logging.handlers
+import multiprocessing
 import os
 import shutil
 
@@ -47,6 +50,7 @@ print('Using backend: ', matplotlib.get_backend())
 import numpy as np
 
 # Local Imports
+from jwst_magic import startup_checks
 from jwst_magic.convert_image import background_stars, convert_image_to_raw_fgs, renormalize
 from jwst_magic.fsw_file_writer import buildfgssteps, write_files
 from jwst_magic.star_selector import select_psfs
@@ -67,7 +71,9 @@ def run_all(image, guider, root=None, norm_value=None, norm_unit=None,
             star_selection=True, file_writer=True, mainGUIapp=None, copy_original=True,
             normalize=True, coarse_pointing=False, jitter_rate_arcsec=None, itm=False,
             shift_id_attitude=True, thresh_factor=0.6, use_oss_defaults=False, override_bright_guiding=False,
-            logger_passed=False, log_filename=None):
+            logger_passed=False, log_filename=None, trk_nramps=None, trk_chunk_size=None,
+            n_workers=None, seed=None, use_conversion_cache=True, convert_both_guiders=False,
+            output_profile='full', undistort_method='pipeline'):
     """
     This function will take any FGS or NIRCam image and create the outputs needed
     to run the image through the DHAS or other FGS FSW simulator. If no incat or
@@ -145,6 +151,35 @@ def run_all(image, guider, root=None, norm_value=None, norm_unit=None,
         Denotes if a logger object has already been generated.
     log_filename : str, optional
         File name for logger object, used to go into pseudo-FGS image header
+    trk_nramps : int, optional
+        Number of TRK ramps to simulate, if different from the config file
+    trk_chunk_size : int, optional
+        If set, generate the TRK ramps in blocks of this many ramps and
+        stream them to disk, rather than building the whole TRK cube at once
+    n_workers : int, optional
+        If greater than 1, build and write the FSW files for each guiding
+        config and step in a pool of this many processes
+    seed : int, optional
+        Seed for the detector noise. Each config/step gets its own
+        random number stream spawned from this seed, so runs are
+        reproducible whether or not they are done in parallel
+    use_conversion_cache : bool, optional
+        Re-use the converted image from an earlier run with the same
+        input file and conversion parameters (see
+        ``convert_image.conversion_cache``)? Set to False to always
+        convert the image.
+    convert_both_guiders : bool, optional
+        Also convert the image for the other guider, sharing the
+        guider-independent conversion steps (see
+        ``convert_image_to_raw_fgs.convert_im_multi``), and write that
+        FGS image too. The rest of the run is only done for ``guider``.
+    output_profile : str, optional
+        Which FSW files to write: "ground-only", "dhas", "full", or
+        "debug" (see ``write_files.step_products``). Images that are
+        only used by files outside the profile are not simulated.
+    undistort_method : str, optional
+        How to remove the distortion from cal images: "pipeline",
+        "siaf", or "compare" (see ``convert_image_to_raw_fgs.convert_im``)
     """
 
     # Determine filename root
@@ -163,6 +198,11 @@ def run_all(image, guider, root=None, norm_value=None, norm_unit=None,
     LOGGER.info("All data will be saved in: {}".format(out_dir_root))
     LOGGER.info("Input image: {}".format(os.path.abspath(image)))
 
+    # Make sure the bad pixel masks and bias files exist (and are not still
+    # being downloaded) before they are used
+    if convert_im or file_writer:
+        startup_checks.require_references()
+
     # Copy input image into out directory
     if copy_original:
         try:
@@ -172,20 +212,33 @@ def run_all(image, guider, root=None, norm_value=None, norm_unit=None,
 
     # Either convert provided NIRCam image to an FGS image...
     if convert_im:
-        fgs_im, all_found_psfs_file, psf_center_file, fgs_hdr_dict = \
-            convert_image_to_raw_fgs.convert_im(image, guider, root,
-                                                out_dir=out_dir,
-                                                nircam=nircam,
-                                                nircam_det=nircam_det,
-                                                normalize=normalize,
-                                                norm_value=norm_value,
-                                                norm_unit=norm_unit,
-                                                smoothing=smoothing,
-                                                detection_threshold=detection_threshold,
-                                                coarse_pointing=coarse_pointing,
-                                                jitter_rate_arcsec=jitter_rate_arcsec,
-                                                logger_passed=True,
-                                                itm=itm)
+        conversion_kwargs = dict(out_dir=out_dir,
+                                 nircam=nircam,
+                                 nircam_det=nircam_det,
+                                 normalize=normalize,
+                                 norm_value=norm_value,
+                                 norm_unit=norm_unit,
+                                 smoothing=smoothing,
+                                 detection_threshold=detection_threshold,
+                                 coarse_pointing=coarse_pointing,
+                                 jitter_rate_arcsec=jitter_rate_arcsec,
+                                 logger_passed=True,
+                                 itm=itm,
+                                 undistort_method=undistort_method,
+                                 use_cache=use_conversion_cache)
+        if convert_both_guiders:
+            other_guider = 2 if guider == 1 else 1
+            conversions = convert_image_to_raw_fgs.convert_im_multi(image, [guider, other_guider], root,
+                                                                    **conversion_kwargs)
+            fgs_im, all_found_psfs_file, psf_center_file, fgs_hdr_dict = conversions[guider]
+
+            # Write the other guider's converted image
+            other_fgs_im, _, _, other_fgs_hdr_dict = conversions[other_guider]
+            other_fgs_hdr_dict['LOG_FILE'] = (os.path.basename(log_filename), 'Log filename')
+            convert_image_to_raw_fgs.write_fgs_im(other_fgs_im, out_dir, root, other_guider, other_fgs_hdr_dict)
+        else:
+            fgs_im, all_found_psfs_file, psf_center_file, fgs_hdr_dict = \
+                convert_image_to_raw_fgs.convert_im(image, guider, root, **conversion_kwargs)
 
         # Add logging information to fgs image header
         fgs_hdr_dict['LOG_FILE'] = (os.path.basename(log_filename), 'Log filename')
@@ -241,36 +294,49 @@ def run_all(image, guider, root=None, norm_value=None, norm_unit=None,
         if steps is None:
             steps = ['ID', 'ACQ1', 'ACQ2', 'LOSTRK']
 
-        threshold_factor_per_config = []
-        fgs_files_objs = [] #np.empty((len(guiding_selections_path_list), len(steps)))
-        for i, guiding_selections_file in enumerate(guiding_selections_path_list):
-            # Change out_dir to write data to guiding_config_#/ sub-directory next to the selections file
-            if 'guiding_config' in guiding_selections_file:
-                out_dir_fsw = os.path.join(out_dir, 'guiding_config_{}'.format(
-                    guiding_selections_file.split('guiding_config_')[1].split('/')[0]))
-            else:
-                out_dir_fsw = out_dir
-
-            if shift_id_attitude:
-                fgs_im_fsw, guiding_selections_file_fsw, psf_center_file_fsw = buildfgssteps.shift_to_id_attitude(
-                    fgs_im, root, guider, out_dir_fsw, guiding_selections_file=guiding_selections_file,
-                    all_found_psfs_file=all_found_psfs, center_pointing_file=center_pointing_file,
-                    psf_center_file=psf_center_file, logger_passed=True)
-            else:
-                fgs_im_fsw = fgs_im
-                guiding_selections_file_fsw = guiding_selections_file
-                psf_center_file_fsw = psf_center_file
-
-            for j, step in enumerate(steps):
-                fgs_files_obj = buildfgssteps.BuildFGSSteps(
-                    fgs_im_fsw, guider, root, step, out_dir=out_dir_fsw, thresh_factor=thresh_factor,
-                    logger_passed=True, guiding_selections_file=guiding_selections_file_fsw,
-                    psf_center_file=psf_center_file_fsw, shift_id_attitude=shift_id_attitude,
-                    use_oss_defaults=use_oss_defaults, catalog_countrate=fgs_countrate,
-                    override_bright_guiding=override_bright_guiding
-                )
-                threshold_factor_per_config.append(fgs_files_obj.thresh_factor)
-                fgs_files_objs.append(fgs_files_obj)
+        shift_kwargs = dict(all_found_psfs_file=all_found_psfs, center_pointing_file=center_pointing_file,
+                            psf_center_file=psf_center_file)
+        build_kwargs = dict(thresh_factor=thresh_factor, shift_id_attitude=shift_id_attitude,
+                            use_oss_defaults=use_oss_defaults, catalog_countrate=fgs_countrate,
+                            override_bright_guiding=override_bright_guiding, trk_nramps=trk_nramps,
+                            trk_chunk_size=trk_chunk_size, output_profile=output_profile)
+        out_dirs_fsw = [_get_config_out_dir(out_dir, guiding_selections_file)
+                        for guiding_selections_file in guiding_selections_path_list]
+
+        # Give every config/step job its own random number stream so the noise
+        # realizations don't depend on the order (or the process) in which jobs are run
+        job_rngs = [rng for config_rngs in utils.spawn_rngs(seed, len(guiding_selections_path_list), len(steps))
+                    for rng in config_rngs]
+
+        if n_workers is not None and n_workers > 1:
+            # Build and write every config/step in a pool of processes. The
+            # files are written with each config's own threshold, and the
+            # threshold-dependent files are rewritten below if needed.
+            fgs_files_objs = _run_fsw_jobs_parallel(fgs_im, root, guider, guiding_selections_path_list,
+                                                    out_dirs_fsw, steps, job_rngs, n_workers,
+                                                    shift_id_attitude, shift_kwargs, build_kwargs)
+        else:
+            # Write each step's files in a pool of threads while the next
+            # step is built; the threshold-dependent files are written below,
+            # once the threshold factor shared by all configs is known
+            fgs_files_objs = []
+            k = 0
+            with write_files.AsyncWriter() as writer:
+                for guiding_selections_file, out_dir_fsw in zip(guiding_selections_path_list, out_dirs_fsw):
+                    fgs_im_fsw, guiding_selections_file_fsw, psf_center_file_fsw = _shift_config(
+                        fgs_im, root, guider, out_dir_fsw, guiding_selections_file, shift_id_attitude,
+                        shift_kwargs)
+
+                    for step in steps:
+                        fgs_files_obj = buildfgssteps.BuildFGSSteps(
+                            fgs_im_fsw, guider, root, step, out_dir=out_dir_fsw, logger_passed=True,
+                            guiding_selections_file=guiding_selections_file_fsw,
+                            psf_center_file=psf_center_file_fsw, rng=job_rngs[k], **build_kwargs
+                        )
+                        writer.submit(fgs_files_obj, threshold_files=False)
+                        fgs_files_objs.append(fgs_files_obj)
+                        k += 1
+        threshold_factor_per_config = [obj.thresh_factor for obj in fgs_files_objs]
 
         # Loop through thresholds for multiple configs and pick largest
         try:
@@ -288,9 +354,14 @@ def run_all(image, guider, root=None, norm_value=None, norm_unit=None,
                 fgs_files_obj = fgs_files_objs[k]
                 # For cases where the threshold factor is allowed to change from one config to the next
                 if (not use_oss_defaults) or (not override_bright_guiding):
+                    changed = fgs_files_obj.thresh_factor != max_thresh_factor
                     fgs_files_obj.threshold = max_thresh_factor * fgs_files_obj.countrate
                     fgs_files_obj.thresh_factor = max_thresh_factor
-                write_files.write_all(fgs_files_obj)
+                else:
+                    changed = False
+
+                if changed or n_workers is None or n_workers <= 1:
+                    write_files.write_threshold_files(fgs_files_obj)
                 k += 1
             LOGGER.info(f"*** Finished FSW File Writing for Selection #{i+1} ***")
 
@@ -301,3 +372,102 @@ def run_all(image, guider, root=None, norm_value=None, norm_unit=None,
         return max_thresh_factor
     except UnboundLocalError:
         return None
+
+
+def _get_config_out_dir(out_dir, guiding_selections_file):
+    """Change out_dir to write data to guiding_config_#/ sub-directory
+    next to the selections file
+    """
+    if 'guiding_config' in guiding_selections_file:
+        return os.path.join(out_dir, 'guiding_config_{}'.format(
+            guiding_selections_file.split('guiding_config_')[1].split('/')[0]))
+    return out_dir
+
+
+def _shift_config(fgs_im, root, guider, out_dir_fsw, guiding_selections_file, shift_id_attitude,
+                  shift_kwargs):
+    """Shift the image and write out new fgs_im, guiding_selections,
+    all_found_psfs, and psf_center files for one guiding config
+    """
+    if shift_id_attitude:
+        return buildfgssteps.shift_to_id_attitude(
+            fgs_im, root, guider, out_dir_fsw, guiding_selections_file=guiding_selections_file,
+            logger_passed=True, **shift_kwargs)
+    return fgs_im, guiding_selections_file, shift_kwargs['psf_center_file']
+
+
+def _build_and_write_step(fgs_im_fsw, guider, root, step, out_dir_fsw, guiding_selections_file_fsw,
+                          psf_center_file_fsw, job_rng, build_kwargs):
+    """Build and write the FSW files for one config/step in a worker
+    process, returning the object without its image arrays
+    """
+    fgs_files_obj = buildfgssteps.BuildFGSSteps(
+        fgs_im_fsw, guider, root, step, out_dir=out_dir_fsw, logger_passed=True,
+        guiding_selections_file=guiding_selections_file_fsw,
+        psf_center_file=psf_center_file_fsw, rng=job_rng, **build_kwargs
+    )
+    # Use the same form of the threshold as when the factor is shared
+    # between configs, so that only a changed factor needs a rewrite
+    if (not build_kwargs['use_oss_defaults']) or (not build_kwargs['override_bright_guiding']):
+        fgs_files_obj.threshold = fgs_files_obj.thresh_factor * fgs_files_obj.countrate
+    write_files.write_all(fgs_files_obj)
+    fgs_files_obj.drop_arrays()
+
+    return fgs_files_obj
+
+
+def _run_fsw_jobs_parallel(fgs_im, root, guider, guiding_selections_path_list, out_dirs_fsw, steps,
+                           job_rngs, n_workers, shift_id_attitude, shift_kwargs, build_kwargs):
+    """Shift each guiding config, then build and write every config/step
+    in a pool of ``n_workers`` processes. Log records from the workers
+    are sent back to this process and handled by the usual loggers.
+    """
+    manager = multiprocessing.Manager()
+    log_queue = manager.Queue()
+    listener = logging.handlers.QueueListener(log_queue, _LogRecordDispatcher())
+    listener.start()
+    level = logging.getLogger('jwst_magic').getEffectiveLevel()
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker_logging,
+                                 initargs=(log_queue, level)) as executor:
+            shift_futures = [executor.submit(_shift_config, fgs_im, root, guider, out_dir_fsw,
+                                             guiding_selections_file, shift_id_attitude, shift_kwargs)
+                             for guiding_selections_file, out_dir_fsw in zip(guiding_selections_path_list,
+                                                                             out_dirs_fsw)]
+
+            # Start each config's steps as soon as its shifted files exist
+            step_futures = []
+            k = 0
+            for shift_future, out_dir_fsw in zip(shift_futures, out_dirs_fsw):
+                fgs_im_fsw, guiding_selections_file_fsw, psf_center_file_fsw = shift_future.result()
+                for step in steps:
+                    step_futures.append(executor.submit(
+                        _build_and_write_step, fgs_im_fsw, guider, root, step, out_dir_fsw,
+                        guiding_selections_file_fsw, psf_center_file_fsw, job_rngs[k], build_kwargs))
+                    k += 1
+
+            fgs_files_objs = [future.result() for future in step_futures]
+    finally:
+        listener.stop()
+        manager.shutdown()
+
+    return fgs_files_objs
+
+
+def _init_worker_logging(log_queue, level):
+    """Send all log records from a worker process to ``log_queue``"""
+    handler = logging.handlers.QueueHandler(log_queue)
+    for name in [None, 'jwst_magic']:
+        logger = logging.getLogger(name)
+        logger.handlers = [handler]
+        logger.setLevel(level)
+    logging.getLogger('jwst_magic').propagate = False
+
+
+class _LogRecordDispatcher(object):
+    """Hand log records received from worker processes to the logger
+    they were emitted from, in this process
+    """
+    def handle(self, record):
+        logging.getLogger(record.name).handle(record)
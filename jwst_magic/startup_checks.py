@@ -0,0 +1,318 @@
+"""Check that MAGIC, FGS Countrate, and the reference files are up to date
+
+These checks query GitHub (for the latest MAGIC and FGS Countrate tags)
+and CRDS (for the latest bad pixel masks and bias files), so they are
+not run when ``jwst_magic`` is imported. Instead they are run when the
+GUI is launched or on request. Each check is limited to ``timeout``
+seconds, and the results of a complete set of checks are cached for
+``max_age`` seconds, so repeated launches don't wait on the network.
+
+Use
+---
+    This module can be used as such:
+    ::
+        import jwst_magic
+        jwst_magic.check_setup()
+
+    or from the command line:
+    ::
+        python -m jwst_magic.startup_checks
+
+    Optional arguments:
+        ``timeout`` - maximum time (seconds) to spend on each check
+        ``max_age`` - re-use the results of the last complete set of
+            checks if they are younger than this (seconds)
+        ``force`` - run the checks even if there are cached results
+"""
+
+# Standard Library Imports
+import importlib.util
+import json
+import os
+import socket
+import subprocess
+import threading
+import time
+
+# Local Imports
+from jwst_magic import __version__, module_path
+
+# Paths
+DATA_PATH = os.path.join(module_path, 'data')
+CHECK_CACHE_FILE = os.path.join(DATA_PATH, 'startup_checks.json')
+
+# Default limits
+DEFAULT_TIMEOUT = 20  # seconds, per check
+DEFAULT_MAX_AGE = 24 * 60 * 60  # seconds
+
+REFERENCE_WARNING = ('Warning: Cannot check for newest reference files. See solutions '
+                     'https://github.com/spacetelescope/jwst_magic#running-the-tools')
+
+# (thread, errors) of the latest reference file check, which may still be
+# running after check_references has timed out
+_reference_sync = None
+
+
+def check_setup(timeout=DEFAULT_TIMEOUT, max_age=DEFAULT_MAX_AGE, force=False):
+    """Check that the MAGIC and FGS Countrate packages and the reference
+    files are up to date, printing the results.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Maximum time (seconds) to spend on each check
+    max_age : float, optional
+        If the last complete set of checks was run less than this many
+        seconds ago, print its results rather than checking again
+    force : bool, optional
+        Run the checks even if there are recent cached results
+
+    Returns
+    -------
+    messages : list of str
+        The results of the checks
+    """
+    if not force:
+        cache = read_check_cache()
+        if cache is not None and time.time() - cache['time'] < max_age:
+            for message in cache['messages']:
+                print(message)
+            return cache['messages']
+
+    version_messages, versions_complete = check_versions(timeout)
+    reference_messages, references_complete = check_references(timeout, force=force)
+    messages = version_messages + reference_messages
+
+    # Only cache results that weren't cut short (e.g. by a lack of network)
+    if versions_complete and references_complete:
+        write_check_cache(messages)
+
+    return messages
+
+
+def check_versions(timeout=DEFAULT_TIMEOUT):
+    """Check if the MAGIC and FGS Countrate versions match the latest
+    versions online.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Maximum time (seconds) to wait for each package's online tags
+
+    Returns
+    -------
+    messages : list of str
+        The results of the checks
+    complete : bool
+        Whether both versions could be checked
+    """
+    messages = []
+    complete = True
+
+    if "sogs" in socket.gethostname():
+        # The SOGS case cannot be checked due to network access on SOGS machines
+        messages += ["Your MAGIC package is up to date",
+                     "Your FGS Countrate package is up to date"]
+        for message in messages:
+            print(message)
+        return messages, complete
+
+    magic_path = module_path.split('/jwst_magic')[0] + '/jwst_magic'
+    packages = [('MAGIC', magic_path, 'git@github.com:spacetelescope/jwst_magic.git', __version__)]
+
+    cr_spec = importlib.util.find_spec('fgscountrate')
+    if cr_spec is None:
+        messages.append('FGS COUNTRATE version status cannot be checked: the package is not installed')
+        complete = False
+    else:
+        import pkg_resources
+        cr_path = cr_spec.origin.split('fgscountrate/')[0]
+        cr_version = pkg_resources.get_distribution("fgscountrate").version
+        packages.append(('FGS COUNTRATE', cr_path, 'git@github.com:spacetelescope/jwst-fgs-countrate.git',
+                         cr_version))
+
+    # Never prompt for credentials, and give up on unreachable hosts
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0',
+               GIT_SSH_COMMAND=f'ssh -o BatchMode=yes -o ConnectTimeout={int(max(timeout, 1))}')
+    for name, path, ssh, version in packages:
+        cmd = ['git', f'--git-dir={path}.git', 'ls-remote', '--tags', ssh]
+        try:
+            p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+                               timeout=timeout)
+            stdout, stderr = p.stdout.decode('utf-8'), p.stderr.decode('utf-8')
+        except subprocess.TimeoutExpired:
+            stdout, stderr = '', f'timed out after {timeout} seconds'
+        except OSError as e:
+            stdout, stderr = '', str(e)
+
+        if stdout != '':
+            tag_list = stdout.strip()
+            latest_remote_version = tag_list.split('\n')[-1].split('tags/')[-1]
+            latest_remote_version = latest_remote_version.replace('^{}', '')  # remove ^{} from tag if tag was updated
+
+            if version == latest_remote_version:
+                messages.append("Your {} package is up to date".format(name))
+            else:
+                messages.append("**WARNING**: LOCAL {} VERSION {} IS BEHIND THE CURRENT ONLINE VERSION {}\nPlease "
+                                "update {}, e.g. run `git pull` and `pip install .`".format(name, version,
+                                                                                            latest_remote_version,
+                                                                                            name))
+        else:  # no network access
+            messages.append('{} version status cannot be checked due to the following issue: {}'.format(
+                name, stderr.strip().split('\n')[0].strip()))
+            complete = False
+
+    for message in messages:
+        print(message)
+    return messages, complete
+
+
+def check_references(timeout=DEFAULT_TIMEOUT, force=False):
+    """Make sure that all of our reference files are up to date and
+    saved locally (see ``utils.check_reference_files``), giving up after
+    ``timeout`` seconds. A check that times out keeps running in the
+    background (see ``wait_for_reference_sync``); if one is still running,
+    it is waited on rather than starting another.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Maximum time (seconds) to wait for the check
+    force : bool, optional
+        Query CRDS even if the local reference file manifest is recent
+
+    Returns
+    -------
+    messages : list of str
+        Any warnings from the check
+    complete : bool
+        Whether the check finished successfully
+    """
+    global _reference_sync
+    from crds import CrdsLookupError, CrdsNetworkError, CrdsDownloadError
+    from jwst_magic.utils.utils import check_reference_files
+
+    if _reference_sync is None or not _reference_sync[0].is_alive():
+        errors = []
+
+        def run():
+            try:
+                check_reference_files(force=force)
+            except (FileNotFoundError, CrdsLookupError, CrdsNetworkError, CrdsDownloadError, ValueError) as e:
+                errors.append(e)
+
+        # Run in a daemon thread so a hanging CRDS query can't block the caller
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        _reference_sync = (thread, errors)
+
+    thread, errors = _reference_sync
+    thread.join(timeout)
+
+    if thread.is_alive():
+        messages = [f'{REFERENCE_WARNING} (timed out after {timeout} seconds)']
+    elif errors:
+        messages = [REFERENCE_WARNING]
+    else:
+        return [], True
+
+    for message in messages:
+        print(message)
+    return messages, False
+
+
+def wait_for_reference_sync(timeout=None):
+    """Wait for a reference file check that ``check_references`` gave
+    up on to finish, as it may still be downloading and converting files.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Maximum time (seconds) to wait; if None, wait until it finishes
+
+    Returns
+    -------
+    finished : bool
+        Whether no reference file check is still running
+    """
+    if _reference_sync is not None and _reference_sync[0].is_alive():
+        print('Waiting for the reference files to finish updating from CRDS...')
+        _reference_sync[0].join(timeout)
+    return _reference_sync is None or not _reference_sync[0].is_alive()
+
+
+def require_references(timeout=DEFAULT_TIMEOUT):
+    """Make sure the reference files are saved locally before they are
+    used. This runs ``check_references``, which only queries CRDS if the
+    local reference file manifest is out of date. If any files are
+    missing, it also waits (up to the timeout) for a check that is still
+    running, e.g. a download started when the GUI was launched. Files
+    that are already there can be used while a check runs, since they
+    are replaced atomically.
+
+    Parameters
+    ----------
+    timeout : float, optional
+        Maximum time (seconds) to wait for the check, and again for a
+        running check to download any missing files
+
+    Raises
+    ------
+    FileNotFoundError
+        Some reference files are still missing after the check
+    """
+    from jwst_magic.utils.utils import missing_reference_files
+
+    check_references(timeout)
+
+    missing = missing_reference_files()
+    if missing:
+        wait_for_reference_sync(timeout)
+        missing = missing_reference_files()
+    if missing:
+        raise FileNotFoundError(
+            'Cannot find the MAGIC reference files {}. Without them, the FSW files would have no zeroth '
+            'read bias or bad pixels. Run jwst_magic.check_setup() with access to CRDS to download '
+            'them; see https://github.com/spacetelescope/jwst_magic#running-the-tools'.format(
+                ', '.join(os.path.basename(path) for path in missing)))
+
+
+def read_check_cache():
+    """Read the results of the last complete set of checks, if any.
+
+    Returns
+    -------
+    cache : dict or None
+        Dictionary with the 'time' the checks were run, the
+        'messages' they printed, and the MAGIC 'version'
+    """
+    try:
+        with open(CHECK_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # Results for a different version of MAGIC are out of date
+    if cache.get('version') != __version__:
+        return None
+    return cache
+
+
+def write_check_cache(messages):
+    """Save the results of a complete set of checks.
+
+    Parameters
+    ----------
+    messages : list of str
+        The results of the checks
+    """
+    try:
+        with open(CHECK_CACHE_FILE, 'w') as f:
+            json.dump({'time': time.time(), 'version': __version__, 'messages': messages}, f)
+    except OSError:
+        # A read-only installation just won't cache the results
+        pass
+
+
+if __name__ == '__main__':
+    check_setup(force=True)
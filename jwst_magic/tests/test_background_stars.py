@@ -24,6 +24,7 @@ import pytest
 
 # Local Imports
 from jwst_magic.utils import utils
+from jwst_magic.convert_image import background_stars
 from jwst_magic.convert_image.background_stars import add_background_stars
 
 if not JENKINS:
@@ -108,6 +109,53 @@ def test_add_background_stars():
     assert image[200, 1500] != 1 # check a star was added here
 
 
+def _loop_add_shifted_copies(image, x_back, y_back, scales):
+    """Add copies of an image the way add_background_stars used to,
+    one full-frame copy per star"""
+    add_data = np.copy(image)
+    for x, y, scale_factor in zip(x_back, y_back, scales):
+        star_data = image * scale_factor
+        psfx = psfy = 2048
+
+        x1 = max(0, int(x) - int(psfx / 2))
+        x2 = min(2048, int(x) + int(psfx / 2) + 1)
+        y1 = max(0, int(y) - int(psfy / 2))
+        y2 = min(2048, int(y) + int(psfy / 2) + 1)
+        if y > 1024:
+            star_data = star_data[:y2 - y1]
+        else:
+            star_data = star_data[2048 - (y2 - y1):]
+        if x > 1024:
+            star_data = star_data[:, :x2 - x1]
+        else:
+            star_data = star_data[:, 2048 - (x2 - x1):]
+        add_data[y1:y2, x1:x2] += star_data
+    return add_data
+
+
+add_shifted_copies_parameters = [(1, 'direct'), (5, 'fft'), (40, 'auto'), (300, 'auto')]
+@pytest.mark.parametrize('n_stars, method', add_shifted_copies_parameters)
+def test_add_shifted_copies(n_stars, method):
+    """Test that adding all the background stars at once matches adding
+    them one at a time"""
+    rng = np.random.default_rng(20)
+    image = rng.random((2048, 2048))
+    image[1000:1048, 1000:1048] += 12
+    image[1080:1100, 1000:1048] += 15
+    template = np.where(image < np.mean(image), 0, image)
+
+    x_back = rng.uniform(0, 2048, n_stars)
+    y_back = rng.uniform(0, 2048, n_stars)
+    x_back[0], y_back[0] = 1024, 1024.5  # Either side of the center
+    scales = rng.uniform(0.001, 0.1, n_stars)
+
+    expected = _loop_add_shifted_copies(template, x_back, y_back, scales) - template + image
+    dy = [background_stars._placement_shift(y) for y in y_back]
+    dx = [background_stars._placement_shift(x) for x in x_back]
+    result = background_stars.add_shifted_copies(np.copy(image), template, dy, dx, scales, method=method)
+    assert np.allclose(result, expected, rtol=0, atol=1e-10)
+
+
 @pytest.mark.skipif(JENKINS, reason="Can't import PyQt5 on Jenkins server.")
 def test_init_background_stars(bkgdstars_dialog):
     """Make sure the background_stars GUI can launch without errors.
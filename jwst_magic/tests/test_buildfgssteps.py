@@ -13,15 +13,20 @@ Use
 """
 import os
 import shutil
+import time
+import tracemalloc
+from types import SimpleNamespace
 
 from astropy.io import ascii as asc
 from astropy.io import fits
 import numpy as np
 import pytest
 
+from scipy import ndimage
+
 from jwst_magic.tests.utils import parametrized_data
-from jwst_magic.fsw_file_writer import write_files
-from jwst_magic.fsw_file_writer.buildfgssteps import BuildFGSSteps, shift_to_id_attitude
+from jwst_magic.fsw_file_writer import reference_cache, shift_engine, write_files
+from jwst_magic.fsw_file_writer.buildfgssteps import BuildFGSSteps, create_strips, shift_to_id_attitude
 from jwst_magic.fsw_file_writer.buildfgssteps import OSS_TRIGGER, COUNTRATE_CONVERSION, DIM_STAR_THRESHOLD_FACTOR, \
     BRIGHT_STAR_THRESHOLD_ADDEND
 from jwst_magic.fsw_file_writer.rewrite_prc import rewrite_prc
@@ -251,6 +256,18 @@ def test_correct_count_rate(open_image, test_directory, guider, step, correct_da
     assert (BFS.countrate == correct_data_dict['countrates']).all(), 'Incorrect {} count rate.'.format(step)
 
 
+def test_id_peak_memory(open_image, test_directory):
+    """Check that building the ID step (full-frame bias, reads, CDS, and
+    strips) stays within a fixed memory budget"""
+    tracemalloc.start()
+    BuildFGSSteps(open_image, 1, ROOT, 'ID', guiding_selections_file=SELECTED_SEGS_CMIMF,
+                  out_dir=TEST_DIRECTORY, shift_id_attitude=False)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert peak < 500e6, 'ID step used more memory than expected.'
+
+
 def test_psf_center_file(test_directory):
     """Test that when psf_center_file is set, the array position for TRK
     is pulled from the psf_center file rather than the guiding selections file
@@ -508,3 +525,468 @@ def test_subarray_size(test_directory, step, shifted):
     elif step == 'LOSTRK':
         assert bfs.input_im.shape == (43, 43)
         assert bfs.image.shape == (255, 255)
+
+
+def test_chunked_trk(open_image, test_directory):
+    """Check that a chunked TRK step streams files of the requested
+    number of ramps, identical in layout to the non-chunked files"""
+    nramps = 23
+    bfs = BuildFGSSteps(open_image, 1, ROOT, 'TRK', guiding_selections_file=SELECTED_SEGS_CMIMF,
+                        out_dir=TEST_DIRECTORY, shift_id_attitude=False, trk_nramps=nramps,
+                        trk_chunk_size=5)
+    assert bfs.image is None
+    assert bfs.bias is None
+
+    write_files.write_all(bfs)
+
+    for filename in [os.path.join(TEST_DIRECTORY, 'stsci', f'{ROOT}_G1_TRKbias.fits'),
+                     os.path.join(TEST_DIRECTORY, 'dhas', f'{ROOT}_G1_TRK.fits')]:
+        with fits.open(filename) as hdulist:
+            data = hdulist[0].data
+        assert data.shape == (nramps * 2, 32, 32)
+        assert data.dtype == np.uint16
+        assert data.max() > 0
+
+
+def test_fits_cube_writer(test_directory):
+    """Check that writing a cube in blocks gives the same file as writing
+    it all at once"""
+    data = np.random.default_rng(1).uniform(0, 65535, size=(17, 32, 32))
+    whole_file = os.path.join(test_directory, 'whole_cube.fits')
+    chunked_file = os.path.join(test_directory, 'chunked_cube.fits')
+
+    utils.write_fits(whole_file, np.uint16(data))
+    writer = utils.FitsCubeWriter(chunked_file, data.shape, np.uint16)
+    for i in range(0, len(data), 4):
+        writer.write(data[i:i + 4])
+    writer.close()
+
+    with open(whole_file, 'rb') as f1, open(chunked_file, 'rb') as f2:
+        assert f1.read() == f2.read()
+
+
+dat_shapes = [('ID', (144, 64, 2048)),
+              ('ACQ1', (12, 128, 128)),
+              ('ACQ2', (10, 32, 32)),
+              ('TRK', (10000, 32, 32)),
+              ('LOSTRK', (255, 255))]
+@pytest.mark.parametrize('step, shape', dat_shapes)
+def test_write_dat(test_directory, step, shape):
+    """Check that the bulk .dat writer produces the same bytes as formatting
+    each value individually, and report how long each step's file takes"""
+    rng = np.random.default_rng(0)
+    data = rng.normal(loc=3000, scale=5000, size=shape)
+    data[0, 0] = np.nan  # non-finite and saturated values are corrected before writing
+    data[-1, -1] = 70000
+    os.makedirs(os.path.join(test_directory, 'ground_system'), exist_ok=True)
+    obj = SimpleNamespace(step=step, root=ROOT, guider=1, out_dir=test_directory,
+                          ground_system_dir='ground_system')
+    if step == 'ID':
+        obj.strips = data
+    else:
+        obj.image = data
+
+    write_files.write_dat(obj)
+
+    filename = os.path.join(test_directory, 'ground_system', f'{ROOT}_G1_{step}.dat')
+    with open(filename, 'rb') as f:
+        contents = f.read()
+
+    # Compare (the start of) the file against value-by-value formatting
+    flat = utils.correct_image(data, upper_threshold=65535, upper_limit=65535).flatten()[:100000]
+    if step in ['TRK', 'LOSTRK']:
+        expected = ''.join('{:16.7e} '.format(dat) for dat in flat)
+        assert len(contents) == 17 * data.size
+    else:
+        expected = ''.join('{:04X} '.format(dat) for dat in flat.astype(np.uint16))
+        assert len(contents) == 5 * data.size
+    assert contents[:len(expected)] == expected.encode('ascii')
+
+
+def test_parallel_fsw_jobs(open_image, test_directory):
+    """Check that building and writing config/step jobs in a process pool
+    gives the same files as running them serially with the same seeds"""
+    from jwst_magic import run_magic
+
+    steps = ['ID', 'ACQ1', 'LOSTRK']
+    build_kwargs = dict(thresh_factor=0.6, shift_id_attitude=False, use_oss_defaults=False,
+                        catalog_countrate=None, override_bright_guiding=False, trk_nramps=None,
+                        trk_chunk_size=None)
+    shift_kwargs = dict(all_found_psfs_file=None, center_pointing_file=None, psf_center_file=None)
+
+    written = {}
+    for n_workers in [None, 2]:
+        out_dir = os.path.join(test_directory, f'parallel_{n_workers}')
+        guiding_selections_files = []
+        for config in [1, 2]:
+            config_dir = os.path.join(out_dir, f'guiding_config_{config}')
+            utils.ensure_dir_exists(config_dir)
+            guiding_selections_files.append(shutil.copy(SELECTED_SEGS_CMIMF, config_dir))
+        out_dirs_fsw = [run_magic._get_config_out_dir(out_dir, f) for f in guiding_selections_files]
+        job_rngs = [rng for config_rngs in utils.spawn_rngs(7, len(guiding_selections_files), len(steps))
+                    for rng in config_rngs]
+
+        if n_workers is None:
+            k = 0
+            for guiding_selections_file, out_dir_fsw in zip(guiding_selections_files, out_dirs_fsw):
+                for step in steps:
+                    bfs = BuildFGSSteps(open_image, 1, ROOT, step, out_dir=out_dir_fsw,
+                                        guiding_selections_file=guiding_selections_file,
+                                        logger_passed=True, rng=job_rngs[k], **build_kwargs)
+                    bfs.threshold = bfs.thresh_factor * bfs.countrate
+                    write_files.write_all(bfs)
+                    k += 1
+        else:
+            objs = run_magic._run_fsw_jobs_parallel(open_image, ROOT, 1, guiding_selections_files,
+                                                    out_dirs_fsw, steps, job_rngs, n_workers, False,
+                                                    shift_kwargs, build_kwargs)
+            assert all(obj.image is None for obj in objs)
+
+        written[n_workers] = {}
+        for dirpath, _, filenames in os.walk(out_dir):
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename), 'rb') as f:
+                    written[n_workers][os.path.relpath(os.path.join(dirpath, filename), out_dir)] = f.read()
+
+    assert written[None].keys() == written[2].keys()
+    for filename, contents in written[None].items():
+        assert written[2][filename] == contents, filename
+
+
+@pytest.mark.parametrize('step', ['ID', 'ACQ1', 'TRK'])
+def test_seeded_noise(open_image, test_directory, step):
+    """Check that the same seed gives the same noise, in single precision,
+    and that different seeds don't"""
+    images = []
+    for seed in [3, 3, 4]:
+        bfs = BuildFGSSteps(open_image, 1, ROOT, step, guiding_selections_file=SELECTED_SEGS_CMIMF,
+                            out_dir=TEST_DIRECTORY, shift_id_attitude=False, trk_nramps=10, rng=seed)
+        images.append((bfs.bias, bfs.image))
+
+    assert images[0][0].dtype == np.float32
+    assert np.array_equal(images[0][0], images[1][0])
+    assert np.array_equal(images[0][1], images[1][1])
+    assert not np.array_equal(images[0][0], images[2][0])
+
+
+def test_reference_cache(test_directory):
+    """Check that reference files are only read once until they change on
+    disk, and that the cached arrays can't be modified"""
+    filename = os.path.join(test_directory, 'reference_cache.fits')
+    data = np.arange(64, dtype=np.float32).reshape(8, 8)
+    utils.write_fits(filename, data)
+    reference_cache.clear()
+
+    first = reference_cache.get_fits_data(filename)
+    second = reference_cache.get_fits_data(filename)
+    assert second is first
+    assert np.array_equal(first[2:4, 2:4], data[2:4, 2:4])
+    assert reference_cache.get_stats()['hits'] == 1
+    assert reference_cache.get_stats()['misses'] == 1
+    with pytest.raises(ValueError):
+        first[0, 0] = 1
+
+    # Rewriting the file invalidates its entry
+    utils.write_fits(filename, data * 2)
+    os.utime(filename, ns=(time.time_ns(), time.time_ns() + 10**9))
+    assert np.array_equal(reference_cache.get_fits_data(filename), data * 2)
+    assert reference_cache.get_stats()['misses'] == 2
+
+    # Headers are copies the caller can modify
+    hdr = reference_cache.get_fits_header(filename)
+    hdr['TESTKEY'] = 1
+    assert 'TESTKEY' not in reference_cache.get_fits_header(filename)
+
+
+@pytest.mark.parametrize('step', ['ID', 'ACQ1', 'TRK'])
+def test_catalog_only(open_image, test_directory, step):
+    """Check that a catalog-only build skips the images but gets the same
+    coordinates, count rates, and thresholds as a full build"""
+    full = BuildFGSSteps(open_image, 1, ROOT, step, guiding_selections_file=SELECTED_SEGS_CMIMF,
+                         out_dir=TEST_DIRECTORY, shift_id_attitude=False)
+    catalog = BuildFGSSteps(open_image, 1, ROOT, step, guiding_selections_file=SELECTED_SEGS_CMIMF,
+                            out_dir=TEST_DIRECTORY, shift_id_attitude=False, catalog_only=True)
+
+    assert catalog.image is None
+    assert catalog.bias is None
+    for attr in ['xarr', 'yarr', 'countrate', 'threshold']:
+        assert np.array_equal(getattr(catalog, attr), getattr(full, attr))
+    assert catalog.thresh_factor == full.thresh_factor
+
+
+shift_engine_parameters = [((23.7, -112.2), np.float64), ((-0.5, 0.25), np.float64), ((40, -7), np.float64),
+                           ((0, 3000), np.float64), ((23.7, -112.2), '>f4'), ((40, -7), '>f4')]
+@pytest.mark.parametrize('shift, dtype', shift_engine_parameters)
+def test_shift_engine(shift, dtype):
+    """Test that the shift engine matches scipy.ndimage.shift, including
+    the type of a float32 image read from a FITS file, and only computes
+    the spline coefficients of an image once"""
+    y, x = np.mgrid[:512, :480]
+    image = (100 * np.exp(-((x - 300) ** 2 + (y - 200) ** 2) / (2 * 6 ** 2)) + 5).astype(dtype)
+    expected = ndimage.shift(image, shift, mode='constant', cval=5, prefilter=True)
+
+    engine = shift_engine.ShiftEngine()
+    for _ in range(3):
+        shifted = engine.shift(image, shift, cval=5)
+        assert shifted.dtype == expected.dtype
+        assert np.allclose(shifted, expected, rtol=0, atol=1e-10)
+    if all(float(s).is_integer() for s in shift):
+        assert engine.stats['prefilter_misses'] == 0
+    else:
+        assert np.array_equal(shifted, expected)
+        assert engine.stats == {'prefilter_hits': 2, 'prefilter_misses': 1}
+
+    # The Fourier shift agrees with the spline for a well-sampled PSF
+    shifted = engine.shift(image, shift, cval=5, method='fourier')
+    assert shifted.dtype == expected.dtype
+    assert np.allclose(shifted, expected, rtol=0, atol=1e-2 * image.max())
+
+
+def _loop_create_strips(image, imgsize, nstrips, nramps, nreads, strip_height, yoffset, overlap):
+    """Copy the ID strips out of the reads one at a time"""
+    nz = nramps * nreads
+    strips = np.zeros((nstrips * nz, strip_height, imgsize), dtype=image.dtype)
+    nn = 0
+    for i in range(nstrips):
+        for iz in range(nz):
+            ylow = i * (strip_height - overlap) + yoffset
+            yhigh = ylow + strip_height
+            strips[nn] = image[iz, ylow:yhigh, :]
+            nn += 1
+    return strips
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_create_strips(test_directory, dtype):
+    """Test that the strips view matches copying the strips, and that
+    writing it out only makes the uint16 copy"""
+    rng = np.random.default_rng(22)
+    image = rng.normal(loc=3000, scale=20000, size=(4, 2048, 2048)).astype(dtype)
+    image[0, 100, 100] = np.nan
+    image[3, 2000, 5] = np.inf
+
+    strips = create_strips(image, 2048, 36, 2, 2, 64, 12, 8)
+    expected = _loop_create_strips(image, 2048, 36, 2, 2, 64, 12, 8)
+    assert strips.shape == expected.shape
+    assert np.array_equal(np.asarray(strips), expected, equal_nan=True)
+    assert np.array_equal(strips[37], expected[37])
+    assert np.array_equal(strips[-1], expected[-1])
+    assert np.shares_memory(strips[5], image)
+
+    # Converting to an array makes a single copy, which can't be avoided
+    tracemalloc.start()
+    array = np.asarray(strips)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert np.array_equal(array, expected, equal_nan=True)
+    assert peak < 1.1 * array.nbytes
+    with pytest.raises(ValueError):
+        strips.__array__(copy=False)
+
+    # Only the uint16 copy is allocated when writing out
+    tracemalloc.start()
+    uint16_strips = strips.to_uint16()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert np.array_equal(uint16_strips,
+                          np.uint16(utils.correct_image(expected, upper_threshold=65535, upper_limit=65535)))
+    assert peak < uint16_strips.nbytes + 3 * image[:, :64].nbytes  # plus a few strips' worth of work space
+
+    # The .dat file is the same as when written from the copied strips
+    utils.ensure_dir_exists(os.path.join(test_directory, 'ground_system'))
+    filename = os.path.join(test_directory, 'ground_system', f'{ROOT}_G1_ID.dat')
+    contents = []
+    for data in [strips, expected]:
+        obj = SimpleNamespace(step='ID', root=ROOT, guider=1, out_dir=test_directory,
+                              ground_system_dir='ground_system', strips=data)
+        write_files.write_dat(obj)
+        with open(filename, 'rb') as f:
+            contents.append(f.read())
+    assert contents[0] == contents[1]
+
+    with pytest.raises(ValueError):
+        create_strips(image, 2048, 37, 2, 2, 64, 12, 8)
+
+
+def _three_pass_correct_image(image, upper_threshold=None, upper_limit=None):
+    """Correct an image with a copy and a pass per kind of bad pixel"""
+    img = np.copy(image)
+    img[img < 0] = 0.
+    if (upper_threshold is not None) and (upper_limit is not None):
+        img[img >= upper_threshold] = upper_limit
+    img[np.isfinite(img) == 0] = 0.
+    return img
+
+
+correct_and_cast_parameters = [((2048, 2048), np.float64, 65535, np.uint16),
+                               ((4, 2048, 2048), np.float32, 65535, np.uint16),
+                               ((10, 32, 32), np.float64, 65535, None),
+                               ((255, 255), np.float64, None, None),
+                               ((1000,), np.int32, 65535, np.uint16)]
+@pytest.mark.parametrize('shape, dtype, upper_limit, out_dtype', correct_and_cast_parameters)
+def test_correct_and_cast(shape, dtype, upper_limit, out_dtype):
+    """Test that the single-pass correction and cast matches correcting
+    the image and then casting it, also in place and into an output"""
+    rng = np.random.default_rng(23)
+    image = rng.normal(loc=3000, scale=40000, size=shape).astype(dtype)
+    if np.issubdtype(dtype, np.floating):
+        image.flat[[0, 5, 17]] = [np.nan, np.inf, -np.inf]
+    expected = _three_pass_correct_image(image, upper_limit, upper_limit)
+    if out_dtype is not None:
+        expected = expected.astype(out_dtype)
+
+    corrected = utils.correct_and_cast(image, upper_limit, dtype=out_dtype)
+    assert corrected.dtype == expected.dtype
+    assert np.array_equal(corrected, expected)
+
+    out = np.empty(shape, dtype=expected.dtype)
+    assert utils.correct_and_cast(image, upper_limit, dtype=out_dtype, out=out) is out
+    assert np.array_equal(out, expected)
+
+    # A non-contiguous view
+    assert np.array_equal(utils.correct_and_cast(image[..., ::2], upper_limit, dtype=out_dtype),
+                          expected[..., ::2])
+
+    # correct_image gives the same result as before
+    assert np.array_equal(utils.correct_image(image, upper_limit, upper_limit),
+                          _three_pass_correct_image(image, upper_limit, upper_limit))
+    if out_dtype is None:
+        assert utils.correct_and_cast(image, upper_limit, inplace=True) is image
+        assert np.array_equal(image, expected)
+
+
+def _write_files_obj(step, out_dir, shape):
+    """Make a lightweight object holding the arrays and catalog that
+    the file writers need for a step"""
+    rng = np.random.default_rng(24)
+    utils.ensure_dir_exists(os.path.join(out_dir, 'ground_system'))
+    return SimpleNamespace(step=step, root=ROOT, guider=1, out_dir=out_dir, stsci_dir='stsci',
+                           dhas_dir='dhas', ground_system_dir='ground_system', imgsize=shape[-1],
+                           time_normed_im=rng.uniform(0, 1000, size=shape[-2:]),
+                           bias=rng.uniform(0, 1000, size=shape),
+                           cds=rng.uniform(0, 1000, size=(shape[0] // 2,) + shape[1:]),
+                           image=rng.uniform(0, 70000, size=shape),
+                           xarr=np.array([10, 20]), yarr=np.array([12, 5]), countrate=np.array([1e5, 2e4]),
+                           threshold=np.array([5e4, 1e4]))
+
+
+@pytest.mark.parametrize('step, shape', [('ACQ2', (10, 32, 32)), ('LOSTRK', (255, 255))])
+def test_async_writer(test_directory, step, shape):
+    """Check that writing the files in a pool of threads gives the same
+    files as writing them one after another"""
+    written = {}
+    for method in ['serial', 'async']:
+        out_dir = os.path.join(test_directory, f'{method}_writer')
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        obj = _write_files_obj(step, out_dir, shape)
+
+        if method == 'serial':
+            write_files.write_all(obj)
+        else:
+            with write_files.AsyncWriter(max_workers=3) as writer:
+                handle = writer.submit(obj)
+                assert [name for name, _ in handle.futures] == \
+                    [function.__name__ for function in write_files.product_writers(obj)]
+            assert handle.done()
+
+        written[method] = {}
+        for dirpath, _, filenames in os.walk(out_dir):
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename), 'rb') as f:
+                    written[method][os.path.relpath(os.path.join(dirpath, filename), out_dir)] = f.read()
+
+    assert len(written['serial']) > 0
+    assert written['serial'] == written['async']
+
+
+def test_async_writer_errors(test_directory, monkeypatch):
+    """Check that an error writing one file is raised by the handle and
+    by the writer, after the other files have been written"""
+    def write_cds(obj):
+        raise IOError('Disk full')
+    monkeypatch.setattr(write_files, 'write_cds', write_cds)
+
+    out_dir = os.path.join(test_directory, 'failed_writer')
+    obj = _write_files_obj('ACQ2', out_dir, (10, 32, 32))
+    writer = write_files.AsyncWriter()
+    handle = writer.submit(obj)
+    with pytest.raises(IOError, match='Disk full'):
+        handle.wait()
+    assert os.path.exists(os.path.join(out_dir, 'ground_system', f'{ROOT}_G1_ACQ2.dat'))
+    with pytest.raises(IOError, match='Disk full'):
+        writer.close()
+
+    with pytest.raises(IOError, match='Disk full'):
+        with write_files.AsyncWriter() as writer:
+            writer.submit(obj)
+
+
+def test_step_products():
+    """Check that each output profile writes the products of the smaller
+    profiles, plus its own"""
+    profiles = ['ground-only', 'dhas', 'full', 'debug']
+    for step in write_files.STEP_PRODUCTS:
+        products = [write_files.step_products(step, profile) for profile in profiles]
+        for smaller, larger in zip(products[:-1], products[1:]):
+            assert set(smaller) <= set(larger)
+        assert products[2] == [p for p in write_files.STEP_PRODUCTS[step] if p != 'raw']
+
+    assert write_files.step_products('ID', 'ground-only') == ['prc', 'dat']
+    assert write_files.step_products('TRK', 'ground-only') == []
+    assert write_files.step_products('TRK', 'dhas') == ['image']
+    with pytest.raises(ValueError):
+        write_files.step_products('ID', 'everything')
+
+
+output_profile_files = [('ground-only', ['ground_system/{}.dat']),
+                        ('dhas', ['ground_system/{}.dat', 'dhas/{}.fits']),
+                        ('full', ['ground_system/{}.dat', 'dhas/{}.fits', 'stsci/{}sky.fits', 'stsci/{}bias.fits',
+                                  'stsci/{}cds.fits', 'stsci/{}.stc', 'stsci/{}.cat']),
+                        ('debug', ['ground_system/{}.dat', 'dhas/{}.fits', 'stsci/{}sky.fits', 'stsci/{}bias.fits',
+                                   'stsci/{}cds.fits', 'stsci/{}.stc', 'stsci/{}.cat', 'stsci/{}raw.fits'])]
+@pytest.mark.parametrize('output_profile, filenames', output_profile_files)
+def test_output_profile_files(test_directory, output_profile, filenames):
+    """Check that only the files in the output profile are written"""
+    out_dir = os.path.join(test_directory, f'{output_profile}_files')
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    obj = _write_files_obj('ACQ2', out_dir, (10, 32, 32))
+    obj.output_profile = output_profile
+    write_files.write_all(obj)
+
+    written = [os.path.relpath(os.path.join(dirpath, filename), out_dir)
+               for dirpath, _, files in os.walk(out_dir) for filename in files]
+    assert sorted(written) == sorted(f.format(f'{ROOT}_G1_ACQ2') for f in filenames)
+
+
+@pytest.mark.parametrize('step', ['ID', 'ACQ1', 'TRK'])
+def test_output_profile_build(open_image, test_directory, step):
+    """Check that building a step for a smaller output profile skips the
+    unneeded arrays, but writes the same files as a full build"""
+    written = {}
+    for output_profile in ['ground-only', 'full']:
+        out_dir = os.path.join(test_directory, f'{output_profile}_build')
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+
+        bfs = BuildFGSSteps(open_image, 1, ROOT, step, guiding_selections_file=SELECTED_SEGS_CMIMF,
+                            out_dir=out_dir, shift_id_attitude=False, logger_passed=True, rng=25,
+                            output_profile=output_profile)
+        write_files.write_all(bfs)
+
+        if output_profile == 'ground-only':
+            assert bfs.bias is None
+            assert bfs.cds is None
+            if step == 'TRK':
+                assert bfs.image is None
+
+        written[output_profile] = {}
+        for dirpath, _, filenames in os.walk(out_dir):
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename), 'rb') as f:
+                    written[output_profile][os.path.relpath(os.path.join(dirpath, filename), out_dir)] = f.read()
+
+    assert set(written['ground-only']) < set(written['full'])
+    for filename, contents in written['ground-only'].items():
+        assert written['full'][filename] == contents, filename
@@ -30,11 +30,14 @@ import yaml
 
 from astropy.io import ascii as asc
 from astropy.io import fits
+from astropy.nddata import Cutout2D
+from astropy.stats import sigma_clip
 import numpy as np
 import pytest
+from scipy import ndimage
 
 from jwst_magic.tests.utils import parametrized_data
-from jwst_magic.convert_image import convert_image_to_raw_fgs
+from jwst_magic.convert_image import conversion_cache, convert_image_to_raw_fgs, undistortion
 from jwst_magic.utils import utils, coordinate_transforms
 
 JENKINS = '/home/developer/workspace/' in os.getcwd()
@@ -267,3 +270,441 @@ def test_psf_detection_methods(test_directory, smoothing, detection_threshold, c
     # Check the saved out all_found_psfs_file
     in_table = asc.read(all_found_psfs_file)
     assert len(in_table) == correct_number_of_psfs
+
+
+def _loop_bad_pixel_correction(data, bad_pix_data):
+    """Pixel-by-pixel version of the bad pixel correction, kept as a
+    reference for the vectorized version"""
+    m, n = data.shape
+    new_data = np.copy(data)
+    for i in range(m):
+        for j in range(n):
+            if bad_pix_data[i, j] == 1:
+                vals = [new_data[k, h] for k in [i + 1, i, i - 1] for h in [j + 1, j, j - 1]
+                        if 0 <= k < m and 0 <= h < n and bad_pix_data[k, h] != 1]
+                new_data[i, j] = np.median(vals) if len(vals) > 0 else 0
+
+    return new_data
+
+
+bad_pixel_parameters = [
+    (np.float64, 0.01),
+    (np.float32, 0.1),
+    (np.float64, 0.5),  # many pixels with few or no good neighbors
+    (np.int32, 0.2),
+]
+@pytest.mark.parametrize('dtype, bad_fraction', bad_pixel_parameters)
+def test_bad_pixel_correction(dtype, bad_fraction):
+    """Test that the vectorized bad pixel correction matches the
+    pixel-by-pixel correction, including at the edges"""
+    rng = np.random.default_rng(2048)
+    data = (rng.normal(loc=100, scale=50, size=(64, 48))).astype(dtype)
+    dq_array = (rng.random(data.shape) < bad_fraction).astype(np.uint8)
+    dq_array[0, :] = 1  # flagged edge pixels
+
+    corrected = convert_image_to_raw_fgs.bad_pixel_correction(data, True, 'NRCA3', dq_array=dq_array)
+
+    assert corrected.dtype == data.dtype
+    assert np.array_equal(corrected, _loop_bad_pixel_correction(data, dq_array))
+    assert np.array_equal(corrected[dq_array == 0], data[dq_array == 0])
+
+
+def _loop_resize_array(arr, new_rows, new_cols):
+    """Column-by-column, row-by-row version of utils.resize_array, kept as
+    a reference for the sparse matrix version"""
+    rows, cols = np.shape(arr)
+    yscale = float(rows) / new_rows
+    xscale = float(cols) / new_cols
+
+    new_a = np.zeros((rows, new_cols))
+    for j in range(new_cols):
+        firstx, lastx = j * xscale, (j + 1) * xscale
+        scale_line = utils.rescale_array(firstx, lastx)[:cols - int(firstx)]
+        new_a[:, j] = np.dot(arr[:, int(firstx):int(lastx) + 1], scale_line) / scale_line.sum()
+
+    new_arr = np.zeros((new_rows, new_cols))
+    for i in range(new_rows):
+        firsty, lasty = i * yscale, (i + 1) * yscale
+        scale_line = utils.rescale_array(firsty, lasty)[:rows - int(firsty)]
+        new_arr[i, :] = np.dot(scale_line, new_a[int(firsty):int(lasty) + 1, ]) / scale_line.sum()
+
+    return new_arr
+
+
+resize_parameters = [
+    ((2048, 2048), (918, 918)),  # NIRCam SW to FGS
+    ((2048, 2048), (1024, 1024)),  # integer factor
+    ((301, 157), (97, 156)),
+    ((64, 64), (64, 64)),
+]
+@pytest.mark.parametrize('shape, new_shape', resize_parameters)
+def test_resize_array(shape, new_shape):
+    """Test that the sparse rebinning matches averaging one row/column at
+    a time, and conserves the mean"""
+    data = np.random.default_rng(918).uniform(0, 1000, size=shape)
+
+    resized = utils.resize_array(data, *new_shape)
+
+    assert resized.shape == new_shape
+    assert np.allclose(resized, _loop_resize_array(data, *new_shape), rtol=1e-12, atol=0)
+    if shape[0] % new_shape[0] == 0 and shape[1] % new_shape[1] == 0:
+        assert np.isclose(resized.mean(), data.mean())
+
+
+def _loop_count_rate_total(data, objects, num_objects, x, y, countrate_3x3=True):
+    """One-PSF-at-a-time version of utils.count_rate_total, kept as a
+    reference for the batched version"""
+    countrate = []
+    val = []
+    for i, x_old, y_old in zip(np.arange(1, num_objects + 1), x, y):
+        im = np.copy(objects)
+        im[objects != i] = False
+        im[objects == i] = True
+
+        if countrate_3x3:
+            image_window = 40
+            min_x = max(int(x_old) - image_window, 0)
+            min_y = max(int(y_old) - image_window, 0)
+            sources = utils.find_peaks(data[min_y:int(y_old) + image_window, min_x:int(x_old) + image_window],
+                                       box_size=1, npeaks=1, threshold='standard-deviation')
+            if sources is None:
+                countrate.append(0)
+            else:
+                x_new = sources['x_peak'][0] + x_old - image_window
+                y_new = sources['y_peak'][0] + y_old - image_window
+                countrate.append(utils.get_countrate_3x3(x_new, y_new, np.array(data)))
+        else:
+            countrate.append(np.sum(im * data))
+        val.append(np.sum(im * 1.))
+
+    return countrate, val
+
+
+def _make_crowded_field(n_psfs, shape=(1024, 1024), seed=10):
+    """Noisy image with n_psfs Gaussian PSFs, plus a flat patch, a patch
+    of NaNs, and PSFs at the edges"""
+    rng = np.random.default_rng(seed)
+    data = rng.normal(loc=100, scale=10, size=shape)
+    x = list(rng.uniform(0, shape[1], n_psfs))
+    y = list(rng.uniform(0, shape[0], n_psfs))
+    yy, xx = np.mgrid[-6:7, -6:7]
+    for x_psf, y_psf in zip(x, y):
+        x_int, y_int = int(x_psf), int(y_psf)
+        if 6 <= x_int < shape[1] - 6 and 6 <= y_int < shape[0] - 6:
+            data[y_int - 6:y_int + 7, x_int - 6:x_int + 7] += 5000 * np.exp(-(xx ** 2 + yy ** 2) / 4)
+    data[500:600, 500:600] = 7.  # no peak above the threshold
+    data[10:20, 900:910] = np.nan
+    x += [550., 3.2, shape[1] - 1.5, 905.]
+    y += [550., 400., 1., 15.]
+
+    smoothed = np.nan_to_num(data)
+    objects = (smoothed > 1000).astype(int)
+    objects[objects > 0] = np.arange(1, np.count_nonzero(objects) + 1) % (len(x) + 1)
+    return data, objects, x, y
+
+
+count_rate_parameters = [(1, True), (40, True), (40, False)]
+@pytest.mark.parametrize('n_psfs, countrate_3x3', count_rate_parameters)
+def test_count_rate_total(n_psfs, countrate_3x3):
+    """Test that the batched count rates match finding the peak and
+    masking the segmentation image one PSF at a time"""
+    data, objects, x, y = _make_crowded_field(n_psfs)
+    if not countrate_3x3:
+        # Masking the full image spread a NaN anywhere to every object
+        data = np.nan_to_num(data)
+
+    countrate, val = utils.count_rate_total(data, objects, len(x), x, y, countrate_3x3=countrate_3x3)
+    loop_countrate, loop_val = _loop_count_rate_total(data, objects, len(x), x, y,
+                                                      countrate_3x3=countrate_3x3)
+
+    assert np.array_equal(val, loop_val)
+    if countrate_3x3:
+        assert np.array_equal(countrate, loop_countrate)
+        assert countrate[-4] == 0  # flat patch
+    else:
+        assert np.allclose(countrate, loop_countrate, rtol=1e-12)
+
+
+def test_count_rate_total_scaling():
+    """Test that count_rate_total handles 10,000 PSFs, matching the
+    one-at-a-time calculation for a sample of them"""
+    data, objects, x, y = _make_crowded_field(10000, shape=(2048, 2048))
+
+    countrate, val = utils.count_rate_total(data, objects, len(x), x, y)
+
+    assert len(countrate) == len(val) == len(x)
+    sample = slice(None, None, 500)
+    loop_countrate, _ = _loop_count_rate_total(data, objects, len(x[sample]), x[sample], y[sample])
+    assert np.array_equal(countrate[sample], loop_countrate)
+
+
+smooth_parameters = [
+    ((256, 256), 1),
+    ((300, 211), 12.5),
+    ((256, 256), 26),  # 'high' and 'choose center' smoothing
+    ((96, 120), 40),  # kernel wider than the image
+]
+@pytest.mark.parametrize('shape, sigma', smooth_parameters)
+def test_smooth_image(shape, sigma):
+    """Test that FFT smoothing matches ndimage.gaussian_filter, including
+    at the edges, and finds the same peaks"""
+    data, _, _, _ = _make_crowded_field(10, shape=shape)
+    data = np.nan_to_num(data)
+
+    spatial = ndimage.gaussian_filter(data, sigma)
+    smoothed = utils.smooth_image(data, sigma, method='fft')
+
+    assert smoothed.shape == data.shape
+    assert np.allclose(smoothed, spatial, rtol=0, atol=1e-12 * np.abs(spatial).max())
+    peaks = utils.find_peaks(smoothed, box_size=sigma, threshold='standard-deviation')
+    spatial_peaks = utils.find_peaks(spatial, box_size=sigma, threshold='standard-deviation')
+    if spatial_peaks is None:
+        assert peaks is None
+    else:
+        for column in ['x_peak', 'y_peak']:
+            assert np.array_equal(peaks[column], spatial_peaks[column])
+
+
+@pytest.mark.parametrize('sigma', [5, 26])
+def test_smooth_image_full_frame(sigma):
+    """Test that the automatic choice of smoothing method matches
+    ndimage.gaussian_filter on a full frame, for the default and "high"
+    smoothing on either side of utils.GAUSSIAN_FFT_SIGMA"""
+    data = np.random.default_rng(26).normal(loc=100, scale=10, size=(2048, 2048))
+
+    smoothed = utils.smooth_image(data, sigma)
+    spatial = ndimage.gaussian_filter(data, sigma)
+    assert np.allclose(smoothed, spatial, rtol=0, atol=1e-12 * np.abs(spatial).max())
+
+
+def _cutout_seed_image(data, x_list, y_list, psf_size):
+    """Stamp-by-stamp version of the seed image background subtraction,
+    kept as a reference for the masked version"""
+    postage_stamps = [Cutout2D(data, (x, y), (psf_size, psf_size)) for x, y in zip(x_list, y_list)]
+
+    old_bkgrd = data.copy()
+    for stamp in postage_stamps:
+        old_bkgrd[stamp.slices_original[0], stamp.slices_original[1]] = np.nan
+    old_bkgrd = sigma_clip(old_bkgrd, sigma=3, cenfunc='mean', masked=False, copy=False, axis=[0, 1])
+    old_bkgrd = sigma_clip(old_bkgrd, sigma=3, cenfunc='mean', masked=False, copy=False, axis=[0, 1])
+    med = np.nanmedian(old_bkgrd)
+
+    seed_image = np.zeros_like(data)
+    for stamp in postage_stamps:
+        seed_image[stamp.slices_original[0], stamp.slices_original[1]] = stamp.data - med
+
+    return seed_image
+
+
+seed_image_parameters = [(1, 'default', None), (25, 'default', None), (25, 'high', 150)]
+@pytest.mark.parametrize('n_psfs, smoothing, psf_size', seed_image_parameters)
+def test_create_seed_image(n_psfs, smoothing, psf_size):
+    """Test that the masked background estimate gives the same seed image
+    as clipping the full frame with NaN-filled stamps"""
+    rng = np.random.default_rng(n_psfs)
+    data, _, _, _ = _make_crowded_field(n_psfs, shape=(512, 512), seed=n_psfs)
+    data[rng.random(data.shape) < 1e-3] = 1e4  # outliers for the clipping
+    data = np.nan_to_num(data)
+
+    seed_image = convert_image_to_raw_fgs.create_seed_image(data, 1, ROOT, TEST_DIRECTORY, smoothing,
+                                                            psf_size=psf_size)
+
+    x_list, y_list, _, _ = convert_image_to_raw_fgs.create_all_found_psfs_file(data, 1, ROOT, TEST_DIRECTORY,
+                                                                               smoothing, save=False)
+    assert np.allclose(seed_image, _cutout_seed_image(data, x_list, y_list, psf_size or 100),
+                       rtol=1e-12, atol=1e-9)
+
+
+def test_estimate_background_subsample():
+    """Test that the background estimated from a subsample is close to
+    the full estimate, and reproducible with a seed"""
+    data = np.random.default_rng(0).normal(loc=50, scale=5, size=(1024, 1024))
+    mask = convert_image_to_raw_fgs.make_stamp_mask(data.shape, [100.5, 1023], [40, 600.2], 100)
+    assert mask.sum() == 90 * 100 + 100 * 51  # trimmed at the edges
+
+    background = convert_image_to_raw_fgs.estimate_background(data, mask)
+    subsampled = convert_image_to_raw_fgs.estimate_background(data, mask, max_pixels=100000, rng=1)
+
+    assert np.isclose(subsampled, background, atol=0.1)
+    assert subsampled == convert_image_to_raw_fgs.estimate_background(data, mask, max_pixels=100000, rng=1)
+
+
+def test_input_image(tmpdir):
+    """Test that InputImage reads the same data and headers as separate
+    fits.getdata/fits.getheader calls"""
+    rng = np.random.default_rng(5)
+    primary = fits.PrimaryHDU()
+    primary.header['DETECTOR'] = 'NRCA3'
+    sci = fits.ImageHDU(rng.normal(size=(32, 32)), name='SCI')
+    sci.header['BUNIT'] = 'MJy/sr'
+    dq = fits.ImageHDU(rng.integers(0, 4, size=(32, 32)).astype(np.uint32), name='DQ')
+    filename = os.path.join(tmpdir, 'cal.fits')
+    fits.HDUList([primary, sci, dq]).writeto(filename)
+
+    with convert_image_to_raw_fgs.InputImage(filename) as image:
+        assert np.array_equal(image.data, fits.getdata(filename))
+        assert image.header['DETECTOR'] == 'NRCA3'
+        assert image.sci_header['BUNIT'] == fits.getheader(filename, extname='sci')['BUNIT']
+        assert np.array_equal(image.dq, fits.getdata(filename, extname='DQ'))
+        data = image.data
+    data /= 2  # still usable (and writable) after closing
+
+    # Files with only a primary HDU
+    filename = os.path.join(tmpdir, 'rate.fits')
+    fits.PrimaryHDU(np.ones((8, 8))).writeto(filename)
+    with convert_image_to_raw_fgs.InputImage(filename) as image:
+        assert image.data.shape == (8, 8)
+        assert image.sci_header == {}
+        assert image.dq is None
+
+
+def test_convert_im_opens_input_once(test_directory, monkeypatch):
+    """Test that convert_im only opens the input image once"""
+    opened = []
+    fits_open = fits.open
+
+    def counting_open(name, *args, **kwargs):
+        opened.append(name)
+        return fits_open(name, *args, **kwargs)
+    monkeypatch.setattr(fits, 'open', counting_open)
+    monkeypatch.setattr(fits.convenience, 'fitsopen', counting_open)
+
+    convert_image_to_raw_fgs.convert_im(FGS_CMIMF_IM, 1, ROOT, out_dir=__location__, nircam=False,
+                                        normalize=False, smoothing='low', logger_passed=True)
+
+    assert opened.count(FGS_CMIMF_IM) == 1
+
+
+@pytest.mark.parametrize('detector', ['NRCA3', 'NRCBLONG', 'GUIDER2'])
+def test_undistort_image(tmpdir, monkeypatch, detector):
+    """Test that the SIAF undistortion moves stars to the pixels whose
+    mapped science-frame position is the star's position, and that the
+    map is saved and re-used"""
+    monkeypatch.setattr(undistortion, 'UNDISTORTION_MAP_PATH', str(tmpdir))
+    undistortion.get_undistortion_map.cache_clear()
+
+    stars = [(300, 400), (1024, 1024), (1800, 1700)]
+    data = np.zeros((2048, 2048))
+    for row, col in stars:
+        data[row, col] = 1.
+
+    undistorted = undistortion.undistort_image(data, detector)
+    assert len(os.listdir(tmpdir)) == 1
+
+    undistortion.get_undistortion_map.cache_clear()
+    coordinates = undistortion.get_undistortion_map(undistortion.get_aperture_name(detector), data.shape)
+    for row, col in stars:
+        near = (np.abs(coordinates[0] - row) < 1) & (np.abs(coordinates[1] - col) < 1)
+        brightest = np.unravel_index(np.argmax(np.where(near, undistorted, 0)), data.shape)
+        assert np.all(np.abs(coordinates[:, brightest[0], brightest[1]] - [row, col]) < 0.5)
+    assert np.isclose(np.nansum(undistorted), len(stars), rtol=0.01)
+
+
+def test_tolerance_report():
+    """Test that the tolerance report finds offsets and differences"""
+    data, _, _, _ = _make_crowded_field(10, shape=(256, 256))
+    data = np.nan_to_num(data)
+
+    report = undistortion.tolerance_report(data, data)
+    assert report['shift'] == (0, 0)
+    assert report['max_abs_diff'] == 0
+    assert report['flux_ratio'] == 1
+
+    report = undistortion.tolerance_report(data, np.roll(data, (3, -2), axis=(0, 1)))
+    assert report['shift'] == (3, -2)
+    assert report['max_rel_diff'] > 0
+
+
+def test_conversion_cache(tmpdir, monkeypatch):
+    """Test that converting the same image with the same parameters a
+    second time re-uses the cached result, and that the cache can be
+    bypassed and is size-limited"""
+    monkeypatch.setattr(conversion_cache, 'CACHE_PATH', os.path.join(tmpdir, 'cache'))
+    data, _, _, _ = _make_crowded_field(5, shape=(2048, 2048))
+    header = fits.Header()
+    header['TEST'] = 'True'
+    input_im = os.path.join(tmpdir, 'fgs_image.fits')
+    fits.PrimaryHDU(np.nan_to_num(data), header=header).writeto(input_im)
+    out_dir = os.path.join(tmpdir, 'out')
+
+    converted = convert_image_to_raw_fgs.convert_im(input_im, 1, ROOT, out_dir=out_dir, nircam=False,
+                                                    normalize=False, smoothing='low', logger_passed=True)
+    assert len(os.listdir(conversion_cache.CACHE_PATH)) == 1
+
+    # The second conversion doesn't open the image
+    opened = []
+    input_image = convert_image_to_raw_fgs.InputImage
+    monkeypatch.setattr(convert_image_to_raw_fgs, 'InputImage', lambda f: opened.append(f) or input_image(f))
+    for path in converted[1:3]:
+        os.remove(path)
+    cached = convert_image_to_raw_fgs.convert_im(input_im, 1, ROOT, out_dir=out_dir, nircam=False,
+                                                 normalize=False, smoothing='low', logger_passed=True)
+    assert opened == []
+    assert np.array_equal(cached[0], converted[0])
+    assert cached[1:3] == converted[1:3]
+    assert all(os.path.exists(path) for path in cached[1:3])
+    assert cached[3] == converted[3]
+
+    # New bad pixel masks (e.g. from a new CRDS context) mean a new conversion
+    masks = utils.bad_pixel_mask_checksums()
+    monkeypatch.setattr(utils, 'bad_pixel_mask_checksums', lambda: dict(masks, **{'new_mask.fits': 'abc'}))
+    convert_image_to_raw_fgs.convert_im(input_im, 1, ROOT, out_dir=out_dir, nircam=False,
+                                        normalize=False, smoothing='low', logger_passed=True)
+    assert len(opened) == 1
+
+    # Different parameters or use_cache=False mean a new conversion
+    convert_image_to_raw_fgs.convert_im(input_im, 1, ROOT, out_dir=out_dir, nircam=False,
+                                        normalize=False, smoothing='default', logger_passed=True)
+    convert_image_to_raw_fgs.convert_im(input_im, 1, ROOT, out_dir=out_dir, nircam=False,
+                                        normalize=False, smoothing='low', logger_passed=True, use_cache=False)
+    assert len(opened) == 3
+    assert len(os.listdir(conversion_cache.CACHE_PATH)) == 3
+
+    conversion_cache.evict(max_size=0)
+    assert os.listdir(conversion_cache.CACHE_PATH) == []
+
+    # A failed save leaves nothing behind
+    def fail(*args, **kwargs):
+        raise OSError('No space left on device')
+    monkeypatch.setattr(conversion_cache.np, 'save', fail)
+    conversion_cache.save('failed', np.zeros((4, 4)), {})
+    assert os.listdir(conversion_cache.CACHE_PATH) == []
+
+
+def test_convert_im_multi(tmpdir, monkeypatch):
+    """Test that converting an image for both guiders at once opens and
+    preprocesses it once, and matches converting it for each guider"""
+    monkeypatch.setattr(conversion_cache, 'CACHE_PATH', os.path.join(tmpdir, 'cache'))
+    data, _, _, _ = _make_crowded_field(5, shape=(2048, 2048))
+    input_im = os.path.join(tmpdir, 'fgs_image.fits')
+    fits.PrimaryHDU(np.nan_to_num(data)).writeto(input_im)
+    out_dir = os.path.join(tmpdir, 'out')
+
+    expected = {guider: convert_image_to_raw_fgs.convert_im(input_im, guider, ROOT, out_dir=out_dir, nircam=False,
+                                                            normalize=False, logger_passed=True, use_cache=False)
+                for guider in [1, 2]}
+
+    preprocessed = []
+    preprocess_image = convert_image_to_raw_fgs.preprocess_image
+    monkeypatch.setattr(convert_image_to_raw_fgs, 'preprocess_image',
+                        lambda *args: preprocessed.append(args) or preprocess_image(*args))
+    results = convert_image_to_raw_fgs.convert_im_multi(input_im, [1, 2], ROOT, out_dir=out_dir, nircam=False,
+                                                        normalize=False, logger_passed=True)
+    assert len(preprocessed) == 1
+    assert list(results) == [1, 2]
+    for guider in [1, 2]:
+        assert np.array_equal(results[guider][0], expected[guider][0])
+        assert results[guider][1:] == expected[guider][1:]
+
+    # Both conversions are cached
+    results = convert_image_to_raw_fgs.convert_im_multi(input_im, [1, 2], ROOT, out_dir=out_dir, nircam=False,
+                                                        normalize=False, logger_passed=True)
+    assert len(preprocessed) == 1
+    assert np.array_equal(results[2][0], expected[2][0])
+
+    # A pre-made all found PSFs file can't be shared between guiders
+    with pytest.raises(ValueError):
+        convert_image_to_raw_fgs.convert_im_multi(input_im, [1, 2], ROOT, out_dir=out_dir, nircam=False,
+                                                  normalize=False, logger_passed=True,
+                                                  all_found_psfs_file=results[1][1])
+    assert len(preprocessed) == 1
@@ -0,0 +1,32 @@
+"""Check that importing jwst_magic stays fast, i.e. that it doesn't
+eagerly import the GUI or query GitHub/CRDS.
+
+Use
+---
+    ::
+        pytest test_import_time.py
+"""
+import subprocess
+import sys
+
+# Maximum time (seconds) that `import jwst_magic` may take
+IMPORT_TIME_BUDGET = 1.0
+
+IMPORT_SCRIPT = """
+import sys, time
+t0 = time.perf_counter()
+import jwst_magic
+print(time.perf_counter() - t0)
+print(','.join(sorted(m for m in ['PyQt5', 'matplotlib', 'crds', 'jwst', 'jwst_magic.mainGUI'] if m in sys.modules)))
+"""
+
+
+def test_import_time():
+    """Import jwst_magic in a fresh interpreter and check it is quick and
+    doesn't pull in the heavy dependencies"""
+    result = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, check=True, timeout=60)
+    import_time, heavy_modules = result.stdout.decode('utf-8').split('\n')[:2]
+
+    assert float(import_time) < IMPORT_TIME_BUDGET, f'import jwst_magic took {float(import_time):.3f} s'
+    assert heavy_modules == ''
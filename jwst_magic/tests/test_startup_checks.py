@@ -0,0 +1,196 @@
+"""Collection of unit tests to verify that the reference files are kept
+up to date with CRDS, and are in place before they are used.
+
+Use
+---
+    ::
+        pytest test_startup_checks.py
+"""
+import os
+import shutil
+import threading
+import time
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+from jwst_magic import startup_checks
+from jwst_magic.utils import utils
+
+
+class FakeCRDS:
+    """Stand-in for the CRDS queries made by ``check_reference_files``,
+    which records the queries and writes small reference files"""
+    def __init__(self):
+        self.context = 'jwst_1000.pmap'
+        self.versions = {}
+        self.queries = []
+        self.downloads = []
+
+    def get_crds_context(self):
+        return self.context
+
+    def get_reffiles(self, parameters, reftypes, download=True):
+        (self.downloads if download else self.queries).append((parameters['DETECTOR'], tuple(reftypes)))
+        return {reftype.lower(): 'jwst_{}_{}_{}.fits'.format(
+            parameters['DETECTOR'].lower(), reftype.lower(), self.versions.get(parameters['DETECTOR'], 0))
+            for reftype in reftypes}
+
+    def convert(self, filename, out_filepath, *args):
+        header = fits.Header({'ORIGFILE': filename})
+        utils.write_fits(out_filepath, np.zeros((4, 4), dtype=np.uint16), header=header)
+
+
+@pytest.fixture()
+def fake_crds(tmpdir, monkeypatch):
+    """Point the reference files and their manifest at a temporary
+    directory, and replace the CRDS queries with a ``FakeCRDS``
+
+    Yields
+    -------
+    crds : FakeCRDS
+        The stand-in for CRDS
+    """
+    data_path = str(tmpdir)
+    shutil.copy(os.path.join(utils.DATA_PATH, 'bad_pixel_mask.yaml'), data_path)
+    crds = FakeCRDS()
+    monkeypatch.setenv('CRDS_SERVER_URL', 'https://jwst-crds.stsci.edu')
+    monkeypatch.setattr(utils, 'DATA_PATH', data_path)
+    monkeypatch.setattr(utils, 'REFERENCE_MANIFEST', os.path.join(data_path, 'reference_manifest.json'))
+    monkeypatch.setattr(utils, 'get_crds_context', crds.get_crds_context)
+    monkeypatch.setattr(utils, 'get_reffiles', crds.get_reffiles)
+    monkeypatch.setattr(utils, 'convert_bad_pixel_mask_files', crds.convert)
+    monkeypatch.setattr(utils, 'rotate_zero_bias_file', crds.convert)
+
+    # Download every file to start with
+    utils.check_reference_files()
+    assert len(crds.downloads) == 14
+    assert utils.missing_reference_files() == []
+    crds.queries.clear()
+    crds.downloads.clear()
+    yield crds
+
+
+def test_require_references_missing(monkeypatch):
+    """Check that missing reference files raise an error rather than
+    being silently skipped"""
+    monkeypatch.setattr(startup_checks, 'check_references', lambda timeout: ([], True))
+    monkeypatch.setattr(utils, 'missing_reference_files', lambda: ['/data/reference_files/g1bias0.fits'])
+
+    with pytest.raises(FileNotFoundError, match='g1bias0.fits'):
+        startup_checks.require_references()
+
+
+def test_require_references_waits(monkeypatch):
+    """Check that a reference file check that timed out is given time
+    to download missing files before they are used"""
+    release = threading.Event()
+    thread = threading.Thread(target=release.wait, daemon=True)
+    thread.start()
+    missing = ['/data/reference_files/g1bias0.fits']
+    monkeypatch.setattr(startup_checks, '_reference_sync', (thread, []))
+    monkeypatch.setattr(startup_checks, 'check_references', lambda timeout: ([], False))
+    monkeypatch.setattr(utils, 'missing_reference_files', lambda: [] if release.is_set() else missing)
+
+    assert not startup_checks.wait_for_reference_sync(timeout=0.1)
+    threading.Timer(0.2, release.set).start()
+    startup_checks.require_references(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_require_references_hanging(monkeypatch):
+    """Check that a reference file check that never finishes doesn't
+    block using the files that are already there, and times out when
+    they're missing"""
+    release = threading.Event()
+    thread = threading.Thread(target=release.wait, daemon=True)
+    thread.start()
+    monkeypatch.setattr(startup_checks, '_reference_sync', (thread, []))
+    monkeypatch.setattr(startup_checks, 'check_references', lambda timeout: ([], False))
+
+    try:
+        monkeypatch.setattr(utils, 'missing_reference_files', lambda: [])
+        startup_checks.require_references(timeout=0.01)
+        assert thread.is_alive()
+
+        monkeypatch.setattr(utils, 'missing_reference_files', lambda: ['/data/reference_files/g1bias0.fits'])
+        with pytest.raises(FileNotFoundError, match='g1bias0.fits'):
+            startup_checks.require_references(timeout=0.01)
+    finally:
+        release.set()
+
+
+def test_reference_manifest_ttl(fake_crds):
+    """Check that CRDS isn't consulted while the reference file manifest
+    is recent, and only the context is checked once it's older"""
+    utils.check_reference_files()
+    assert fake_crds.queries == [] and fake_crds.downloads == []
+
+    # Past the TTL, an unchanged context means the files are up to date
+    checked = utils.read_reference_manifest()['checked']
+    time.sleep(0.01)
+    utils.check_reference_files(ttl=0)
+    assert fake_crds.queries == [] and fake_crds.downloads == []
+    assert utils.read_reference_manifest()['checked'] > checked
+
+
+def test_reference_manifest_context(fake_crds):
+    """Check that a new CRDS context means each file is queried, and only
+    the ones that changed are downloaded"""
+    fake_crds.context = 'jwst_1001.pmap'
+    fake_crds.versions['NRCB2'] = 1
+    utils.check_reference_files(ttl=0)
+    assert len(fake_crds.queries) == 12
+    assert fake_crds.downloads == [('NRCB2', ('MASK',))]
+    manifest = utils.read_reference_manifest()
+    assert manifest['context'] == 'jwst_1001.pmap'
+    assert manifest['files']['reference_files/nircam_dq_nrcb2.fits']['original_filename'] == \
+        'jwst_nrcb2_mask_1.fits'
+
+
+def test_reference_manifest_tampered(fake_crds):
+    """Check that a reference file that no longer matches the manifest is
+    checked against CRDS, even while the manifest is recent"""
+    filepath = os.path.join(utils.DATA_PATH, 'reference_files', 'g1bias0.fits')
+    header = fits.getheader(filepath)
+    utils.write_fits(filepath, np.ones((4, 4), dtype=np.uint16), header=header)
+
+    utils.check_reference_files()
+    assert len(fake_crds.queries) == 12
+    assert utils.read_reference_manifest()['files']['reference_files/g1bias0.fits']['checksum'] == \
+        utils.file_checksum(filepath)
+
+
+def test_reference_manifest_force(fake_crds):
+    """Check that a forced check always queries CRDS"""
+    utils.check_reference_files(force=True)
+    assert len(fake_crds.queries) == 12
+    assert fake_crds.downloads == []
+
+
+def test_reference_manifest_mtime(fake_crds, monkeypatch):
+    """Check that a reference file that was touched but not changed is
+    only re-hashed once"""
+    filepath = os.path.join(utils.DATA_PATH, 'reference_files', 'fgs_dq_G1.fits')
+    mtime = os.stat(filepath).st_mtime + 10
+    os.utime(filepath, (mtime, mtime))
+
+    hashed = []
+    file_checksum = utils.file_checksum
+    monkeypatch.setattr(utils, 'file_checksum', lambda path: hashed.append(path) or file_checksum(path))
+    for _ in range(2):
+        utils.check_reference_files()
+    assert hashed == [filepath]
+    assert utils.read_reference_manifest()['files']['reference_files/fgs_dq_G1.fits']['mtime'] == mtime
+    assert fake_crds.queries == [] and fake_crds.downloads == []
+
+
+def test_write_fits_atomic(tmpdir):
+    """Check that FITS files are moved into place complete, leaving no
+    temporary files behind"""
+    outfile = os.path.join(str(tmpdir), 'reference.fits')
+    for value in [1, 2]:
+        utils.write_fits(outfile, np.full((16, 16), value, dtype=np.uint16))
+        assert np.all(fits.getdata(outfile) == value)
+    assert os.listdir(str(tmpdir)) == ['reference.fits']
@@ -16,7 +16,10 @@ Use
 from collections import OrderedDict
 import csv
 import datetime
+import functools
+import hashlib
 import itertools
+import json
 import logging
 import logging.config
 import os
@@ -24,6 +27,7 @@ import re
 import string
 import socket
 import sys
+import threading
 import time
 import requests
 import yaml
@@ -36,6 +40,7 @@ import numpy as np
 import pandas as pd
 import photutils
 from PyQt5.QtCore import QFile, QDir
+from scipy import fft, ndimage, sparse
 
 # Local Imports
 from jwst_magic.utils import coordinate_transforms
@@ -43,6 +48,17 @@ from jwst_magic.utils import coordinate_transforms
 PACKAGE_PATH = os.path.dirname(os.path.realpath(__file__)).split('utils')[0]
 DATA_PATH = os.path.join(PACKAGE_PATH, 'data')
 LOG_CONFIG_FILE = os.path.join(DATA_PATH, 'logging.yaml')
+REFERENCE_MANIFEST = os.path.join(DATA_PATH, 'reference_manifest.json')
+
+# Number of seconds for which the reference file manifest is trusted without checking CRDS
+REFERENCE_MANIFEST_TTL = float(os.environ.get('MAGIC_REFERENCE_TTL', 24 * 60 * 60))
+
+# Gaussian sigma (pixels) above which smooth_image convolves in Fourier space;
+# the crossover measured for 2048x2048 images (see test_smooth_image_benchmark)
+GAUSSIAN_FFT_SIGMA = 10
+
+# Number of pixels corrected at a time by correct_and_cast
+CORRECT_BLOCK_SIZE = 2 ** 18
 
 # Start logger
 LOGGER = logging.getLogger(__name__)
@@ -154,8 +170,7 @@ def determine_log_path(out_dir_path):
 def ensure_dir_exists(fullpath):
     """Creates dirs from ``fullpath`` if they do not already exist.
     """
-    if not os.path.exists(fullpath):
-        os.makedirs(fullpath)
+    os.makedirs(fullpath, exist_ok=True)
 
 
 def get_logname(logdir, taskname):
@@ -192,8 +207,7 @@ def write_fits(outfile, data, header=None, log=None):
     or lists of arrays/headers
     """
     out_dir = os.path.dirname(outfile)
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
 
     header_list = header if isinstance(header, list) else [header]
     for hdr in header_list:
@@ -212,7 +226,7 @@ def write_fits(outfile, data, header=None, log=None):
             hdu_list.append(hdu)
         hdul = fits.HDUList(hdu_list)
 
-    hdul.writeto(outfile, overwrite=True)
+    write_hdul(hdul, outfile)
 
     if log is not None:
         log.info(f"Successfully wrote: {outfile}")
@@ -220,6 +234,70 @@ def write_fits(outfile, data, header=None, log=None):
         print(f"Successfully wrote: {outfile}")
 
 
+def write_hdul(hdul, outfile):
+    """Write an HDU or HDUList to a temporary file and then move it into
+    place, so that readers (and interrupted writes) never see a partly
+    written file at ``outfile``.
+    """
+    # Keep the extension, which astropy uses to decide on compression
+    root, ext = os.path.splitext(outfile)
+    tmpfile = '{}.{}-{}.tmp{}'.format(root, os.getpid(), threading.get_ident(), ext)
+    try:
+        hdul.writeto(tmpfile, overwrite=True)
+        os.replace(tmpfile, outfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+class FitsCubeWriter(object):
+    """Write a 3-D array to a FITS file a block of frames at a time, so
+    the whole cube never has to be held in memory. The file written is
+    the same as writing the full cube with ``write_fits``.
+
+    Parameters
+    ----------
+    outfile : str
+        Path of the FITS file to write
+    shape : tuple
+        Shape of the full cube (n_frames, n_rows, n_cols)
+    dtype : numpy dtype
+        Data type to write the cube as (e.g. np.uint16)
+    header : astropy.io.fits.Header, optional
+        Primary header to write with the data
+    """
+    def __init__(self, outfile, shape, dtype, header=None):
+        ensure_dir_exists(os.path.dirname(outfile))
+        if os.path.exists(outfile):
+            os.remove(outfile)
+
+        self.outfile = outfile
+        self.dtype = np.dtype(dtype)
+
+        # Build the header for one frame, then expand it to the full cube
+        hdr = fits.PrimaryHDU(data=np.zeros((1,) + tuple(shape[1:]), dtype=self.dtype),
+                              header=header).header
+        hdr['NAXIS3'] = shape[0]
+        self._stream = fits.StreamingHDU(outfile, hdr)
+
+    def write(self, data):
+        """Append a block of frames to the cube"""
+        data = np.asarray(data, dtype=self.dtype)
+        if self.dtype == np.uint16:
+            # FITS stores unsigned 16-bit data as signed with BZERO = 32768
+            data = (data ^ np.uint16(0x8000)).view(np.int16)
+        self._stream.write(data)
+
+    def close(self, log=None):
+        """Finish writing the file"""
+        self._stream.close()
+
+        if log is not None:
+            log.info(f"Successfully wrote: {self.outfile}")
+        else:
+            print(f"Successfully wrote: {self.outfile}")
+
+
 def write_to_file(filename, rows, labels='', mode='w', fmt='%.4f'):
     """ Write out results to a csv, dat, txt, etc file.
 
@@ -241,8 +319,7 @@ def write_to_file(filename, rows, labels='', mode='w', fmt='%.4f'):
         Format string for the text being written.
     """
     out_dir = os.path.dirname(filename)
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
 
     mode = mode
     if filename.endswith('csv'):
@@ -300,48 +377,48 @@ def resize_array(arr, new_rows, new_cols):
     of size new_rows, new_cols. new_rows and new_cols must be less than
     or equal to the number of rows and columns in a. new_rows and new_columns
     do not have to be integer factors of the original array rows and columns.
+
+    Each output pixel is the area-weighted average of the input pixels it
+    covers. The averaging is separable, so it is applied as two sparse
+    matrix products (see ``rebin_matrix``), which are cached per shape.
     """
     rows, cols = np.shape(arr)
-    yscale = float(rows) / new_rows
-    xscale = float(cols) / new_cols
+    arr = np.asarray(arr, dtype=np.float64)
 
     # First average across the cols to shorten rows
-    new_a = np.zeros((rows, new_cols))
-    for j in range(new_cols):
-        # Calculate the (fractional) starting and ending columns that will be
-        # averaged into one column (e.g. averaging from column 4.3 to 7.8)
-        firstx, lastx = j * xscale, (j + 1) * xscale
-        # Calculate list of scaling factors of each column that is being averaged
-        # e.g. if avging from 4.3 to 7.8: [0.7, 1, 1, 0.8]
-        #                        column:    4   5  6   7
-        scale_line = rescale_array(firstx, lastx)
-
-        # Fill new array with averaged columns
-        try:
-            new_a[:, j] = np.dot(arr[:, int(firstx):int(lastx) + 1], scale_line) / scale_line.sum()
-        except ValueError:
-            # If needed, crop the scaling list to match the number of columns
-            scale_line = scale_line[:-1]
-            new_a[:, j] = np.dot(arr[:, int(firstx):int(lastx) + 1], scale_line) / scale_line.sum()
+    new_a = (rebin_matrix(cols, new_cols) @ arr.T).T
 
     # Then average across the rows to produce the final array
-    new_arr = np.zeros((new_rows, new_cols))
-    for i in range(new_rows):
+    new_arr = rebin_matrix(rows, new_rows) @ new_a
+
+    return new_arr
+
+
+@functools.lru_cache(maxsize=16)
+def rebin_matrix(n_in, n_out):
+    """
+    Build the sparse (n_out x n_in) matrix that averages n_in rows (or
+    columns) down to n_out, weighting each by the fraction of it that
+    falls within the output row (see ``rescale_array``). To be used with
+    resize_array.
+    """
+    scale = float(n_in) / n_out
+    out_inds, in_inds, weights = [], [], []
+    for j in range(n_out):
         # Calculate the (fractional) starting and ending rows that will be
-        # averaged into one row
-        firsty, lasty = i * yscale, (i + 1) * yscale
-        # Calculate scaling factors of each row that is being averaged
-        scale_line = rescale_array(firsty, lasty)
+        # averaged into one row (e.g. averaging from row 4.3 to 7.8)
+        first, last = j * scale, (j + 1) * scale
+        scale_line = rescale_array(first, last)
 
-        # Fill new array with averaged rows
-        try:
-            new_arr[i:, ] = np.dot(scale_line, new_a[int(firsty):int(lasty) + 1, ]) / scale_line.sum()
-        except ValueError:
-            # If needed, crop the scaling list to match the number of rows
-            scale_line = scale_line[:-1]
-            new_arr[i:, ] = np.dot(scale_line, new_a[int(firsty):int(lasty) + 1, ]) / scale_line.sum()
+        # If needed, crop the scaling list to match the number of rows
+        scale_line = scale_line[:n_in - int(first)]
 
-    return new_arr
+        out_inds.append(np.full(len(scale_line), j))
+        in_inds.append(np.arange(int(first), int(first) + len(scale_line)))
+        weights.append(scale_line / scale_line.sum())
+
+    return sparse.csr_matrix((np.concatenate(weights), (np.concatenate(out_inds), np.concatenate(in_inds))),
+                             shape=(n_out, n_in))
 
 
 def rescale_array(first, last):
@@ -357,6 +434,79 @@ def rescale_array(first, last):
     return scale_line
 
 
+def smooth_image(data, sigma, method='auto', truncate=4.0):
+    """Apply a Gaussian filter to an image, giving the same result as
+    ``scipy.ndimage.gaussian_filter(data, sigma, truncate=truncate)``.
+
+    The cost of filtering in the spatial domain grows with sigma, so for
+    sigma above ``GAUSSIAN_FFT_SIGMA`` the (reflect-padded) image is
+    convolved with the same truncated kernel using real FFTs, one axis
+    at a time. The results agree to ~1e-15 of the image maximum.
+
+    Parameters
+    ----------
+    data : 2-D numpy array
+        Image data
+    sigma : float
+        The sigma of the Gaussian filter (pixels)
+    method : str, optional
+        "spatial" for ndimage.gaussian_filter, "fft" for the Fourier
+        convolution, or "auto" to choose based on sigma. Integer images,
+        images with NaNs or infs, and per-axis sigmas are always
+        filtered spatially.
+    truncate : float, optional
+        Truncate the filter at this many standard deviations
+
+    Returns
+    -------
+    smoothed_data : 2-D numpy array
+        Smoothed image data
+    """
+    if method not in ['auto', 'spatial', 'fft']:
+        raise ValueError('Unknown smoothing method {}; use "auto", "spatial", or "fft"'.format(method))
+
+    data = np.asarray(data)
+    use_fft = method == 'fft' or (method == 'auto' and np.isscalar(sigma) and sigma > GAUSSIAN_FFT_SIGMA)
+    if (not use_fft or not np.isscalar(sigma) or sigma <= 0 or data.ndim != 2 or
+            not np.issubdtype(data.dtype, np.floating) or not np.all(np.isfinite(data))):
+        return ndimage.gaussian_filter(data, sigma, truncate=truncate)
+
+    radius = int(truncate * float(sigma) + 0.5)
+    smoothed_data = data
+    for axis in [0, 1]:
+        n = data.shape[axis]
+        length = fft.next_fast_len(n + 2 * radius, real=True)
+        pad_width = [(0, 0), (0, 0)]
+        pad_width[axis] = (radius, radius)
+        # ndimage's "reflect" mode repeats the edge pixel, like numpy's "symmetric"
+        padded = np.pad(smoothed_data, pad_width, mode='symmetric')
+
+        kernel_spectrum = gaussian_kernel_spectrum(length, float(sigma), radius)
+        kernel_spectrum = kernel_spectrum[:, np.newaxis] if axis == 0 else kernel_spectrum
+        convolved = fft.irfft(fft.rfft(padded, n=length, axis=axis) * kernel_spectrum, n=length, axis=axis)
+        smoothed_data = convolved[radius:radius + n] if axis == 0 else convolved[:, radius:radius + n]
+
+    return np.ascontiguousarray(smoothed_data, dtype=data.dtype)
+
+
+@functools.lru_cache(maxsize=16)
+def gaussian_kernel_spectrum(length, sigma, radius):
+    """
+    Real FFT of the normalized Gaussian kernel ndimage.gaussian_filter
+    uses (truncated at ``radius``), centered on index 0 of an array of
+    ``length`` points. To be used with smooth_image.
+    """
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / sigma ** 2 * x ** 2)
+    kernel /= kernel.sum()
+
+    wrapped_kernel = np.zeros(length)
+    wrapped_kernel[:radius + 1] = kernel[radius:]
+    if radius > 0:
+        wrapped_kernel[-radius:] = kernel[:radius]
+    return fft.rfft(wrapped_kernel)
+
+
 def find_xy_between_two_points(coords1, coords2):
     """
     Find the x and y differences between two points
@@ -388,22 +538,139 @@ def find_dist_between_points(coords):
     return dists
 
 
-def correct_image(image, upper_threshold=None, upper_limit=None):
+def correct_image(image, upper_threshold=None, upper_limit=None, inplace=False):
     """
-    Correct image for negative and saturated pixels
+    Correct image for negative and saturated pixels. If inplace is True,
+    the input array is corrected directly rather than copied first.
     """
-    img = np.copy(image)
+    if upper_threshold is None or upper_limit is None or upper_threshold == upper_limit:
+        upper = upper_limit if upper_threshold is not None else None
+        return correct_and_cast(image, upper, inplace=inplace)
+
+    img = image if inplace else np.copy(image)
     img[img < 0] = 0.            # neg pixs -> 0
-    if (upper_threshold is not None) and (upper_limit is not None):
-        img[img >= upper_threshold] = upper_limit
+    img[img >= upper_threshold] = upper_limit
     img[np.isfinite(img) == 0] = 0.
 
     return img
 
 
+def correct_and_cast(image, upper_limit=None, dtype=None, out=None, inplace=False,
+                     block_size=CORRECT_BLOCK_SIZE):
+    """Set negative and non-finite pixels to 0 and pixels at or above
+    ``upper_limit`` to ``upper_limit``, and cast the result to ``dtype``,
+    in a single pass over the image.
+
+    The image is processed in blocks of about ``block_size`` pixels, so
+    apart from the output only a block-sized temporary is made. This
+    gives the same result as ``correct_image(image, upper_limit,
+    upper_limit)`` followed by ``.astype(dtype)``, without the
+    intermediate full-size copies.
+
+    Parameters
+    ----------
+    image : numpy array
+        Image data (may be a non-contiguous view)
+    upper_limit : float, optional
+        Saturation value; if None, only negative and non-finite pixels
+        are corrected (and +inf is set to 0)
+    dtype : numpy dtype, optional
+        Data type of the result (e.g. np.uint16); defaults to the dtype
+        of ``image``. Values are truncated as by ``astype``.
+    out : numpy array, optional
+        Array of the same shape to write the result to
+    inplace : bool, optional
+        Write the result into ``image`` itself (``dtype`` must be the
+        image dtype)
+    block_size : int, optional
+        Approximate number of pixels processed at a time
+
+    Returns
+    -------
+    corrected : numpy array
+        The corrected image (``out`` or ``image`` if given)
+    """
+    image = np.asarray(image)
+    dtype = image.dtype if dtype is None else np.dtype(dtype)
+    if inplace:
+        if dtype != image.dtype:
+            raise ValueError('Cannot correct an image of type {} in place as {}.'.format(image.dtype, dtype))
+        out = image
+    elif out is None:
+        out = np.empty(image.shape, dtype=dtype)
+    elif out.shape != image.shape:
+        raise ValueError('Output shape {} does not match image shape {}.'.format(out.shape, image.shape))
+
+    is_float = np.issubdtype(image.dtype, np.floating)
+    same_dtype = out.dtype == image.dtype
+    image_2d = image.reshape((1,) * (2 - image.ndim) + image.shape) if image.ndim < 2 else image
+    out_2d = out.reshape(image_2d.shape) if image.ndim < 2 else out
+    n_rows, n_cols = image_2d.shape[-2:]
+    rows_per_block = max(1, block_size // max(n_cols, 1))
+
+    for plane in np.ndindex(image_2d.shape[:-2]):
+        for row in range(0, n_rows, rows_per_block):
+            index = plane + (slice(row, row + rows_per_block),)
+            block = np.clip(image_2d[index], 0, upper_limit, out=out_2d[index] if same_dtype else None)
+            if is_float:
+                block[~np.isfinite(block)] = 0
+            if not same_dtype:
+                out_2d[index] = block
+
+    return out
+
+
+def get_rng(rng=None):
+    """Get the source of random numbers for simulating noise.
+
+    Parameters
+    ----------
+    rng : int, numpy.random.SeedSequence, or numpy.random.Generator, optional
+        Seed or generator. If None, the global (legacy) ``np.random``
+        state is used, so that ``np.random.seed`` still applies.
+
+    Returns
+    -------
+    rng : numpy.random.Generator or module
+        A PCG64 ``numpy.random.Generator``, or the ``np.random`` module
+    """
+    if rng is None or rng is np.random:
+        return np.random
+    return np.random.default_rng(rng)
+
+
+def spawn_rngs(seed, n_configs, n_steps):
+    """Create independent random number generators for each guiding
+    config and each step within it, so that the noise in every
+    config/step doesn't depend on the order in which they are run.
+
+    Parameters
+    ----------
+    seed : int or None
+        Seed for the whole run. If None, fresh entropy is used.
+    n_configs : int
+        Number of guiding configurations
+    n_steps : int
+        Number of steps per configuration
+
+    Returns
+    -------
+    rngs : list of lists
+        List (one per config) of lists (one per step) of
+        ``numpy.random.Generator`` objects
+    """
+    configs = np.random.SeedSequence(seed).spawn(n_configs)
+    return [[np.random.default_rng(step) for step in config.spawn(n_steps)] for config in configs]
+
+
 def count_rate_total(data, objects, num_objects, x, y, countrate_3x3=True, log=None):
     """Get the count rates within each object from a segmentation image.
 
+    The pixel counts (and full-object count rates) of all objects are
+    found in a single pass over the segmentation image, and the peak
+    refinement and 3x3 sums are done for all PSFs at once (see
+    ``count_rate_3x3_batch``).
+
     Parameters
     ----------
     data : 2-D numpy array
@@ -427,39 +694,140 @@ def count_rate_total(data, objects, num_objects, x, y, countrate_3x3=True, log=N
     val : list
         List of number of pixels within each segmentation object
     """
+    data = np.asarray(data)
+    objects = np.asarray(objects)
+    n_psfs = min(num_objects, len(x), len(y))
+    labels = np.arange(1, n_psfs + 1)
 
-    countrate = []
-    val = []
-    for i, x_old, y_old in zip(np.arange(1, num_objects + 1), x, y):
-        im = np.copy(objects)
-        im[objects != i] = False
-        im[objects == i] = True
-
-        if countrate_3x3:
-            image_window = 40  # This should be more than large enough to get the core of the PSF
-            min_x = (int(x_old) - image_window) if (int(x_old) - image_window) >= 0 else 0
-            min_y = (int(y_old) - image_window) if (int(y_old) - image_window) >= 0 else 0
-            max_x = int(x_old) + image_window
-            max_y = int(y_old) + image_window
-            sources = find_peaks(data[min_y:max_y, min_x:max_x],
-                                 box_size=1, npeaks=1, threshold='standard-deviation')
-            # If no source was found with the original threshold, skip the star
-            if sources is None:
-                if log is not None:
-                    log.info(f'Find Peaks function cannot find a peak near (y,x) = ({y_old}, {x_old}).')
-                countrate.append(0)
-            else:
-                x_new = sources['x_peak'][0] + x_old - image_window  # find new x value
-                y_new = sources['y_peak'][0] + y_old - image_window  # find new y value
-                # Get the 3x3 count rate
-                countrate.append(get_countrate_3x3(x_new, y_new, np.array(data)))
-        else:
-            countrate.append(np.sum(im * data))
-        val.append(np.sum(im * 1.))  # Number of pixels in object
+    # Number of pixels in each object
+    val = list(ndimage.sum_labels(np.ones(objects.shape), objects, labels))
+
+    if countrate_3x3:
+        countrate = list(count_rate_3x3_batch(data, x[:n_psfs], y[:n_psfs], log=log))
+    else:
+        countrate = list(ndimage.sum_labels(data, objects, labels))
 
     return countrate, val
 
 
+def count_rate_3x3_batch(data, x, y, image_window=40, chunk_size=256, log=None):
+    """Find the brightest pixel near each PSF and sum the 3x3 box around it.
+
+    For each PSF, the brightest pixel in the (2 * ``image_window``)^2
+    box around (``x``, ``y``) is used if it is above the box's median
+    plus 3 standard deviations (as with ``find_peaks(...,
+    threshold='standard-deviation')``); otherwise the count rate is 0.
+    The boxes of all PSFs that are fully on the detector are processed
+    together, ``chunk_size`` at a time. PSFs near the edge of the
+    image, in boxes with NaNs, or with tied brightest pixels go through
+    ``find_peaks`` one at a time, so the results are the same either
+    way.
+
+    Parameters
+    ----------
+    data : 2-D numpy array
+        Image data
+    x : list
+        List of x-coordinates of identified PSFs
+    y : list
+        List of y-coordinates of identified PSFs
+    image_window : int, optional
+        Half-width of the box searched for the peak
+    chunk_size : int, optional
+        Number of boxes to process at once
+    log : logging.Logger, optional
+        Logger used to report PSFs without a peak
+
+    Returns
+    -------
+    countrate : numpy array
+        3x3 count rate of each PSF
+    """
+    data = np.asarray(data)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n_rows, n_cols = data.shape
+    countrate = np.zeros(len(x), dtype=np.result_type(data.dtype, float))
+
+    # Lower corners of the search boxes
+    min_x = x.astype(int) - image_window
+    min_y = y.astype(int) - image_window
+    batch = ((min_x >= 0) & (min_y >= 0) &
+             (min_x + 2 * image_window <= n_cols) & (min_y + 2 * image_window <= n_rows))
+
+    unbatched = list(np.flatnonzero(~batch))
+    batch_inds = np.flatnonzero(batch)
+    if len(batch_inds) > 0:
+        windows = np.lib.stride_tricks.sliding_window_view(data, (2 * image_window, 2 * image_window))
+    for start in range(0, len(batch_inds), chunk_size):
+        inds = batch_inds[start:start + chunk_size]
+        boxes = windows[min_y[inds], min_x[inds]].reshape(len(inds), -1)
+
+        threshold = np.median(boxes, axis=1) + 3 * np.std(boxes, axis=1)
+        peak = np.argmax(boxes, axis=1)
+        peak_value = boxes[np.arange(len(inds)), peak]
+        n_peaks = np.count_nonzero(boxes == peak_value[:, None], axis=1)
+
+        # NaNs and ties are left to find_peaks
+        simple = np.isfinite(threshold) & (n_peaks == 1)
+        unbatched += list(inds[~simple])
+
+        found = simple & (peak_value > threshold)
+        for i in inds[simple & ~found]:
+            _log_missing_peak(x[i], y[i], log)
+
+        inds, peak = inds[found], peak[found]
+        y_peak, x_peak = np.divmod(peak, 2 * image_window)
+        x_new = (x_peak + x[inds] - image_window).astype(int)
+        y_new = (y_peak + y[inds] - image_window).astype(int)
+        countrate[inds] = _sum_3x3(data, x_new, y_new)
+
+    for i in sorted(unbatched):
+        countrate[i] = _count_rate_3x3_single(data, x[i], y[i], image_window, log)
+
+    return countrate
+
+
+def _count_rate_3x3_single(data, x_old, y_old, image_window, log=None):
+    """Find the peak near one PSF with find_peaks and return its 3x3 count rate"""
+    min_x = max(int(x_old) - image_window, 0)
+    min_y = max(int(y_old) - image_window, 0)
+    max_x = int(x_old) + image_window
+    max_y = int(y_old) + image_window
+    sources = find_peaks(data[min_y:max_y, min_x:max_x],
+                         box_size=1, npeaks=1, threshold='standard-deviation')
+    # If no source was found with the original threshold, skip the star
+    if sources is None:
+        _log_missing_peak(x_old, y_old, log)
+        return 0
+
+    x_new = sources['x_peak'][0] + x_old - image_window  # find new x value
+    y_new = sources['y_peak'][0] + y_old - image_window  # find new y value
+    return get_countrate_3x3(x_new, y_new, data)
+
+
+def _log_missing_peak(x_old, y_old, log=None):
+    if log is not None:
+        log.info(f'Find Peaks function cannot find a peak near (y,x) = ({y_old}, {x_old}).')
+
+
+def _sum_3x3(data, x, y):
+    """Vectorized ``get_countrate_3x3`` for arrays of integer coordinates"""
+    n_rows, n_cols = data.shape
+    inside = (x >= 1) & (y >= 1) & (x + 2 <= n_cols) & (y + 2 <= n_rows)
+
+    countrate = np.zeros(len(x), dtype=np.result_type(data.dtype, float))
+    if np.any(inside):
+        boxes = np.lib.stride_tricks.sliding_window_view(data, (3, 3))[y[inside] - 1, x[inside] - 1]
+        countrate[inside] = boxes.sum(axis=(1, 2))
+
+    # Boxes that hang off the edge are sliced exactly as before
+    for i in np.flatnonzero(~inside):
+        countrate[i] = get_countrate_3x3(x[i], y[i], data)
+
+    return countrate
+
+
 def get_countrate_3x3(x, y, data):
     """
     Using the coordinates of each PSF, place a 3x3 box around center pixel and sum
@@ -843,23 +1211,46 @@ def rotate_zero_bias_file(bias_file, expected_filepath, guider):
     header['HISTORY'] = 'This file was updated by jwst_magic software to be rotated from the DMS Science ' \
                         f'Frame into the FGS{guider} Raw Frame'
     hdul = fits.PrimaryHDU(data=new_image, header=header)
-    hdul.writeto(expected_filepath, overwrite=True)
+    write_hdul(hdul, expected_filepath)
 
 
-def check_reference_files():
+def check_reference_files(ttl=REFERENCE_MANIFEST_TTL, force=False):
     """
     Given a file path, file type, and the detector that it is for, check if the reference
     file exists in MAGIC and is the right one, and if not, pull the latest file from CRDS
     and convert it as needed.
+
+    What was found is recorded in a local manifest (see ``REFERENCE_MANIFEST``). While the
+    manifest is younger than ``ttl`` seconds and the local files still match it, CRDS is not
+    consulted at all. Once it is older, CRDS is only queried file by file if the CRDS context
+    has changed.
+
+    Parameters
+    ----------
+    ttl : float, optional
+        Number of seconds for which a manifest is trusted without consulting CRDS
+    force : bool, optional
+        Query CRDS for every file regardless of the manifest
     """
+    manifest = read_reference_manifest()
+    if not force and time.time() - manifest['checked'] < ttl and reference_manifest_matches_files(manifest):
+        return
+
     # Set CRDS server
     crds_server = os.environ.get('CRDS_SERVER_URL')
     if crds_server is None:
         os.environ["CRDS_SERVER_URL"] = "https://jwst-crds.stsci.edu"
 
+    # If the CRDS context hasn't changed, neither have the best reference files
+    context = get_crds_context()
+    if not force and context is not None and context == manifest['context'] and \
+            reference_manifest_matches_files(manifest):
+        manifest['checked'] = time.time()
+        write_reference_manifest(manifest)
+        return
+
     # Open the bad pixel mask yaml file that will indicate where those files should live
-    with open(os.path.join(DATA_PATH, 'bad_pixel_mask.yaml')) as f:
-        bad_pixel_map_yaml = yaml.safe_load(f.read())
+    bad_pixel_map_yaml = read_bad_pixel_mask_yaml()
 
     # There is only one case where we don't grab a new file so we set the default to True
     dets = {'GUIDER1': 'FGS',
@@ -875,6 +1266,7 @@ def check_reference_files():
             'NRCB4': 'NIRCAM',
             'NRCBLONG': 'NIRCAM',
             }
+    files = {}
     for detector, instrument in dets.items():
         # Set parameters for CRDS query
         imaging = f'{instrument}_IMAGE'
@@ -900,7 +1292,7 @@ def check_reference_files():
                                                  bad_pixel_map_yaml[instrument][detector])
                 if os.path.exists(expected_filepath):
                     # We want grab a new file if the filenames do NOT match
-                    original_filename = get_original_filename(expected_filepath)
+                    original_filename = get_manifest_original_filename(manifest, expected_filepath)
                     grab_new_file = original_filename != reffile_mapping[reftype.lower()]
                 if grab_new_file:
                     # Download the file
@@ -915,7 +1307,7 @@ def check_reference_files():
                                                  f'g{detector[-1]}bias0.fits')
                 if os.path.exists(expected_filepath):
                     # We want grab a new file if the filenames do NOT match
-                    original_filename = get_original_filename(expected_filepath)
+                    original_filename = get_manifest_original_filename(manifest, expected_filepath)
                     grab_new_file = original_filename != reffile_mapping[reftype.lower()]
                 if grab_new_file:
                     # Download the file
@@ -925,6 +1317,175 @@ def check_reference_files():
                     rotate_zero_bias_file(bias_mapping[reftype.lower()], expected_filepath,
                                           detector[-1])
 
+            files[os.path.relpath(expected_filepath, DATA_PATH)] = \
+                make_manifest_entry(expected_filepath, reffile_mapping[reftype.lower()])
+
+    write_reference_manifest({'context': context, 'checked': time.time(), 'files': files})
+
+
+def read_bad_pixel_mask_yaml():
+    """Read the locations of the bad pixel masks for each instrument
+    and detector, relative to ``DATA_PATH``"""
+    with open(os.path.join(DATA_PATH, 'bad_pixel_mask.yaml')) as f:
+        return yaml.safe_load(f.read())
+
+
+def reference_file_paths():
+    """List the paths of all the reference files that are kept up to
+    date by ``check_reference_files``: the FGS and NIRCam bad pixel
+    masks, and the FGS zeroth read bias files.
+    """
+    paths = [os.path.join(DATA_PATH, path) for detectors in read_bad_pixel_mask_yaml().values()
+             for path in detectors.values()]
+    paths += [os.path.join(DATA_PATH, 'reference_files', f'g{guider}bias0.fits') for guider in [1, 2]]
+    return sorted(set(paths))
+
+
+def missing_reference_files():
+    """List the reference files (see ``reference_file_paths``) that
+    don't exist locally"""
+    return [path for path in reference_file_paths() if not os.path.exists(path)]
+
+
+def bad_pixel_mask_checksums():
+    """Get the checksums of the local bad pixel masks, from the reference
+    file manifest where it is up to date with the file.
+
+    Returns
+    -------
+    checksums : dict
+        Checksum (None if the file is missing) of each mask, keyed on
+        its path relative to ``DATA_PATH``
+    """
+    manifest = read_reference_manifest()
+    checksums = {}
+    for detectors in read_bad_pixel_mask_yaml().values():
+        for relpath in detectors.values():
+            filepath = os.path.join(DATA_PATH, relpath)
+            entry = manifest['files'].get(relpath)
+            if not os.path.exists(filepath):
+                checksums[relpath] = None
+            elif entry is not None and entry.get('mtime') == os.stat(filepath).st_mtime:
+                checksums[relpath] = entry['checksum']
+            else:
+                checksums[relpath] = file_checksum(filepath)
+    return checksums
+
+
+def get_crds_context():
+    """Get the name of the current (operational) JWST CRDS context,
+    e.g. 'jwst_1100.pmap', or None if it can't be determined.
+    """
+    # IMPORTANT: Import of crds package must be done AFTER the environment
+    # variables are set in check_reference_files
+    import crds
+    from crds import CrdsError
+
+    try:
+        return crds.get_context_name('jwst')
+    except (CrdsError, OSError):
+        return None
+
+
+def read_reference_manifest():
+    """Read the local reference file manifest, which records the CRDS
+    context, when CRDS was last checked, and the original filename,
+    checksum, and modification time of each converted reference file.
+
+    Returns
+    -------
+    manifest : dict
+        The manifest, or an empty manifest if there isn't a readable one
+    """
+    try:
+        with open(REFERENCE_MANIFEST) as f:
+            manifest = json.load(f)
+        if {'context', 'checked', 'files'} <= set(manifest):
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {'context': None, 'checked': 0, 'files': {}}
+
+
+def write_reference_manifest(manifest):
+    """Write the local reference file manifest (see ``read_reference_manifest``)
+
+    Parameters
+    ----------
+    manifest : dict
+        The manifest to write
+    """
+    tmpfile = '{}.{}-{}.tmp'.format(REFERENCE_MANIFEST, os.getpid(), threading.get_ident())
+    with open(tmpfile, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmpfile, REFERENCE_MANIFEST)
+
+
+def make_manifest_entry(filepath, original_filename):
+    """Record the original (CRDS) filename, checksum, and modification
+    time of a converted reference file, for the reference file manifest.
+    """
+    return {'original_filename': original_filename,
+            'checksum': file_checksum(filepath),
+            'mtime': os.stat(filepath).st_mtime}
+
+
+def reference_manifest_matches_files(manifest):
+    """Check that every reference file in the manifest still exists and is
+    unchanged. Files are only re-hashed if their modification time has
+    changed; entries whose contents still match get the new time, which
+    is saved so they aren't re-hashed next time.
+
+    Parameters
+    ----------
+    manifest : dict
+        The reference file manifest
+
+    Returns
+    -------
+    matches : bool
+        True if the manifest lists files and they all match it
+    """
+    if not manifest['files']:
+        return False
+
+    refreshed = False
+    for filename, entry in manifest['files'].items():
+        filepath = os.path.join(DATA_PATH, filename)
+        try:
+            mtime = os.stat(filepath).st_mtime
+        except OSError:
+            return False
+        if mtime != entry['mtime']:
+            if file_checksum(filepath) != entry['checksum']:
+                return False
+            entry['mtime'] = mtime
+            refreshed = True
+
+    if refreshed:
+        write_reference_manifest(manifest)
+    return True
+
+
+def get_manifest_original_filename(manifest, filepath):
+    """Get the original (CRDS) filename of a converted reference file from
+    the manifest if the file is unchanged since it was recorded, or else
+    from its header.
+    """
+    entry = manifest['files'].get(os.path.relpath(filepath, DATA_PATH))
+    if entry is not None and entry['mtime'] == os.stat(filepath).st_mtime:
+        return entry['original_filename']
+    return get_original_filename(filepath)
+
+
+def file_checksum(filepath):
+    """Compute the SHA-256 checksum of a file"""
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
 
 def get_original_filename(filepath):
     """